@@ -15,6 +15,15 @@
 #                  If given, len(npixstep) must equal len(templates)
 # dest (string): Full path to directory in which output fill will be written.  If not specified, defaults to
 #                $REDMONSTER_SPECTRO_REDUX/$RUN2D/pppp/$RUN1D/ , where pppp is the 4 digit plate id.
+# refine (Boolean): If set, templates with npixstep > 1 are searched on that coarse grid first, then at every pixel
+#                   around the best coarse minima of each spectrum; results are on the npixstep=1 grid.
+# prune (Boolean): With refine, only templates whose coarse chi2 is estimated to come within 23.3 of the best in a
+#                  window are recomputed there (a heuristic; see zfinder.prune_templates).
+# rank, rank_tol: If rank is given, templates are correlated through a truncated SVD basis of rank vectors or, with
+#                 'auto', of the fewest vectors keeping a chi2 error bound within rank_tol (see ZFinder.choose_rank).
+#                 Spectra are refitted with the full template set if the measured chi2 error exceeds rank_tol.
+# chi2encoding (string): With chi2file, write chi2 surfaces as tile compressed files, one tile per fiber, in 'float32' or
+#                        'delta' (quantized chi2 - minimum chi2) encoding (see io2.write_chi2), instead of float64.
 # clobber (Boolean): Default behavior is to overwrite older output files for same plate/mjd.  Setting to false will cause new
 #                    version to be written.
 #
@@ -39,13 +48,30 @@ from redmonster.physics import misc
 
 class ZFind:
 
-    def __init__(self, num_z=5, inifile=None, dest=None, nproc=1, clobber=True):
+    def __init__(self, num_z=5, inifile=None, dest=None, nproc=1, clobber=True,
+                 reduce=False, refine=False, rank=None, rank_tol=2.33,
+                 backend='processes', prune=False, chi2encoding=None):
         self.num_z = num_z
         self.inifile = inifile
         self.dest = dest
         self.clobber = clobber
         if self.inifile: self.set_templates_from_inifile()
         self.nproc = nproc
+        # ZFinder parallel backend for nproc > 1: 'processes' or 'threads'
+        self.backend = backend
+        # Keep only per-redshift chi2 minima over templates in ZFinder
+        self.reduce = reduce
+        # Coarse-to-fine redshift search for templates with npixstep > 1
+        self.refine = refine
+        # With refine, skip templates estimated not to come within the
+        # ZFitter threshold of the best chi2 in a refined window
+        self.prune = prune
+        # Low rank template basis in ZFinder: rank, or 'auto', and the chi2
+        # error tolerance
+        self.rank = rank
+        self.rank_tol = rank_tol
+        # Encoding of chi2 files: None (float64), 'float32' or 'delta'
+        self.chi2encoding = chi2encoding
 
     def set_templates_from_inifile(self):
         self.labels = []
@@ -215,13 +241,21 @@ class ZFind:
                                                   npoly=self.npoly[i],
                                                   zmin=self.zmin[i],
                                                   zmax=self.zmax[i],
-                                                  nproc=self.nproc) )
+                                                  nproc=self.nproc,
+                                                  reduce=self.reduce,
+                                                  rank=self.rank,
+                                                  rank_tol=self.rank_tol,
+                                                  backend=self.backend,
+                                                  chi2encoding=self.chi2encoding) )
                 zfindobjs[i].zchi2( specs.flux, specs.loglambda, specs.ivar,
                                    npixstep=self.npixstep[i], plate=plate,
-                                   mjd=mjd, fiberid=fiberid[0],
-                                   chi2file=self.chi2file )
+                                   mjd=mjd, fiberid=fiberid,
+                                   chi2file=self.chi2file,
+                                   refine=self.refine, prune=self.prune )
+                zfindobjs[i].close_pool()
                 zfitobjs.append( zfitter.ZFitter(zfindobjs[i].zchi2arr,
-                                                 zfindobjs[i].zbase) )
+                                                 zfindobjs[i].zbase,
+                                                 zfindobjs[i].zchi2argmin) )
                 zfitobjs[i].z_refine2()
         else:
             for i in range(len(self.templates)):
@@ -229,13 +263,21 @@ class ZFind:
                                                   group=self.group[i],
                                                   npoly=self.npoly[i],
                                                   npixstep=self.npixstep[i],
-                                                  nproc=self.nproc) )
+                                                  nproc=self.nproc,
+                                                  reduce=self.reduce,
+                                                  rank=self.rank,
+                                                  rank_tol=self.rank_tol,
+                                                  backend=self.backend,
+                                                  chi2encoding=self.chi2encoding) )
                 zfindobjs[i].zchi2( specs.flux, specs.loglambda, specs.ivar,
                                    npixstep=self.npixstep[i], plate=plate,
-                                   mjd=mjd, fiberid=fiberid[0],
-                                   chi2file=self.chi2file )
+                                   mjd=mjd, fiberid=fiberid,
+                                   chi2file=self.chi2file,
+                                   refine=self.refine, prune=self.prune )
+                zfindobjs[i].close_pool()
                 zfitobjs.append( zfitter.ZFitter(zfindobjs[i].zchi2arr,
-                                                 zfindobjs[i].zbase) )
+                                                 zfindobjs[i].zbase,
+                                                 zfindobjs[i].zchi2argmin) )
                 zfitobjs[i].z_refine2()
 
         # Flags
@@ -269,7 +311,7 @@ class ZFind:
                     output = io2.WriteRedmonster(zpick, clobber=True)
 
         if output:
-            if len(zpick.fiberid) == 1: output.write_fiber()
+            if len(zpick.fiberid) == 1: output.write_store()
             else: output.write_plate()
 
 
@@ -287,12 +329,21 @@ class ZFind:
                                                       npoly=self.npoly[i],
                                                       zmin=self.zmin[i],
                                                       zmax=self.zmax[i],
-                                                      nproc=self.nproc) )
+                                                      nproc=self.nproc,
+                                                      reduce=self.reduce,
+                                                      rank=self.rank,
+                                                      rank_tol=self.rank_tol,
+                                                      backend=self.backend,
+                                                      chi2encoding=
+                                                      self.chi2encoding) )
                     zfindobjs[i].zchi2(specs.flux, specs.loglambda, specs.ivar,
                                        npixstep=self.npixstep[i],
-                                       chi2file=self.chi2file)
+                                       chi2file=self.chi2file,
+                                       refine=self.refine, prune=self.prune)
+                    zfindobjs[i].close_pool()
                     zfitobjs.append( zfitter.ZFitter(zfindobjs[i].zchi2arr,
-                                                     zfindobjs[i].zbase) )
+                                                     zfindobjs[i].zbase,
+                                                     zfindobjs[i].zchi2argmin) )
                     zfitobjs[i].z_refine2()
             else:
                 for i in range(len(self.templates)):
@@ -300,12 +351,21 @@ class ZFind:
                                                       group=self.group[i],
                                                       npoly=self.npoly[i],
                                                       npixstep=self.npixstep[i],
-                                                      nproc=self.nproc) )
+                                                      nproc=self.nproc,
+                                                      reduce=self.reduce,
+                                                      rank=self.rank,
+                                                      rank_tol=self.rank_tol,
+                                                      backend=self.backend,
+                                                      chi2encoding=
+                                                      self.chi2encoding) )
                     zfindobjs[i].zchi2( specs.flux, specs.loglambda, specs.ivar,
                                        npixstep=self.npixstep[i],
-                                       chi2file=self.chi2file )
+                                       chi2file=self.chi2file,
+                                       refine=self.refine, prune=self.prune )
+                    zfindobjs[i].close_pool()
                     zfitobjs.append( zfitter.ZFitter(zfindobjs[i].zchi2arr,
-                                                     zfindobjs[i].zbase) )
+                                                     zfindobjs[i].zbase,
+                                                     zfindobjs[i].zchi2argmin) )
                     zfitobjs[i].z_refine2()
                                                                                            
             # Flags
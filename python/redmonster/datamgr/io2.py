@@ -8,18 +8,20 @@
 
 import re
 from os import environ, makedirs, getcwd, remove
-from os.path import exists, join, basename, splitext
+from os.path import exists, join, basename, splitext, dirname, isdir
 from time import gmtime, strftime
+from multiprocessing import Pool, cpu_count
 
 import numpy as n
 from astropy.io import fits
 from glob import iglob
 
 from redmonster._version import __version__
+from redmonster.datamgr.platestore import PlateStore
 
 
 
-def read_ndArch(fname):
+def read_ndArch(fname, read_data=True):
     """
         Read in an ndArch archetype file, parsing parameter baselines.
         (See ndArch data model document for file details.)
@@ -32,7 +34,8 @@ def read_ndArch(fname):
         where
         
         data is an array containing archetype templates with
-        shape (N_0, N_1,...,N_(npar-1),N_wave)
+        shape (N_0, N_1,...,N_(npar-1),N_wave), or None if read_data
+        is False (only the header is read in that case)
         
         baselines is a list containing the parameter baseline
         vectors along each of the parameter axes as numpy arrays
@@ -61,10 +64,16 @@ def read_ndArch(fname):
     fn_CLASS = fn_ROOT.split('-')[-2]
     fn_VERSION = fn_ROOT.split('-')[-1]
     # Get the data and header:
-    data = fits.getdata(fname).copy()
     header = fits.getheader(fname)
+    if read_data:
+        data = fits.getdata(fname).copy()
+        shape = data.shape
+    else:
+        data = None
+        shape = tuple([header['NAXIS%d' % i] for i in
+                       range(header['NAXIS'], 0, -1)])
     # Identify how many parameters:
-    npars = len(data.shape) - 1
+    npars = len(shape) - 1
     emptyparlist = ['']
     # Initialize output info dictionary:
     infodict = {'filename': fname.split('/')[-1],
@@ -79,7 +88,7 @@ def read_ndArch(fname):
         'par_axistype': ['index']*npars}
     if ('BUNIT' in header): infodict['fluxunit'] = header['BUNIT']
     # Initialize list of baselines with index defaults:
-    baselines = [n.arange(this_size)+1 for this_size in data.shape[:-1]]
+    baselines = [n.arange(this_size)+1 for this_size in shape[:-1]]
     # Loop over parameters and construct baselines:
     for ipar in range(npars):
         # Translate Python axis index integer to FITS axis index string:
@@ -93,17 +102,17 @@ def read_ndArch(fname):
         # all of these, but makes for nicer code:
         is_regular = (('CRPIX'+ax in header) and ('CRVAL'+ax in header) and
                       ('CDELT'+ax in header))
-        pv_base = ['PV'+ax+'_'+str(j+1) for j in range(data.shape[ipar])]
+        pv_base = ['PV'+ax+'_'+str(j+1) for j in range(shape[ipar])]
         pv_test = n.asarray([this_pv in header for this_pv in pv_base])
         is_irregular = pv_test.prod() > 0
-        ps_base = ['PS'+ax+'_'+str(j+1) for j in range(data.shape[ipar])]
+        ps_base = ['PS'+ax+'_'+str(j+1) for j in range(shape[ipar])]
         ps_test = n.asarray([this_ps in header for this_ps in ps_base])
         is_labeled = ps_test.prod() > 0
-        n_base = ['N'+ax+'_'+str(j+1) for j in range(data.shape[ipar])]
+        n_base = ['N'+ax+'_'+str(j+1) for j in range(shape[ipar])]
         n_test = n.asarray([this_n in header for this_n in n_base])
         is_named = n_test.prod() > 0
         if is_regular:
-            baselines[ipar] = ((n.arange(data.shape[ipar]) + 1 -
+            baselines[ipar] = ((n.arange(shape[ipar]) + 1 -
                                 header['CRPIX'+ax]) * header['CDELT'+ax] +
                                header['CRVAL'+ax])
             infodict['par_axistype'][ipar] = 'regular'
@@ -300,6 +309,10 @@ class WriteRedmonster:
                     ('NZ', len(self.zpick.z[0]),'Number of redshifts retained'),
                     ('RCHI2TH',self.zpick.rchi2threshold,
                      'Reduced chi**2 threshold used')])
+        if hasattr(self.zpick, 'nfft'):
+            for i, nfft in enumerate(self.zpick.nfft):
+                hdr.extend([('NFFT%d' % (i+1), nfft,
+                             'FFT length, class %d (0: direct sum)' % (i+1))])
         prihdu = fits.PrimaryHDU(header=hdr)
         # Columns for 1st BIN table
         colslist = []
@@ -456,6 +469,22 @@ class WriteRedmonster:
                                  (self.zpick.plate, self.zpick.mjd,
                                   self.zpick.fiberid[0])))
 
+    def write_store(self):
+        # Append each fiber to the plate store in self.dest (or the current
+        # directory), to be merged into a plate file by
+        # MergeRedmonster.merge_fibers2 or PlateStore.finalize.  Without
+        # clobber, fibers already in the store are kept.
+        self.create_hdulist()
+        store = PlateStore(self.zpick.plate, self.zpick.mjd, self.dest)
+        tbdata = self.thdulist[1].data
+        for i, fiberid in enumerate(self.zpick.fiberid):
+            row = [(col.name, col.format, tbdata[col.name][i]) for col in
+                   tbdata.columns]
+            if store.append(fiberid, row, self.zpick.models[i],
+                            self.thdulist[0].header, clobber=self.clobber):
+                print('Writing redmonster results for fiber %s to %s' %
+                      (fiberid, store.path))
+
     def write_plate(self):
         self.create_hdulist()
         if self.clobber:
@@ -535,6 +564,97 @@ instantiate with no plate, mjd and call methond merge_plates()
 # t.hutchinson@utah.edu
 
 
+# Helpers of MergeRedmonster: redmonster files are merged by reading the
+# headers of all files (table_layout) to preallocate the merged table
+# (merge_alloc), then their table columns (read_columns), read as raw
+# records, straight into it, both in a process pool (merge_map).
+
+_tform_dtypes = {'B': 'u1', 'I': '>i2', 'J': '>i4', 'K': '>i8',
+                 'E': '>f4', 'D': '>f8'}
+
+
+def tform_dtype(fmt):
+    # numpy dtype of FITS table column format fmt, as (dtype, shape)
+    repeat, code = re.match(r'(\d*)([A-Z])', fmt).groups()
+    repeat = int(repeat) if repeat else 1
+    if code == 'A': return 'S%d' % repeat, ()
+    return _tform_dtypes[code], (() if repeat == 1 else (repeat,))
+
+
+def merge_map(func, items, nproc=None):
+    # Yield func(item) for items in order, computed in a pool of nproc
+    # processes (all cpus if None)
+    if nproc is None: nproc = cpu_count()
+    if nproc <= 1 or len(items) <= 1:
+        for item in items: yield func(item)
+    else:
+        pool = Pool(min(nproc, len(items)))
+        try:
+            for result in pool.imap(func, items,
+                                    max(1, len(items) // (4*nproc))):
+                yield result
+        finally:
+            pool.terminate()
+
+
+def table_layout(path):
+    # (nrows, tforms, shape, offset) of redmonster file path, from its
+    # headers: number of rows and list of (name, TFORM) of its table, shape
+    # of its models (None if it has none) and file offset of the table data
+    with fits.open(path, memmap=True) as hdus:
+        hdr = hdus[1].header
+        tforms = [(hdr['TTYPE%d' % (i+1)], hdr['TFORM%d' % (i+1)]) for i in
+                  range(hdr['TFIELDS'])]
+        shape = hdus[2].shape if len(hdus) > 2 else None
+        return hdr['NAXIS2'], tforms, shape, hdus[1].fileinfo()['datLoc']
+
+
+def merge_alloc(layouts, columns=None, formats={}):
+    # Zeroed record array holding the tables of all table_layout()s
+    # layouts, and the offsets of each table in it.  columns is the list of
+    # (name, source column) of the merged table (all source columns if
+    # None); columns whose source no table has get their TFORM from
+    # formats, or are left out if formats has none.  String columns are as
+    # wide as the widest of all tables.
+    dtypes = {}
+    for nrows, tforms, shape, offset in layouts:
+        for name, fmt in tforms:
+            dtype, dshape = tform_dtype(fmt)
+            if name in dtypes and dtype[0] == 'S' == dtypes[name][0][0]:
+                dtype = 'S%d' % max(int(dtype[1:]), int(dtypes[name][0][1:]))
+            dtypes[name] = (dtype, dshape)
+    if columns is None:
+        columns = []
+        for nrows, tforms, shape, offset in layouts:
+            columns += [(name, name) for name, fmt in tforms
+                        if (name, name) not in columns]
+    dtype = []
+    for name, src in columns:
+        if src in dtypes: dtype.append( (name,) + dtypes[src] )
+        elif name in formats:
+            dtype.append( (name,) + tform_dtype(formats[name]) )
+    offsets = n.cumsum([0] + [layout[0] for layout in layouts])
+    return n.zeros(offsets[-1], dtype=dtype).view(n.recarray), offsets
+
+
+def read_columns(args):
+    # Pool task: (columns, models) of redmonster file path for args =
+    # (path, layout, names, models), layout its table_layout(): columns is
+    # the dict of the table columns in names, models the model array if
+    # models is True, else None
+    path, (nrows, tforms, shape, offset), names, models = args
+    dtype = [(name,) + tform_dtype(fmt) for name, fmt in tforms]
+    data = n.fromfile(path, dtype=dtype, count=nrows, offset=offset)
+    columns = dict([(name, data[name]) for name in names if name in
+                    data.dtype.names])
+    if models:
+        with fits.open(path, memmap=True) as hdus:
+            models = n.array(hdus[2].data)
+    else:
+        models = None
+    return columns, models
+
+
 class MergeRedmonster:
     
     def __init__(self, plate=None, mjd=None, temp=None):
@@ -732,533 +852,192 @@ class MergeRedmonster:
                                       run2d), clobber=True)
 
 
-    def merge_fibers2(self):
+    def merge_fibers2(self, nproc=None):
+        # Merge the fibers of plate self.plate, mjd self.mjd from its plate
+        # store (see PlateStore) or, failing that, from its
+        # redmonster-PLATE-MJD-FIBER.fits files, read in a pool of nproc processes (all cpus if None)
         self.filepaths = []
         self.fiberid = []
-        self.dof = []
-        self.boss_target1 = []
-        self.eboss_target0 = []
-        self.eboss_target1 = []
-        self.z1 = []
-        self.z_err1 = []
-        self.class1 = []
-        self.subclass1 = []
-        self.fname1 = []
-        self.group1 = []
-        self.minvector1 = []
-        self.minrchi21 = []
-        self.npoly1 = []
-        self.npixstep1 = []
-        self.theta1 = []
-        self.z2 = []
-        self.z_err2 = []
-        self.class2 = []
-        self.subclass2 = []
-        self.fname2 = []
-        self.group2 = []
-        self.minvector2 = []
-        self.minrchi22 = []
-        self.npoly2 = []
-        self.npixstep2 = []
-        self.theta2 = []
-        self.z3 = []
-        self.z_err3 = []
-        self.class3 = []
-        self.subclass3 = []
-        self.fname3 = []
-        self.group3 = []
-        self.minvector3 = []
-        self.minrchi23 = []
-        self.npoly3 = []
-        self.npixstep3 = []
-        self.theta3 = []
-        self.z4 = []
-        self.z_err4 = []
-        self.class4 = []
-        self.subclass4 = []
-        self.fname4 = []
-        self.group4 = []
-        self.minvector4 = []
-        self.minrchi24 = []
-        self.npoly4 = []
-        self.npixstep4 = []
-        self.theta4 = []
-        self.z5 = []
-        self.z_err5 = []
-        self.class5 = []
-        self.subclass5 = []
-        self.fname5 = []
-        self.group5 = []
-        self.minvector5 = []
-        self.minrchi25 = []
-        self.npoly5 = []
-        self.npixstep5 = []
-        self.theta5 = []
-        self.zwarning = []
-        self.rchi2diff = []
-        self.chi2_null = []
-        self.sn2_data = []
+        self.models = None
+        self.hdr = None
+        # Fibers dropped from the plate store (bad records only), to be
+        # rerun (the fillin scripts requeue them) and merged again
+        self.missing = []
         try:
             topdir = environ['REDMONSTER_SPECTRO_REDUX']
-        except KeyError:
+        except KeyError as e:
             topdir = None
             print("Environmental variable 'REDMONSTER_SPECTRO_REDUX' is \
             not set: %r" % e)
         try:
             run2d = environ['RUN2D']
-        except KeyError:
+        except KeyError as e:
             run2d = None
             print("Environmental variable 'RUN2D' is not set: %r" % e)
         try:
             run1d = environ['RUN1D']
-        except KeyError:
+        except KeyError as e:
             run1d = None
             print("Environmental variable 'RUN1D' is not set: %r" % e)
         fiberdir = join(topdir, run2d, '%s' % __version__.replace('.', '_'), '%s' % self.plate,
                         'redmonster-%s-%s-*.fits' % (self.plate, self.mjd)) if \
                                topdir and run2d and run1d else None
         
+        # Fibers written to a plate store are merged in a single pass,
+        # after adding any fiber files of fibers missing from the store
+        if fiberdir:
+            store = PlateStore(self.plate, self.mjd, dirname(fiberdir))
+            if store.exists():
+                fibers = store.fibers()
+                for path in iglob(fiberdir):
+                    fiberfile = splitext(basename(path))[0]
+                    fiberid = int(fiberfile.split('-')[3])
+                    if fiberid in fibers: continue
+                    with fits.open(path) as hdul:
+                        tbdata = hdul[1].data
+                        row = [(col.name, col.format, tbdata[col.name][0])
+                               for col in tbdata.columns]
+                        store.append(fiberid, row, hdul[2].data[0],
+                                     hdul[0].header)
+                    fibers.add(fiberid)
+                store.finalize()
+                self.missing = store.lost
+                if self.missing or store.nbad:
+                    print('WARNING: Plate %s mjd %s merged without fibers %s (%d bad records in %s): rerun them and merge again' % (self.plate, self.mjd, ', '.join(map(str, self.missing)) or 'unknown', store.nbad, store.path))
+                return
+
         if fiberdir:
+            paths = []
             for path in iglob(fiberdir):
-                self.filepaths.append( path )
-                fiberfile = basename( path )
-                self.fiberid.append( int(fiberfile[22:25])+1 )
-            try:
-                
-                self.hdr = fits.open( join( environ['BOSS_SPECTRO_REDUX'], environ['RUN2D'], '%s' % self.plate, 'spPlate-%s-%s.fits' % (self.plate,self.mjd) ) )[0].header
-                
-                #self.hdr = fits.open('/uufs/chpc.utah.edu/common/home/sdss00/ebosswork/eboss/spectro/redux/test/bautista/test_dr14/%s/spPlate-%s-%s.fits' % (self.plate, self.plate, self.mjd))[0].header
-            except AttributeError:
-                self.hdr = fits.Header()
-            
-            
-            npix = fits.open( join( environ['BOSS_SPECTRO_REDUX'],environ['RUN2D'], '%s' % self.plate,'spPlate-%s-%s.fits' %(self.plate,self.mjd) ) )[0].data.shape[1]
-            
-            #npix = fits.open('/uufs/chpc.utah.edu/common/home/sdss00/ebosswork/eboss/spectro/redux/test/bautista/test_dr14/%s/spPlate-%s-%s.fits' % (self.plate, self.plate, self.mjd))[0].data.shape[1]
-            self.models = n.zeros( (len(self.fiberid),5,npix) )
-            self.filepaths.sort()
-            self.fiberid.sort()
-            haveHeader = False
-            for i, path in enumerate(self.filepaths):
-                hdu = fits.open(path)
-                if not haveHeader:
-                    self.hdr = hdu[0].header
-                    haveHeader = True
-                self.dof.append(hdu[1].data.DOF[0])
-                self.z1.append(hdu[1].data.Z1[0])
-                self.z_err1.append(hdu[1].data.Z_ERR1[0])
-                self.class1.append(hdu[1].data.CLASS1[0])
-                self.subclass1.append(hdu[1].data.SUBCLASS1[0])
-                self.fname1.append(hdu[1].data.FNAME1[0])
-                self.group1.append(hdu[1].data.GROUP1[0])
-                self.minvector1.append(hdu[1].data.MINVECTOR1[0])
-                self.minrchi21.append(hdu[1].data.MINRCHI21[0])
-                self.npoly1.append(hdu[1].data.NPOLY1[0])
-                self.npixstep1.append(hdu[1].data.NPIXSTEP1[0])
-                self.theta1.append(hdu[1].data.THETA1[0])
-                self.z2.append(hdu[1].data.Z2[0])
-                self.z_err2.append(hdu[1].data.Z_ERR2[0])
-                self.class2.append(hdu[1].data.CLASS2[0])
-                self.subclass2.append(hdu[1].data.SUBCLASS2[0])
-                self.fname2.append(hdu[1].data.FNAME2[0])
-                self.group2.append(hdu[1].data.GROUP2[0])
-                self.minvector2.append(hdu[1].data.MINVECTOR2[0])
-                self.minrchi22.append(hdu[1].data.MINRCHI22[0])
-                self.npoly2.append(hdu[1].data.NPOLY2[0])
-                self.npixstep2.append(hdu[1].data.NPIXSTEP2[0])
-                self.theta2.append(hdu[1].data.THETA2[0])
-                self.z3.append(hdu[1].data.Z3[0])
-                self.z_err3.append(hdu[1].data.Z_ERR3[0])
-                self.class3.append(hdu[1].data.CLASS3[0])
-                self.subclass3.append(hdu[1].data.SUBCLASS3[0])
-                self.fname3.append(hdu[1].data.FNAME3[0])
-                self.group3.append(hdu[1].data.GROUP3[0])
-                self.minvector3.append(hdu[1].data.MINVECTOR3[0])
-                self.minrchi23.append(hdu[1].data.MINRCHI23[0])
-                self.npoly3.append(hdu[1].data.NPOLY3[0])
-                self.npixstep3.append(hdu[1].data.NPIXSTEP3[0])
-                self.theta3.append(hdu[1].data.THETA3[0])
-                self.z4.append(hdu[1].data.Z4[0])
-                self.z_err4.append(hdu[1].data.Z_ERR4[0])
-                self.class4.append(hdu[1].data.CLASS4[0])
-                self.subclass4.append(hdu[1].data.SUBCLASS4[0])
-                self.fname4.append(hdu[1].data.FNAME4[0])
-                self.group4.append(hdu[1].data.GROUP4[0])
-                self.minvector4.append(hdu[1].data.MINVECTOR4[0])
-                self.minrchi24.append(hdu[1].data.MINRCHI24[0])
-                self.npoly4.append(hdu[1].data.NPOLY4[0])
-                self.npixstep4.append(hdu[1].data.NPIXSTEP4[0])
-                self.theta4.append(hdu[1].data.THETA4[0])
-                self.z5.append(hdu[1].data.Z5[0])
-                self.z_err5.append(hdu[1].data.Z_ERR5[0])
-                self.class5.append(hdu[1].data.CLASS5[0])
-                self.subclass5.append(hdu[1].data.SUBCLASS5[0])
-                self.fname5.append(hdu[1].data.FNAME5[0])
-                self.group5.append(hdu[1].data.GROUP5[0])
-                self.minvector5.append(hdu[1].data.MINVECTOR5[0])
-                self.minrchi25.append(hdu[1].data.MINRCHI25[0])
-                self.npoly5.append(hdu[1].data.NPOLY5[0])
-                self.npixstep5.append(hdu[1].data.NPIXSTEP5[0])
-                self.theta5.append(hdu[1].data.THETA5[0])
-                self.zwarning.append(hdu[1].data.ZWARNING[0])
-                self.rchi2diff.append(hdu[1].data.RCHI2DIFF[0])
-                self.chi2_null.append(hdu[1].data.CHI2NULL[0])
-                self.sn2_data.append(hdu[1].data.SN2DATA[0])
-                try:
-                    self.boss_target1.append(hdu[1].data.BOSS_TARGET1[0])
-                except (NameError, AttributeError):
-                    pass
-                try:
-                    self.eboss_target0.append(hdu[1].data.EBOSS_TARGET0[0])
-                except (NameError, AttributeError):
-                    pass
-                try:
-                    self.eboss_target1.append(hdu[1].data.EBOSS_TARGET1[0])
-                except (NameError, AttributeError):
-                    pass
-                self.models[i] = hdu[2].data[0]
+                fiberfile = splitext(basename(path))[0]
+                paths.append( (int(fiberfile.split('-')[3]) + 1, path) )
+            if not paths: return
+            paths.sort()
+            self.fiberid = [fiberid for fiberid, path in paths]
+            self.filepaths = [path for fiberid, path in paths]
+            layouts = list(merge_map(table_layout, self.filepaths, nproc))
+            # Columns of the fiber files, with all target columns after DOF
+            targets = ['BOSS_TARGET1', 'EBOSS_TARGET0', 'EBOSS_TARGET1']
+            names = []
+            for layout in layouts:
+                names += [name for name, fmt in layout[1] if name not in
+                          names + targets]
+            columns = [(name, name) for name in names[:2] + targets +
+                       names[2:]]
+            data, offsets = merge_alloc(layouts, columns,
+                                        dict([(name, 'J') for name in
+                                              targets]))
+            self.hdr = fits.getheader(self.filepaths[0])
+            self.models = n.zeros( (len(self.fiberid),) +
+                                  tuple(layouts[0][2][1:]) )
+            tasks = [(path, layout, data.dtype.names, True) for path, layout
+                     in zip(self.filepaths, layouts)]
+            for i, (columns, models) in \
+                    enumerate(merge_map(read_columns, tasks, nproc)):
+                for name in columns:
+                    data[name][offsets[i]:offsets[i+1]] = columns[name]
+                self.models[i] = models[0]
                 #remove(path)
+            data['FIBERID'] = self.fiberid
             self.hdr['NFIBERS'] = len(self.fiberid)
             prihdu = fits.PrimaryHDU(header=self.hdr)
-            colslist = []
-            colslist.append( fits.Column(name='FIBERID', format='J',
-                                         array=self.fiberid) )
-            colslist.append( fits.Column(name='DOF', format='J',
-                                         array=self.dof) )
-            try: colslist.append( fits.Column(name='BOSS_TARGET1', format='J',
-                                              array=self.boss_target1) )
-            except (NameError, AttributeError): pass
-            try: colslist.append( fits.Column(name='EBOSS_TARGET0', format='J',
-                                              array=self.eboss_target0) )
-            except (NameError, AttributeError): pass
-            try: colslist.append( fits.Column(name='EBOSS_TARGET1', format='J',
-                                              array=self.eboss_target1) )
-            except (NameError, AttributeError): pass
-            colslist.append( fits.Column(name='Z1', format='E', array=self.z1) )
-            colslist.append( fits.Column(name='Z_ERR1', format='E',
-                                         array=self.z_err1) )
-            colslist.append( fits.Column(name='CLASS1', format='%iA' %
-                                         max(list(map(len,self.class1))),
-                                         array=self.class1) )
-            colslist.append( fits.Column(name='SUBCLASS1', format='%iA' %
-                                         max(list(map(len,self.subclass1))),
-                                         array=self.subclass1) )
-            colslist.append( fits.Column(name='FNAME1', format='%iA' %
-                                         max(list(map(len,self.fname1))),
-                                         array=self.fname1) )
-            colslist.append( fits.Column(name='GROUP1', format='J',
-                                         array=self.group1) )
-            colslist.append( fits.Column(name='MINVECTOR1', format='%iA' %
-                                         max(list(map(len,self.minvector1))),
-                                         array=self.minvector1) )
-            colslist.append( fits.Column(name='MINRCHI21', format='E',
-                                         array=self.minrchi21) )
-            colslist.append( fits.Column(name='NPOLY1', format='J',
-                                         array=self.npoly1) )
-            colslist.append( fits.Column(name='NPIXSTEP1', format='J',
-                                         array=self.npixstep1) )
-            colslist.append( fits.Column(name='THETA1', format='%iA' %
-                                         max(list(map(len,self.theta1))),
-                                         array=self.theta1) )
-            colslist.append( fits.Column(name='Z2', format='E', array=self.z2) )
-            colslist.append( fits.Column(name='Z_ERR2', format='E',
-                                         array=self.z_err2) )
-            colslist.append( fits.Column(name='CLASS2', format='%iA' %
-                                         max(list(map(len,self.class2))),
-                                         array=self.class2) )
-            colslist.append( fits.Column(name='SUBCLASS2', format='%iA' %
-                                         max(list(map(len,self.subclass2))),
-                                         array=self.subclass2) )
-            colslist.append( fits.Column(name='FNAME2', format='%iA' %
-                                         max(list(map(len,self.fname2))),
-                                         array=self.fname2) )
-            colslist.append( fits.Column(name='GROUP2', format='J',
-                                         array=self.group2) )
-            colslist.append( fits.Column(name='MINVECTOR2', format='%iA' %
-                                         max(list(map(len,self.minvector2))),
-                                         array=self.minvector2) )
-            colslist.append( fits.Column(name='MINRCHI22', format='E',
-                                         array=self.minrchi22) )
-            colslist.append( fits.Column(name='NPOLY2', format='J',
-                                         array=self.npoly2) )
-            colslist.append( fits.Column(name='NPIXSTEP2', format='J',
-                                         array=self.npixstep2) )
-            colslist.append( fits.Column(name='THETA2', format='%iA' %
-                                         max(list(map(len,self.theta2))),
-                                         array=self.theta2) )
-            colslist.append( fits.Column(name='Z3', format='E', array=self.z3) )
-            colslist.append( fits.Column(name='Z_ERR3', format='E',
-                                         array=self.z_err3) )
-            colslist.append( fits.Column(name='CLASS3', format='%iA' %
-                                         max(list(map(len,self.class3))),
-                                         array=self.class3) )
-            colslist.append( fits.Column(name='SUBCLASS3', format='%iA' %
-                                         max(list(map(len,self.subclass3))),
-                                         array=self.subclass3) )
-            colslist.append( fits.Column(name='FNAME3', format='%iA' %
-                                         max(list(map(len,self.fname3))),
-                                         array=self.fname3) )
-            colslist.append( fits.Column(name='GROUP3', format='J',
-                                         array=self.group3) )
-            colslist.append( fits.Column(name='MINVECTOR3', format='%iA' %
-                                         max(list(map(len,self.minvector3))),
-                                         array=self.minvector3) )
-            colslist.append( fits.Column(name='MINRCHI23', format='E',
-                                         array=self.minrchi23) )
-            colslist.append( fits.Column(name='NPOLY3', format='J',
-                                         array=self.npoly3) )
-            colslist.append( fits.Column(name='NPIXSTEP3', format='J',
-                                         array=self.npixstep3) )
-            colslist.append( fits.Column(name='THETA3', format='%iA' %
-                                         max(list(map(len,self.theta3))),
-                                         array=self.theta3) )
-            colslist.append( fits.Column(name='Z4', format='E', array=self.z4) )
-            colslist.append( fits.Column(name='Z_ERR4', format='E',
-                                         array=self.z_err4) )
-            colslist.append( fits.Column(name='CLASS4', format='%iA' %
-                                         max(list(map(len,self.class4))),
-                                         array=self.class4) )
-            colslist.append( fits.Column(name='SUBCLASS4', format='%iA' %
-                                         max(list(map(len,self.subclass4))),
-                                         array=self.subclass4) )
-            colslist.append( fits.Column(name='FNAME4', format='%iA' %
-                                         max(list(map(len,self.fname4))),
-                                         array=self.fname4) )
-            colslist.append( fits.Column(name='GROUP4', format='J',
-                                         array=self.group4) )
-            colslist.append( fits.Column(name='MINVECTOR4', format='%iA' %
-                                         max(list(map(len,self.minvector4))),
-                                         array=self.minvector4) )
-            colslist.append( fits.Column(name='MINRCHI24', format='E',
-                                         array=self.minrchi24) )
-            colslist.append( fits.Column(name='NPOLY4', format='J',
-                                         array=self.npoly4) )
-            colslist.append( fits.Column(name='NPIXSTEP4', format='J',
-                                         array=self.npixstep4) )
-            colslist.append( fits.Column(name='THETA4', format='%iA' %
-                                         max(list(map(len,self.theta4))),
-                                         array=self.theta4) )
-            colslist.append( fits.Column(name='Z5', format='E', array=self.z5) )
-            colslist.append( fits.Column(name='Z_ERR5', format='E',
-                                         array=self.z_err5) )
-            colslist.append( fits.Column(name='CLASS5', format='%iA' %
-                                         max(list(map(len,self.class5))),
-                                         array=self.class5) )
-            colslist.append( fits.Column(name='SUBCLASS5', format='%iA' %
-                                         max(list(map(len,self.subclass5))),
-                                         array=self.subclass5) )
-            colslist.append( fits.Column(name='FNAME5', format='%iA' %
-                                         max(list(map(len,self.fname5))),
-                                         array=self.fname5) )
-            colslist.append( fits.Column(name='GROUP5', format='J',
-                                         array=self.group5) )
-            colslist.append( fits.Column(name='MINVECTOR5', format='%iA' %
-                                         max(list(map(len,self.minvector5))),
-                                         array=self.minvector5) )
-            colslist.append( fits.Column(name='MINRCHI25', format='E',
-                                         array=self.minrchi25) )
-            colslist.append( fits.Column(name='NPOLY5', format='J',
-                                         array=self.npoly5) )
-            colslist.append( fits.Column(name='NPIXSTEP5', format='J',
-                                         array=self.npixstep5) )
-            colslist.append( fits.Column(name='THETA5', format='%iA' %
-                                         max(list(map(len,self.theta5))),
-                                         array=self.theta5) )
-            colslist.append( fits.Column(name='ZWARNING', format='J',
-                                         array=self.zwarning) )
-            colslist.append( fits.Column(name='RCHI2DIFF', format='E',
-                                         array=self.rchi2diff) )
-            colslist.append( fits.Column(name='CHI2NULL', format='E',
-                                         array=self.chi2_null) )
-            colslist.append( fits.Column(name='SN2DATA', format='E',
-                                         array=self.sn2_data) )
-            cols = fits.ColDefs(colslist)
-            tbhdu = fits.BinTableHDU.from_columns(cols)
+            tbhdu = fits.BinTableHDU(data=data)
             # ImageHDU of models
             sechdu = fits.ImageHDU(data=self.models)
             thdulist = fits.HDUList([prihdu, tbhdu, sechdu])
             
             dest = join(topdir, run2d, '%s' % __version__.replace('.', '_'), '%s' % self.plate,
                         'redmonster-%s-%s.fits' % (self.plate, self.mjd))
-            thdulist.writeto( dest, clobber=True )
+            thdulist.writeto( dest, overwrite=True )
 
-    def merge_plates2(self):
-        self.platelist = []
-        self.mjdlist = []
-        self.fiberid = []
-        self.dof = []
-        self.boss_target1 = []
-        self.eboss_target0 = []
-        self.eboss_target1 = []
-        self.z = []
-        self.z_err = []
-        self.type = []
-        self.subtype = []
-        self.fname = []
-        self.minvector = []
-        self.minrchi2 = []
-        self.npoly = []
-        self.npixstep = []
-        self.theta = []
-        self.zwarning = []
-        self.rchi2diff = []
-        self.chi2_null = []
-        self.sn2_data = []
-        self.plates = []
+    def merge_plates2(self, nproc=None):
+        # Merge the first (best) redshift of every fiber of every
+        # redmonster-PLATE-MJD.fits file into redmonsterAll-RUN1D.fits,
+        # reading the plate tables in a pool of nproc processes (all cpus
+        # if None) into one preallocated table
         self.hdr = fits.Header()
+        self.plates = []
+        self.filepaths = []
         try:
             topdir = environ['REDMONSTER_SPECTRO_REDUX']
-        except KeyError:
+        except KeyError as e:
             topdir = None
             print("Environmental variable 'REDMONSTER_SPECTRO_REDUX' is not \
             set: %r" % e)
         try:
             rmver = environ['REDMONSTER_VER']
-        except KeyError:
+        except KeyError as e:
             rmver = None
             print("Environmental variable 'REDMONSTER_VER' is not set: %r" % e)
         try:
             run2d = environ['RUN2D']
-        except KeyError:
+        except KeyError as e:
             run2d = None
             print("Environmental variable 'RUN2D' is not set: %r" % e)
         try:
             run1d = environ['RUN1D']
-        except KeyError:
+        except KeyError as e:
             run1d = None
             print("Environmental variable 'RUN1D' is not set: %r" % e)
         platedir = join( topdir, run2d, rmver, '*') if topdir and run2d else None
         if platedir:
-            for path in iglob(platedir):
-                self.plates.append( basename(path) )
-            self.plates.sort()
-            for listitem in self.plates:
-                # Ignore any existing redmonsterAll files
-                if listitem[-5:] == '.fits': self.plates.remove(listitem)
+            # Ignore any existing redmonsterAll files
+            self.plates = sorted([basename(path) for path in iglob(platedir)
+                                  if isdir(path)])
+            platemjds = []
             for plate in self.plates:
-                print('Merging plate %s' % plate)
-                mjds = []
-                try:
-                    for x in iglob( join( topdir, run2d, rmver, '%s' % plate,
-                                         'redmonster-%s-*.fits' % plate) ):
-                        if basename(x)[16:21] not in mjds:
-                            mjds.append(basename(x)[16:21])
-                except Exception as e:
-                    mjds = None
-                    print("Exception: %r" % e)
-                if mjds is not [] and mjds is not None:
-                    for mjd in mjds:
-                        filepath = join( topdir, run2d, rmver, '%s' % plate,
-                                        'redmonster-%s-%s.fits' % (plate, mjd))
-                        if exists(filepath):
-                            hdu = fits.open(filepath)
-                            self.fiberid += hdu[1].data.FIBERID.tolist()
-                            self.platelist += [int(plate)] * \
-                                    len(hdu[1].data.FIBERID.tolist())
-                            self.mjdlist += [int(mjd)] * \
-                                    len(hdu[1].data.FIBERID.tolist())
-                            self.dof += hdu[1].data.DOF.tolist()
-                            try: self.boss_target1 += \
-                                        hdu[1].data.BOSS_TARGET1.tolist()
-                            except (NameError, AttributeError):
-                                pass
-                            try:
-                                self.eboss_target0 += \
-                                        hdu[1].data.EBOSS_TARGET0.tolist()
-                            except (NameError, AttributeError):
-                                pass
-                            try:
-                                self.eboss_target1 += \
-                                        hdu[1].data.EBOSS_TARGET1.tolist()
-                            except (NameError, AttributeError):
-                                pass
-                            self.z += hdu[1].data.Z1.tolist()
-                            self.z_err += hdu[1].data.Z_ERR1.tolist()
-                            self.type += hdu[1].data.CLASS1.tolist()
-                            self.subtype += hdu[1].data.SUBCLASS1.tolist()
-                            self.fname += hdu[1].data.FNAME1.tolist()
-                            self.minvector += hdu[1].data.MINVECTOR1.tolist()
-                            self.minrchi2 += hdu[1].data.MINRCHI21.tolist()
-                            self.npoly += hdu[1].data.NPOLY1.tolist()
-                            self.npixstep += hdu[1].data.NPIXSTEP1.tolist()
-                            self.theta += hdu[1].data.THETA1.tolist()
-                            self.zwarning += hdu[1].data.ZWARNING.tolist()
-                            self.rchi2diff += hdu[1].data.RCHI2DIFF.tolist()
-                            self.chi2_null += hdu[1].data.CHI2NULL.tolist()
-                            self.sn2_data += hdu[1].data.SN2DATA.tolist()
+                for x in iglob( join( topdir, run2d, rmver, '%s' % plate,
+                                     'redmonster-%s-*.fits' % plate) ):
+                    # Plate files only, not fibers
+                    fields = splitext(basename(x))[0].split('-')
+                    if len(fields) == 3:
+                        platemjds.append( (plate, fields[2], x) )
+            platemjds.sort()
+            self.filepaths = [path for plate, mjd, path in platemjds]
+            print('Merging %s plates' % len(self.filepaths))
+            # Columns of redmonsterAll, from the first redshift of each fiber
+            columns = [('FIBERID', 'FIBERID'), ('PLATE', None), ('MJD', None),
+                       ('DOF', 'DOF'),
+                       ('BOSS_TARGET1', 'BOSS_TARGET1'),
+                       ('EBOSS_TARGET0', 'EBOSS_TARGET0'),
+                       ('EBOSS_TARGET1', 'EBOSS_TARGET1'), ('Z', 'Z1'),
+                       ('Z_ERR', 'Z_ERR1'), ('CLASS', 'CLASS1'),
+                       ('SUBCLASS', 'SUBCLASS1'), ('FNAME', 'FNAME1'),
+                       ('MINVECTOR', 'MINVECTOR1'), ('MINRCHI2', 'MINRCHI21'),
+                       ('NPOLY', 'NPOLY1'), ('NPIXSTEP', 'NPIXSTEP1'),
+                       ('THETA', 'THETA1'), ('ZWARNING', 'ZWARNING'),
+                       ('RCHI2DIFF', 'RCHI2DIFF'), ('CHI2NULL', 'CHI2NULL'),
+                       ('SN2DATA', 'SN2DATA')]
+            layouts = list(merge_map(table_layout, self.filepaths, nproc))
+            data, offsets = merge_alloc(layouts, columns,
+                                        {'PLATE': 'J', 'MJD': 'J',
+                                         'BOSS_TARGET1': 'J',
+                                         'EBOSS_TARGET0': 'J',
+                                         'EBOSS_TARGET1': 'J'})
+            tasks = [(path, layout, [src for name, src in columns if src],
+                      False) for path, layout in zip(self.filepaths, layouts)]
+            for i, (cols, models) in \
+                    enumerate(merge_map(read_columns, tasks, nproc)):
+                rows = slice(offsets[i], offsets[i+1])
+                for name, src in columns:
+                    if src in cols: data[name][rows] = cols[src]
+                data['PLATE'][rows] = int(platemjds[i][0])
+                data['MJD'][rows] = int(platemjds[i][1])
             self.hdr.extend([
                              ('SPEC2D',environ['RUN2D'],
                               'Version of spec2d reductions used'),
                              ('VERS_RM',rmver,'Version of redmonster used'),
                              ('TIME',strftime("%Y-%m-%d_%H:%M:%S", gmtime()),
                               'Time of redmonsterAll creation'),
-                             ('NFIBERS', len(self.fiberid), 'Number of fibers'),
+                             ('NFIBERS', len(data), 'Number of fibers'),
                              ('RCHI2TH',0.005,'Reduced chi**2 threshold used')
                              ])
             prihdu = fits.PrimaryHDU(header=self.hdr)
-            colslist = []
-            colslist.append( fits.Column(name='FIBERID', format='J',
-                                         array=self.fiberid) )
-            colslist.append( fits.Column(name='PLATE', format='J',
-                                         array=self.platelist) )
-            colslist.append( fits.Column(name='MJD', format='J',
-                                         array=self.mjdlist) )
-            colslist.append( fits.Column(name='DOF', format='J',
-                                         array=self.dof) )
-            try:
-                colslist.append( fits.Column(name='BOSS_TARGET1', format='J',
-                                              array=self.boss_target1) )
-            except (NameError, AttributeError):
-                pass
-            try:
-                colslist.append( fits.Column(name='EBOSS_TARGET0', format='J',
-                                              array=self.eboss_target0) )
-            except (NameError, AttributeError):
-                pass
-            try:
-                colslist.append( fits.Column(name='EBOSS_TARGET1', format='J',
-                                             array=self.eboss_target1) )
-            except (NameError, AttributeError):
-                pass
-            colslist.append( fits.Column(name='Z', format='E', array=self.z) )
-            colslist.append( fits.Column(name='Z_ERR', format='E',
-                                         array=self.z_err) )
-            colslist.append( fits.Column(name='CLASS', format='%iA' %
-                                         max(list(map(len,self.type))),
-                                         array=self.type) )
-            colslist.append( fits.Column(name='SUBCLASS', format='%iA' %
-                                         max(list(map(len,self.subtype))),
-                                         array=self.subtype) )
-            colslist.append( fits.Column(name='FNAME', format='%iA' %
-                                         max(list(map(len,self.fname))),
-                                         array=self.fname) )
-            colslist.append( fits.Column(name='MINVECTOR', format='%iA' %
-                                         max(list(map(len,self.minvector))),
-                                         array=self.minvector) )
-            colslist.append( fits.Column(name='MINRCHI2', format='E',
-                                         array=self.minrchi2) )
-            colslist.append( fits.Column(name='NPOLY', format='J',
-                                         array=self.npoly) )
-            colslist.append( fits.Column(name='NPIXSTEP', format='J',
-                                         array=self.npixstep) )
-            colslist.append( fits.Column(name='THETA', format='%iA' %
-                                         max(list(map(len,self.theta))),
-                                         array=self.theta) )
-            colslist.append( fits.Column(name='ZWARNING', format='J',
-                                         array=self.zwarning) )
-            colslist.append( fits.Column(name='RCHI2DIFF', format='E',
-                                         array=self.rchi2diff) )
-            colslist.append( fits.Column(name='CHI2NULL', format='E',
-                                         array=self.chi2_null) )
-            colslist.append( fits.Column(name='SN2DATA', format='E',
-                                         array=self.sn2_data) )
-            
-            cols = fits.ColDefs(colslist)
-            tbhdu = fits.BinTableHDU.from_columns(cols)
+            tbhdu = fits.BinTableHDU(data=data)
             thdulist = fits.HDUList([prihdu, tbhdu])
             
             dest = join(topdir, run2d, rmver, 'redmonsterAll-%s.fits' % run1d)
-            thdulist.writeto( dest, clobber=True )
+            thdulist.writeto( dest, overwrite=True )
 
     def merge_chi2(self):
         try:
@@ -1268,14 +1047,14 @@ class MergeRedmonster:
             print("'REDMONSTER_SPECTRO_REDUX' env variable not set.")
         try:
             rmver = environ['REDMONSTER_VER']
-        except KeyError:
+        except KeyError as e:
             rmver = None
             print("Environmental variable 'REDMONSTER_VER' is not set: %r" % e)
         try:
             run2d = environ['RUN2D']
         except KeyError:
             run2d = None
-            print("'RUN1D' env variable not set.")
+            print("'RUN2D' env variable not set.")
         try:
             run1d = environ['RUN1D']
         except KeyError:
@@ -1297,7 +1076,24 @@ class MergeRedmonster:
                 if m.group(1): fiberid.append( int(m.group(1)) )
             fiberid.sort()
             paths.sort()
+            dest = join( topdir, run2d, rmver, '%s' % self.plate,
+                        'chi2arr-%s-%s-%s.fits' % (self.temp, self.plate,
+                                                   self.mjd) )
             
+            # Tile compressed fiber files make a tile compressed plate file
+            hdr = fits.getheader(paths[0]) if paths else fits.Header()
+            if 'ENCODING' in hdr:
+                chi2arrs, fiberids = [], []
+                for path in paths:
+                    chi2arr, zbase, fibers = read_chi2(path)
+                    chi2arrs.append(chi2arr)
+                    fiberids.append(fibers)
+                    remove(path)
+                write_chi2(dest, n.concatenate(chi2arrs), zbase,
+                           n.concatenate(fiberids), hdr['ENCODING'],
+                           hdr.get('QSTEP', 0.001))
+                return
+
             for i,path in enumerate(paths):
                 chi2arr = fits.open(path)[0].data
                 try:
@@ -1314,53 +1110,135 @@ class MergeRedmonster:
             cols = fits.ColDefs([col1])
             tbhdu = fits.BinTableHDU.from_columns(cols)
             thdulist = fits.HDUList([prihdu,tbhdu])
-            thdulist.writeto( join( topdir, run2d, rmver, '%s' % self.plate,
-                                   'chi2arr-%s-%s-%s.fits' %
-                                   (self.temp, self.plate, self.mjd) ),
-                             clobber=True)
+            thdulist.writeto( dest, overwrite=True )
 
 
 # ------------------------------------------------------------------------------
 
 
-def write_chi2arr(plate, mjd, fiberid, zchi2arr):
-    # Write chi**2 surface, called by zfinder
-    prihdu = fits.PrimaryHDU(zchi2arr)
-    thdulist = fits.HDUList([prihdu])
+def write_chi2arr(plate, mjd, fiberid, zchi2arr, temp=None, zbase=None,
+                  encoding=None):
+    # Write chi**2 surface, called by zfinder.  fiberid is the fiber or
+    # list of fibers of zchi2arr; the file is named after the first.  With
+    # encoding 'float32' or 'delta' the surface is written by write_chi2,
+    # otherwise as a plain float64 primary HDU
+    fibers = n.atleast_1d(fiberid)
+    dest = None
     try:
         rsr = environ['REDMONSTER_SPECTRO_REDUX']
         run2d = environ['RUN2D']
         run1d = environ['RUN1D']
-        if (rsr is not None) & (run2d is not None) & (run1d is not None):
-            testpath = join(rsr, run2d, '%s' % __version__.replace('.', '_'), '%s' % plate)
-            if exists(testpath):
+        testpath = join(rsr, run2d, '%s' % __version__.replace('.', '_'), '%s' % plate)
+        if exists(testpath):
+            dest = testpath
+        else:
+            try:
+                makedirs(testpath)
                 dest = testpath
-            else:
-                try:
-                    makedirs(testpath)
-                    dest = testpath
-                except Exception as e:
-                    print("Exception: %r" % e)
-                    dest = None
+            except Exception as e:
+                print("Exception: %r" % e)
     except Exception as e:
         print("Exception: %r" % e)
-        dest = None
-        if dest is not None:
-            try:
-                thdulist.writeto(join(dest, '%s' % 'chi2arr-%s-%s-%s-%03d.fits'
-                                      % (self.type, plate, mjd, fiberid)),
-                                 clobber=True)
-                print('Writing chi2 file to %s' % \
-                        join(dest, '%s' % 'chi2arr-%s-%s-%s-%03d.fits' %
-                             (self.type, plate, mjd, fiberid)))
-            except Exception as e:
-                print('Environment variables not set or path does not exist - \
-                        not writing chi2 file! %r' % e)
+    if dest is not None:
+        path = join(dest, 'chi2arr-%s-%s-%s-%03d.fits' % (temp, plate, mjd,
+                                                         fibers[0]))
+        try:
+            if encoding is None:
+                fits.HDUList([fits.PrimaryHDU(zchi2arr)]).writeto(
+                    path, overwrite=True)
+            else:
+                if len(fibers) != zchi2arr.shape[0]:
+                    fibers = fibers[0] + n.arange(zchi2arr.shape[0])
+                write_chi2(path, zchi2arr, zbase, fibers, encoding)
+            print('Writing chi2 file to %s' % path)
+        except Exception as e:
+            print('Environment variables not set or path does not exist - \
+                    not writing chi2 file! %r' % e)
     else:
         print('Environment variables not set or path does not exist - not \
                 writing chi2 file!')
 
 
+def write_chi2(path, zchi2arr, zbase=None, fiberid=None, encoding='float32',
+               qstep=0.001):
+    """
+    Write chi2 surfaces zchi2arr, shape (nfibers, ..., nz), to path as a
+    tile compressed image with one tile per fiber, so that read_chi2 can
+    read single fibers without decompressing the whole file, along with
+    the table FIBERS (FIBERID, CHI2MIN, the minimum chi2 of each fiber)
+    and, if given, the redshift baseline zbase as image ZBASE.
+
+    encoding is 'float32' (lossless gzip of the float32 surfaces) or
+    'delta' (chi2 - CHI2MIN of each fiber, rounded to multiples of qstep
+    and Rice compressed as 32 bit integers; deltas beyond the int32 range
+    are clipped and non-finite values are read back as inf).
+    """
+    zchi2arr = n.asarray(zchi2arr)
+    nfibers = zchi2arr.shape[0]
+    fiberid = n.arange(nfibers) if fiberid is None else n.atleast_1d(fiberid)
+    tile = (1,) + zchi2arr.shape[1:]
+    flat = n.reshape(zchi2arr, (nfibers, -1))
+    finite = n.isfinite(flat)
+    chi2min = n.min(n.where(finite, flat, n.inf), axis=1)
+    hdr = fits.Header([('ENCODING', encoding, 'chi2 encoding')])
+    if encoding == 'float32':
+        chi2hdu = fits.CompImageHDU(zchi2arr.astype(n.float32), name='CHI2',
+                                    compression_type='GZIP_2',
+                                    tile_shape=tile, quantize_level=0)
+    elif encoding == 'delta':
+        hdr['QSTEP'] = (qstep, 'chi2 quantization step')
+        delta = n.round((flat - n.where(n.isfinite(chi2min), chi2min,
+                                        0)[:,None]) / qstep)
+        delta = n.where(finite, n.clip(delta, 0, 2**31-2), 2**31-1)
+        chi2hdu = fits.CompImageHDU(n.reshape(delta.astype(n.int32),
+                                              zchi2arr.shape), name='CHI2',
+                                    compression_type='RICE_1',
+                                    tile_shape=tile)
+    else:
+        raise ValueError("Unknown chi2 encoding %r" % encoding)
+    cols = fits.ColDefs([fits.Column(name='FIBERID', format='J',
+                                     array=fiberid),
+                         fits.Column(name='CHI2MIN', format='D',
+                                     array=chi2min)])
+    hdus = [fits.PrimaryHDU(header=hdr), chi2hdu,
+            fits.BinTableHDU.from_columns(cols, name='FIBERS')]
+    if zbase is not None: hdus.append( fits.ImageHDU(zbase, name='ZBASE') )
+    fits.HDUList(hdus).writeto(path, overwrite=True)
+
+
+def read_chi2(path, fibers=None):
+    """
+    Return (zchi2arr, zbase, fiberid) from chi2 file path written by
+    write_chi2: the float64 chi2 surfaces of the rows fibers (an index or
+    list of indices; all if None) of the file, the redshift baseline
+    (None if not stored) and their FIBERIDs.  Only the tiles of the
+    requested fibers are decompressed.
+    """
+    with fits.open(path) as hdus:
+        hdr = hdus[0].header
+        table = hdus['FIBERS'].data
+        if fibers is None:
+            chi2 = hdus['CHI2'].data
+            rows = slice(None)
+        elif n.ndim(fibers) == 0:
+            chi2 = hdus['CHI2'].section[int(fibers)]
+            rows = int(fibers)
+        else:
+            chi2 = n.array([hdus['CHI2'].section[int(i)] for i in fibers])
+            rows = n.asarray(fibers, dtype=int)
+        fiberid = n.array(table['FIBERID'][rows])
+        chi2min = n.array(table['CHI2MIN'][rows])
+        zbase = n.array(hdus['ZBASE'].data) if 'ZBASE' in hdus else None
+    if hdr['ENCODING'] == 'delta':
+        chi2min = n.reshape(chi2min, n.shape(chi2min) +
+                            (1,)*(n.ndim(chi2) - n.ndim(chi2min)))
+        zchi2arr = n.where(chi2 == 2**31-1, n.inf,
+                           chi2 * hdr['QSTEP'] + chi2min)
+    else:
+        zchi2arr = n.asarray(chi2, dtype=float)
+    return zchi2arr, zbase, fiberid
+
+
 # ------------------------------------------------------------------------------
 
 # Read generic FITS file.  Data must be in (nspectra, npix) shaped image
@@ -0,0 +1,232 @@
+# Append-only store of per-fiber redmonster results for one plate.
+#
+# Runs of single fibers (zfind -f) append their results to the single file
+# redmonster-PLATE-MJD.store instead of writing one FITS file per fiber.
+# A record is a fixed size header (magic bytes, lengths and CRC-32s of the
+# row and of the models, and the fiber), the pickled table row and plate
+# header, and the models in .npy format.  Every record goes to the end of the file in a single
+# O_APPEND write, so concurrent workers need no locking.  A record that is
+# cut short by a crashed worker, or otherwise corrupted, fails its checks
+# when the store is read; it is dropped and reading resumes at the next
+# record.  Fibers whose records were all dropped are listed in lost
+# (unless the fixed size header itself was cut), so
+# that they can be rerun (the fillin scripts requeue every fiber without a
+# good record).  If a fiber was appended more than once, its last good
+# record in the file is used, whatever the clocks of the workers.
+#
+# finalize() writes the standard redmonster-PLATE-MJD.fits plate file, as
+# MergeRedmonster.merge_fibers2 does from per-fiber files, in a single
+# pass: the table is built from the record rows and the models are
+# streamed into the image HDU fiber by fiber.
+
+from os import makedirs, getpid, remove, rename, open as os_open, write, \
+        close, O_WRONLY, O_APPEND, O_CREAT
+from os.path import join, exists, isdir, getsize
+from socket import gethostname
+from io import BytesIO
+import mmap
+import pickle
+import struct
+import zlib
+
+import numpy as n
+from astropy.io import fits
+
+_magic = b'RMREC003'
+_head = struct.Struct('<8sQQIIq')
+
+
+class PlateStore:
+    '''
+        Store of per-fiber results of plate, mjd in the file
+        dest/redmonster-PLATE-MJD.store (dest defaults to the current
+        directory).  append() adds fibers, read_index() returns the last
+        record of every fiber and finalize() merges them into
+        dest/redmonster-PLATE-MJD.fits.
+        '''
+    def __init__(self, plate, mjd, dest=None):
+        self.plate = plate
+        self.mjd = mjd
+        self.dest = dest if dest is not None else '.'
+        self.path = join(self.dest, 'redmonster-%s-%s.store' % (plate, mjd))
+        # Fibers with bad records and no good one, and the number of bad
+        # records, found by the last read_index()
+        self.lost = []
+        self.nbad = 0
+        # Fibers in the store as far as append() knows, read once for
+        # appends without clobber
+        self._stored = None
+
+    def append(self, fiberid, row, models, hdr=None, clobber=True):
+        # row is the list of (name, format, value) of the fiber's table
+        # columns, models its (nz, npix) array and hdr the primary header
+        # of the plate.  Without clobber a fiber already in the store is
+        # left as it is.  Returns whether the record was written.
+        if not clobber:
+            if self._stored is None:
+                self._stored = set(self.read_index(verify=False))
+            if fiberid in self._stored:
+                print('WARNING: Fiber %s already in %s, not overwriting' %
+                      (fiberid, self.path))
+                return False
+        if not isdir(self.dest):
+            try:
+                makedirs(self.dest)
+            except OSError:
+                # Created by another worker in the meantime
+                if not isdir(self.dest): raise
+        models = n.asarray(models, dtype=float)
+        meta = pickle.dumps((models.shape, row,
+                             hdr.tostring() if hdr is not None else None), 2)
+        buf = BytesIO()
+        n.save(buf, models)
+        data = buf.getvalue()
+        record = _head.pack(_magic, len(meta), len(data), zlib.crc32(meta),
+                            zlib.crc32(data), int(fiberid)) + meta + data
+        fd = os_open(self.path, O_WRONLY | O_APPEND | O_CREAT, 0o644)
+        try:
+            nbytes = write(fd, record)
+        finally:
+            close(fd)
+        if nbytes != len(record):
+            raise IOError('Short write of fiber %s to %s (%d of %d bytes)' %
+                          (fiberid, self.path, nbytes, len(record)))
+        if self._stored is not None: self._stored.add(int(fiberid))
+        return True
+
+    def exists(self):
+        return exists(self.path) and getsize(self.path) > 0
+
+    def read_index(self, verify=True):
+        # Return {fiberid: (shape, row, header, offset)} of the last good
+        # record of every fiber in file order, offset being the position of
+        # its models in the store.  Records failing their checks are
+        # dropped, and the fibers left without a good record listed in
+        # self.lost; without verify, the CRC of the models is only checked
+        # for records not followed by another one.
+        index = {}
+        bad = set()
+        self.lost = []
+        self.nbad = 0
+        if not self.exists(): return index
+        with open(self.path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            view = memoryview(mm)
+            size = len(mm)
+            pos = 0
+            while pos < size:
+                good = pos + _head.size <= size
+                if good:
+                    magic, nmeta, ndata, crcmeta, crcdata, fiberid = \
+                            _head.unpack_from(mm, pos)
+                    start = pos + _head.size
+                    end = start + nmeta + ndata
+                    good = magic == _magic and end <= size and \
+                            zlib.crc32(view[start:start+nmeta]) == crcmeta
+                if good and (verify or mm[end:end+len(_magic)] not in
+                             (_magic, b'')):
+                    # Check the models too, always if the record is not
+                    # followed by another one (it may have been cut short)
+                    good = zlib.crc32(view[start+nmeta:end]) == crcdata
+                if not good:
+                    self.nbad += 1
+                    if pos + _head.size <= size and magic == _magic:
+                        bad.add(fiberid)
+                    # Resume at the next record, if any
+                    nextpos = mm.find(_magic, pos + 1)
+                    print('WARNING: Dropping bad record at byte %d of %s' %
+                          (pos, self.path))
+                    if nextpos < 0: break
+                    pos = nextpos
+                    continue
+                shape, row, hdr = pickle.loads(view[start:start+nmeta])
+                index[fiberid] = (shape, row, hdr, start + nmeta)
+                pos = end
+            view.release()
+        finally:
+            mm.close()
+        self.lost = sorted(bad - set(index))
+        if self.lost:
+            print('WARNING: Fibers %s have no good record in %s' %
+                  (', '.join(map(str, self.lost)), self.path))
+        return index
+
+    def fibers(self):
+        # Fibers with a good record in the store
+        return set(self.read_index())
+
+    def finalize(self, clobber=True, remove_store=False):
+        # Write dest/redmonster-PLATE-MJD.fits from the last record of
+        # every fiber and return its path (None if the store is empty).
+        # Fibers lost from the store (self.lost) are left out.
+        index = self.read_index()
+        if not index:
+            print('WARNING: No fibers in %s' % self.path)
+            return None
+        dest = join(self.dest, 'redmonster-%s-%s.fits' % (self.plate,
+                                                         self.mjd))
+        if exists(dest) and not clobber:
+            print('WARNING: %s exists, not overwriting' % dest)
+            return None
+        fibers = sorted(index)
+        # Primary header of the last record in the file that has one
+        hdrs = sorted([(index[fiberid][3], index[fiberid][2]) for fiberid in
+                       fibers if index[fiberid][2] is not None])
+        hdr = fits.Header.fromstring(hdrs[-1][1]) if hdrs else fits.Header()
+        hdr['NFIBERS'] = len(fibers)
+        # Columns in the order of the first record, plus any that only
+        # later records have; FIBERID is 1-indexed as in merge_fibers2
+        names, formats = [], {}
+        for fiberid in fibers:
+            for name, fmt, value in index[fiberid][1]:
+                if name not in formats:
+                    names.append(name)
+                    formats[name] = fmt
+        values = dict([(name, []) for name in names])
+        for fiberid in fibers:
+            row = dict([(name, value) for name, fmt, value in
+                        index[fiberid][1]])
+            for name in names:
+                values[name].append(row.get(name,
+                                    '' if formats[name].endswith('A') else 0))
+        values['FIBERID'] = [fiberid + 1 for fiberid in fibers]
+        if 'FIBERID' not in formats:
+            names.insert(0, 'FIBERID')
+            formats['FIBERID'] = 'J'
+        colslist = []
+        for name in names:
+            fmt = formats[name]
+            if fmt.endswith('A'):
+                fmt = '%iA' % max(1, max(list(map(len, values[name]))))
+            colslist.append( fits.Column(name=name, format=fmt,
+                                         array=values[name]) )
+        tbhdu = fits.BinTableHDU.from_columns(fits.ColDefs(colslist))
+        shape = tuple(n.max([index[fiberid][0] for fiberid in fibers],
+                            axis=0))
+        # Write to a temporary file and rename, so that the plate file is
+        # never seen half written
+        tmp = '%s.tmp-%s-%d' % (dest, gethostname(), getpid())
+        fits.HDUList([fits.PrimaryHDU(header=hdr), tbhdu]).writeto(
+            tmp, overwrite=True)
+        imhdr = fits.Header([('XTENSION', 'IMAGE'), ('BITPIX', -64),
+                             ('NAXIS', len(shape) + 1)] +
+                            [('NAXIS%d' % (i+1), nax) for i, nax in
+                             enumerate(reversed((len(fibers),) + shape))] +
+                            [('PCOUNT', 0), ('GCOUNT', 1)])
+        stream = fits.StreamingHDU(tmp, imhdr)
+        try:
+            with open(self.path, 'rb') as f:
+                models = n.zeros(shape, dtype='>f8')
+                for fiberid in fibers:
+                    fshape, row, fhdr, offset = index[fiberid]
+                    f.seek(offset)
+                    models[...] = 0
+                    models[tuple([slice(0, s) for s in fshape])] = n.load(f)
+                    stream.write(models)
+        finally:
+            stream.close()
+        rename(tmp, dest)
+        print('Writing redmonster file to %s' % dest)
+        if remove_store: remove(self.path)
+        return dest
@@ -20,6 +20,8 @@ class Spec:
 
     def __init__(self, plate=None, mjd=None, fiberid=None, data_range=None, platepath=None):
         #print 'plate %s mjd %s fiberid %s' % (plate, mjd, fiberid)
+        self.platepath = None
+        self.fiberid = None
         self.hdr = None
         self.flux = None
         self.ivar = None
@@ -33,6 +35,7 @@ class Spec:
         self.coeff0 = None
         self.coeff1 = None
         self.dof = None
+        self.flux_warnings = None
         try:
             self.topdir = environ['BOSS_SPECTRO_REDUX']
         except KeyError as e:
@@ -40,7 +43,7 @@ class Spec:
             print("Enviromental variable 'BOSS_SPECTRO_REDUX' not set: %r" % e)
         try:
             self.run2d = environ['RUN2D']
-        except KeyError:
+        except KeyError as e:
             self.run2d = None
             print("Enviromental variable 'RUN2D' not set: %r" % e)
         self.set_plate_mjd(plate=plate, mjd=mjd, fiberid=fiberid,
@@ -48,7 +51,8 @@ class Spec:
         #for i in xrange(self.flux.shape[0]):
             #self.flux[i] = convolve(self.flux[i], Box1DKernel(5))
         if exists(self.platepath):
-            self.ivar, self.dof = flux_check(self.flux, self.ivar, plate, mjd)
+            self.ivar, self.dof, self.flux_warnings = \
+                    flux_check(self.flux, self.ivar, plate, mjd, self.fiberid)
         else:
             # This should probably be logged eventually as well
             print('%s does not exist.' % self.platepath)
@@ -69,15 +73,47 @@ class Spec:
             self.platepath = join(self.topdir, self.run2d, "%s" % self.plate,
                                   "spPlate-%s-%s.fits" % (self.plate,self.mjd))
         if exists(self.platepath):
-            self.set_data()
+            self.set_data(fiberid, data_range)
             if data_range: self.chop_data(data_range)
-            if fiberid != None: self.set_fibers(fiberid)
-            else: self.fiberid = [i for i in range(self.nobj)]
             self.flag_sky_fibers()
-    
-    def set_data(self):
+
+    # The and mask and sky flux are not used by redmonster itself, so they
+    # are only read from the spPlate file (for the selected fibers) when
+    # first accessed
+    @property
+    def andmask(self):
+        if self._andmask is None and self.fiberid is not None:
+            self._andmask = self.read_rows(2)
+        return self._andmask
+
+    @andmask.setter
+    def andmask(self, value):
+        self._andmask = value
+
+    @property
+    def skyflux(self):
+        if self._skyflux is None and self.fiberid is not None:
+            try:
+                self._skyflux = self.read_rows(6)
+            except Exception as e:
+                print("Exception: %r" % e)
+            # For plate files before Spectro-2D v5, there are no sky
+            # vectors and hdu[6] is something else
+            if self._skyflux is None or \
+                    n.shape(self._skyflux) != n.shape(self.flux):
+                self._skyflux = 0
+        return self._skyflux
+
+    @skyflux.setter
+    def skyflux(self, value):
+        self._skyflux = value
+
+    def set_data(self, fiberid=None, data_range=None):
+        # The spPlate is memory mapped, and only the rows of the fibers in
+        # fiberid (all if None) are read; if data_range is given, flux
+        # and ivar are only read within it, and are 0 outside it
         if self.platepath and exists(self.platepath):
-            hdu = fits.open(self.platepath)
+            hdu = fits.open(self.platepath, memmap=True)
         else:
             print("Missing path to %r" % self.platepath)
             # Added by TH 21 July 2015
@@ -85,82 +121,91 @@ class Spec:
                           #'Missing path to %r' % self.platepath)
         try:
             self.hdr = hdu[0].header
-            self.flux = hdu[0].data
-            self.ivar = hdu[1].data
+            self.nobj = hdu[0].header['NAXIS2']
+            self.npix = hdu[0].header['NAXIS1']
+            self.coeff0 = hdu[0].header['COEFF0']
+            self.coeff1 = hdu[0].header['COEFF1']
             self.loglambda = (hdu[0].header['COEFF0'] +
                               n.arange(hdu[0].header['NAXIS1']) *
                               hdu[0].header['COEFF1'])
-            self.andmask = hdu[2].data
-            self.ormask = hdu[3].data
-            self.plugmap = hdu[5].data
+            self.set_fibers(fiberid)
+            cols = self.pixel_range(data_range) if data_range else None
+            self.flux = self.read_rows(0, cols, hdu)
+            self.ivar = self.read_rows(1, cols, hdu)
+            self.ormask = self.read_rows(3, hdu=hdu)
+            self.plugmap = hdu[5].data[n.asarray(self.fiberid)].copy()
 
             self.sky_mask()
 
             try:
-                self.boss_target1 = hdu[5].data.BOSS_TARGET1
+                self.boss_target1 = self.plugmap.BOSS_TARGET1
             except AttributeError:
                 pass
             try:
-                self.eboss_target0 = hdu[5].data.EBOSS_TARGET0
+                self.eboss_target0 = self.plugmap.EBOSS_TARGET0
             except AttributeError:
                 pass
             try:
-                self.eboss_target1 = hdu[5].data.EBOSS_TARGET1
+                self.eboss_target1 = self.plugmap.EBOSS_TARGET1
             except AttributeError:
                 pass
-            self.skyflux = hdu[6].data
-            # For plate files before Spectro-2D v5, there are no sky vectors and
-            # hdu[6] is something else
-            if self.skyflux.shape != self.flux.shape: self.skyflux = 0
-            self.nobj = hdu[0].header['NAXIS2']
-            self.npix = hdu[0].header['NAXIS1']
-            self.coeff0 = hdu[0].header['COEFF0']
-            self.coeff1 = hdu[0].header['COEFF1']
         except Exception as e:
             print("Exception: %r" % e)
             # Added by TH 21 July 2015
             #write_to_log(self.plate, self.mjd, 'Exception: %r' % e')
+        finally:
+            if self.platepath and exists(self.platepath): hdu.close()
+
+    def read_rows(self, ext, cols=None, hdu=None):
+        # Rows self.fiberid of image HDU ext of the spPlate, read through
+        # the memory map so that other rows are never read.  If cols =
+        # (i1, i2) is given only those pixels are read, the rest being 0
+        close = hdu is None
+        if close: hdu = fits.open(self.platepath, memmap=True)
+        try:
+            data = hdu[ext].data
+            if data is None or data.ndim != 2: return data
+            rows = n.asarray(self.fiberid)
+            if n.array_equal(rows, n.arange(data.shape[0])): rows = slice(None)
+            if cols is None: return n.array(data[rows])
+            arr = n.zeros((len(self.fiberid), data.shape[1]),
+                          dtype=data.dtype)
+            arr[:,cols[0]:cols[1]] = data[rows,cols[0]:cols[1]]
+            return arr
+        finally:
+            if close: hdu.close()
+
+    def pixel_range(self, data_range):
+        # Pixels (i1, i2) of the spectra within wavelength range data_range
+        i1 = ceil( (n.log10(data_range[0]) - self.coeff0) / self.coeff1 )
+        i2 = floor( (n.log10(data_range[1]) - self.coeff0) / self.coeff1 )
+        return max(i1, 0), min(max(i2, 0), self.npix)
 
     def chop_data(self, data_range):
         self.data_range = data_range
-        i1 = ceil( (n.log10(data_range[0]) - self.coeff0) / self.coeff1 )
-        i2 = floor( (n.log10(data_range[1]) - self.coeff0) / self.coeff1 )
-        if i1 >= 0: self.ivar[:,:i1] = 0
-        if i2 <= self.npix: self.ivar[:,i2:] = 0
+        i1, i2 = self.pixel_range(data_range)
+        self.ivar[:,:i1] = 0
+        self.ivar[:,i2:] = 0
         # CHANGE PRINT STATEMENT TO LOG - done by TH 21 July 2015
-        print('Trim wavelength range to %s' % data_range)
+        print('Trim wavelength range to %s' % (data_range,))
         #write_to_log(self.plate, self.mjd,
                      #'Trim wavelength range to %s' % data_range)
 
     def set_fibers(self, fiberid):
-        if min(fiberid) < 0 or max(fiberid) > self.nobj:
+        # Select the fibers to be read by set_data (all if None)
+        if fiberid is None:
+            self.fiberid = [i for i in range(self.nobj)]
+        elif min(fiberid) < 0 or max(fiberid) >= self.nobj:
             # CHANGE THIS TO LOG INSTEAD OF PRINT - done TH
             print(('Invalid value for FIBERID: must be between 0 and %s' %
-                   hdu[0].header['NAXIS1']))
+                   (self.nobj-1)))
             #write_to_log(self.plate, self.mjd,
                          #'Invalid value for FIBERID: must be between 0 and %s'%
                          #hdu[0].header['NAXIS1'])
+            self.fiberid = [i for i in range(self.nobj)]
         else:
             self.fiberid = fiberid
-            self.flux = self.flux[fiberid]
-            self.ivar = self.ivar[fiberid]
-            self.andmask = self.andmask[fiberid]
-            self.ormask = self.ormask[fiberid]
-            self.plugmap = self.plugmap[fiberid]
-            try:
-                self.boss_target1 = self.boss_target1[fiberid]
-            except AttributeError:
-                pass
-            try:
-                self.eboss_target0 = self.eboss_target0[fiberid]
-            except AttributeError:
-                pass
-            try:
-                self.eboss_target1 = self.eboss_target1[fiberid]
-            except AttributeError:
-                pass
             self.nobj = len(fiberid)
-            if self.skyflux.shape[0] != 1: self.skyflux = self.skyflux[fiberid]
 
     def flag_sky_fibers(self):
         self.zwarning = n.zeros( len(self.fiberid) )
@@ -0,0 +1,301 @@
+# On-disk cache of padded ndArch templates and their FFTs.
+#
+# Each cache entry is a directory of .npy files keyed by the sha1 of the
+# template file contents plus a tag describing what was computed (FFT
+# length, FFT mode, template pixel window and low rank basis, or the
+# singular value decomposition of the templates), so entries are
+# invalidated automatically when a template file changes.  Entries are
+# loaded with memory mapping, so a warm start costs an mmap open rather
+# than a full read and FFT of every template.  Template pixel windows are
+# snapped to a grid of window_grid pixels (fft_window), so that plates
+# with slightly different coverage share their FFTs.
+#
+# The cache lives in $REDMONSTER_CACHE_DIR if set, otherwise in the per-user
+# directory $XDG_CACHE_HOME/redmonster (~/.cache/redmonster), never in the
+# shared template tree.  If it cannot be written to, templates are padded
+# and transformed in memory as before.  Whenever an entry is written, the
+# least recently used entries are removed to keep the cache within
+# $REDMONSTER_CACHE_SIZE MB (cache_size by default).
+#
+# On top of the disk cache, get_templates keeps a process-wide registry of
+# the most recently used template arrays, so that repeated requests for
+# the same file (one per fiber and redshift when building models) do no
+# file I/O at all.
+
+from os import environ, makedirs, rename, getpid, listdir, remove, rmdir, \
+        stat, utime
+from os.path import join, exists, dirname, basename, isdir, abspath, \
+        getsize, getmtime, expanduser
+from collections import OrderedDict
+from shutil import rmtree
+import hashlib
+
+import numpy as n
+
+from redmonster.datamgr.io2 import read_ndArch
+from redmonster.physics.misc import two_pad, fast_len
+
+# Content hashes memoized by (path, mtime, size) for the life of the process
+_hashes = {}
+
+# Template registry of get_templates, least recently used entry first
+_registry = OrderedDict()
+registry_size = 8
+
+# Default size cap of the cache directory, in MB
+cache_size = 512
+
+# Grid, in pixels, of the template windows of fft_window
+window_grid = 256
+
+def file_hash(fname):
+    """Return the sha1 hex digest of the contents of fname."""
+    st = stat(fname)
+    key = (fname, st.st_mtime, st.st_size)
+    if key not in _hashes:
+        h = hashlib.sha1()
+        with open(fname, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                h.update(chunk)
+        _hashes[key] = h.hexdigest()
+    return _hashes[key]
+
+
+def cache_dir(fname):
+    """
+    Directory holding cache entries for template file fname:
+    $REDMONSTER_CACHE_DIR, or redmonster in the user's cache directory
+    ($XDG_CACHE_HOME, ~/.cache by default).  Entries are named by content
+    hash, so template files anywhere share the one directory.
+    """
+    try:
+        return environ['REDMONSTER_CACHE_DIR']
+    except KeyError:
+        return join(environ.get('XDG_CACHE_HOME') or
+                    expanduser(join('~', '.cache')), 'redmonster')
+
+
+def entry_name(fname, tag):
+    """Name of the cache entry tag for template file fname."""
+    root = basename(fname)
+    if root.endswith('.fits'): root = root[:-5]
+    return '%s-%s-%s' % (root, file_hash(fname)[:16], tag)
+
+
+def _write_entry(path, arrays):
+    # Write into a private directory and rename it into place, so readers
+    # never see a partial entry and concurrent writers cannot collide
+    tmp = '%s.tmp%d' % (path, getpid())
+    if not exists(tmp): makedirs(tmp)
+    for key, arr in arrays.items():
+        n.save(join(tmp, key + '.npy'), arr)
+    try:
+        rename(tmp, path)
+    except OSError:
+        # Another process got there first; keep its entry
+        for f in listdir(tmp): remove(join(tmp, f))
+        rmdir(tmp)
+
+
+def cached(fname, tag, keys, compute, use_cache=True):
+    """
+    Return the tuple of arrays named keys from the cache entry tag of
+    template file fname, memory mapped read-only, or, if there is no such
+    entry, from compute() (which must return them in the same order),
+    storing them in the cache.
+    """
+    path = None
+    if use_cache:
+        try:
+            path = join(cache_dir(fname), entry_name(fname, tag))
+            if isdir(path):
+                arrays = tuple([n.load(join(path, key + '.npy'),
+                                       mmap_mode='r') for key in keys])
+                # Mark the entry as recently used for prune_cache (not
+                # possible in a read-only cache)
+                try:
+                    utime(path)
+                except OSError:
+                    pass
+                return arrays
+        except Exception as e:
+            print("WARNING: Unable to read template cache for %s: %r" %
+                  (basename(fname), e))
+    arrays = tuple(compute())
+    if path is not None:
+        try:
+            if not isdir(dirname(path)): makedirs(dirname(path))
+            _write_entry(path, dict(zip(keys, arrays)))
+            prune_cache(dirname(path))
+        except Exception as e:
+            print("WARNING: Unable to write template cache for %s: %r" %
+                  (basename(fname), e))
+    return arrays
+
+
+def prune_cache(root, maxsize=None):
+    """
+    Remove the least recently used entries of cache directory root, other
+    than the most recent one, until it holds at most maxsize MB
+    ($REDMONSTER_CACHE_SIZE, or cache_size, if None).
+    """
+    if maxsize is None:
+        maxsize = float(environ.get('REDMONSTER_CACHE_SIZE', cache_size))
+    entries = []
+    for name in listdir(root):
+        path = join(root, name)
+        # Skip entries being written by other processes
+        if '.tmp' in name or not isdir(path): continue
+        try:
+            size = sum([getsize(join(path, f)) for f in listdir(path)])
+            entries.append((getmtime(path), size, path))
+        except OSError:
+            # Removed by another process in the meantime
+            continue
+    entries.sort()
+    total = sum([size for mtime, size, path in entries])
+    for mtime, size, path in entries[:-1]:
+        if total <= maxsize * 2**20: break
+        # Readers holding the entry memory mapped keep their copy
+        rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def read_templates(fname, nfft=None, use_cache=True):
+    """
+    Read ndArch template file fname and return the tuple
+
+    (templates_pad, baselines, infodict)
+
+    where templates_pad holds the templates, shape (N_0,...,N_wave),
+    zero padded to nfft pixels (two_pad(N_wave) if nfft is None), and
+    baselines and infodict are as returned by read_ndArch.
+    """
+    data, baselines, infodict = read_ndArch(fname, read_data=False)
+    if nfft is None: nfft = two_pad(infodict['nwave'])
+    def compute():
+        templates = read_ndArch(fname)[0]
+        templates_pad = n.zeros(templates.shape[:-1] + (nfft,))
+        templates_pad[...,:templates.shape[-1]] = templates
+        return [templates_pad]
+    templates_pad, = cached(fname, '%d' % nfft, ['templates'], compute,
+                            use_cache)
+    return templates_pad, baselines, infodict
+
+
+def get_templates(fname, nfft=None, use_cache=True):
+    """
+    Return read_templates(fname, nfft, use_cache) from the process-wide
+    registry of the registry_size most recently used template files,
+    keyed by path, modification time and nfft.  Template arrays are
+    read-only (memory mapped from the template cache when available) and
+    shared by every caller.
+    """
+    st = stat(fname)
+    path = abspath(fname)
+    key = (path, st.st_mtime, st.st_size, nfft)
+    if key in _registry:
+        _registry.move_to_end(key)
+        return _registry[key]
+    templates_pad, baselines, infodict = read_templates(fname, nfft,
+                                                        use_cache)
+    if templates_pad.flags.writeable:
+        templates_pad = templates_pad.view()
+        templates_pad.flags.writeable = False
+    # Drop entries of earlier versions of the file
+    for old in [k for k in _registry if k[0] == path and k[1:3] != key[1:3]]:
+        del _registry[old]
+    _registry[key] = (templates_pad, baselines, infodict)
+    while len(_registry) > registry_size: _registry.popitem(last=False)
+    return _registry[key]
+
+
+def template_svd(fname, use_cache=True):
+    """
+    Return (norm, u, s, vt, u2, s2, vt2): the norms of the flattened
+    (ntemps, N_wave) templates of ndArch file fname, and the thin singular
+    value decompositions of the unit norm templates, templates/norm =
+    n.dot(u*s, vt), and of their squares, (templates/norm)**2 =
+    n.dot(u2*s2, vt2), with singular values in decreasing order.
+    """
+    def compute():
+        # Templates are stored as float32; decompose in float64
+        templates = n.asarray(read_ndArch(fname)[0], dtype=float)
+        templates = n.reshape(templates, (-1,templates.shape[-1]))
+        norm = n.sqrt(n.sum(templates**2, axis=1))
+        templates = templates / n.where(norm > 0, norm, 1.)[:,None]
+        return (norm,) + n.linalg.svd(templates, full_matrices=False) + \
+                n.linalg.svd(templates**2, full_matrices=False)
+    return cached(fname, 'svd64', ['norm', 'u', 's', 'vt', 'u2', 's2', 'vt2'],
+                  compute, use_cache)
+
+
+def fft_window(lo, hi):
+    """
+    Return (lo, hi, nfft): the template pixel window lo to hi-1 widened to
+    the grid of window_grid pixels, and a fast FFT length for it.  Any
+    window covering the pixels reachable from the data gives the same
+    correlations at the searched lags, so snapping it lets nearby windows
+    share a template_fft cache entry.
+    """
+    lo = lo // window_grid * window_grid
+    hi = -(-hi // window_grid) * window_grid
+    return lo, hi, fast_len(hi - lo)
+
+
+def template_fft(fname, nfft, rfft=False, window=None, rank=None,
+                 use_cache=True):
+    """
+    Return (t_fft, t2_fft), the FFTs of length nfft of the templates in
+    ndArch file fname and of their squares, taken over the flattened
+    (ntemps, nwave) template array.  If rfft, only the nfft//2+1
+    non-negative frequencies are kept (n.fft.rfft).
+
+    If window = (lo, hi) is given only template pixels lo to hi-1 are
+    transformed; pixel indices wrap around the two_pad(N_wave) padded
+    templates of read_templates, as in the uncropped circular
+    correlation.  hi - lo must not exceed nfft.  Windows should come from
+    fft_window, so that the cache holds one entry for nearby windows.
+
+    If rank = (r, r2) is given the leading r and r2 basis vectors s*vt
+    and s2*vt2 of template_svd are transformed instead of the templates
+    and their squares.  The whole basis is transformed and cached, and
+    cut to rank on return, so every rank shares one cache entry.
+    """
+    tag = '%d%s' % (nfft, '-r' if rfft else '')
+    if window is not None: tag += '-%d-%d' % tuple(window)
+    if rank is not None: tag += '-svd'
+    def compute():
+        if rank is None:
+            templates = get_templates(fname, use_cache=use_cache)[0]
+            templates = n.reshape(templates, (-1,templates.shape[-1]))
+            templates2 = templates**2
+        else:
+            norm, u, s, vt, u2, s2, vt2 = template_svd(fname, use_cache)
+            templates, templates2 = template_basis(fname, (len(s), len(s2)),
+                                                   use_cache)
+        if window is not None:
+            wrap = n.arange(window[0], window[1]) % templates.shape[-1]
+            templates = n.take(templates, wrap, axis=1)
+            templates2 = n.take(templates2, wrap, axis=1)
+        fft = n.fft.rfft if rfft else n.fft.fft
+        return fft(templates, nfft), fft(templates2, nfft)
+    t_fft, t2_fft = cached(fname, tag, ['t_fft', 't2_fft'], compute,
+                           use_cache)
+    if rank is not None: t_fft, t2_fft = t_fft[:rank[0]], t2_fft[:rank[1]]
+    return t_fft, t2_fft
+
+
+def template_basis(fname, rank, use_cache=True):
+    """
+    Return (basis, basis2), the leading rank = (r, r2) basis vectors s*vt
+    and s2*vt2 of template_svd, zero padded as read_templates pads the
+    templates.
+    """
+    norm, u, s, vt, u2, s2, vt2 = template_svd(fname, use_cache)
+    nfft = two_pad(vt.shape[-1])
+    basis = n.zeros((rank[0], nfft))
+    basis[:,:vt.shape[-1]] = s[:rank[0],None] * vt[:rank[0]]
+    basis2 = n.zeros((rank[1], nfft))
+    basis2[:,:vt2.shape[-1]] = s2[:rank[1],None] * vt2[:rank[1]]
+    return basis, basis2
@@ -8,11 +8,16 @@
 # Most convenient interface is via GridSpline class,
 # which encapsulates the low-level routines.
 #
+# The spline routines also take a stack of curves, y of shape
+# (..., N), splining each along its last axis, so that many curves
+# (e.g. the chi2 vectors of every fiber of a plate) are handled at once.
+#
 # A. Bolton, U. of Utah, 2010-2014
 #
 from __future__ import division
 
 import numpy as n
+from scipy.linalg import solve_banded
 
 def tri_diag(a, b, c, r):
     """
@@ -36,96 +41,112 @@ def tri_diag(a, b, c, r):
 
 def spline_get_ms(y):
     """
-    Compute knot slopes to initialize spline
+    Compute knot slopes to initialize spline (of every curve of a
+    stack y, solving all the tri-diagonal systems in one banded solve)
     """
-    bign = len(y) - 1
+    bign = y.shape[-1] - 1
     m = 0. * y
-    m[0] = 2.0 * y[1] - 1.5 * y[0] - 0.5 * y[2]
-    m[bign] = 1.5 * y[bign] + 0.5 * y[bign-2] - 2.0 * y[bign-1]
-    r = 3.0 * (y[2:] - y[:-2])
-    r[0] = r[0] - m[0]
-    r[bign-2] = r[bign-2] - m[bign]
-    on_diag = n.zeros(bign-1) + 4.0
-    off_diag = n.zeros(bign-1) + 1.0
-    m[1:bign] = tri_diag(off_diag, on_diag, off_diag, r)
+    m[...,0] = 2.0 * y[...,1] - 1.5 * y[...,0] - 0.5 * y[...,2]
+    m[...,bign] = 1.5 * y[...,bign] + 0.5 * y[...,bign-2] - \
+            2.0 * y[...,bign-1]
+    r = 3.0 * (y[...,2:] - y[...,:-2])
+    r[...,0] = r[...,0] - m[...,0]
+    r[...,bign-2] = r[...,bign-2] - m[...,bign]
+    # Banded form of the (1, 4, 1) tri-diagonal matrix
+    ab = n.zeros((3,bign-1))
+    ab[0,1:] = 1.0
+    ab[1] = 4.0
+    ab[2,:-1] = 1.0
+    rhs = n.reshape(r, (-1,bign-1)).T
+    m[...,1:bign] = n.reshape(solve_banded((1,1), ab, rhs,
+                                           check_finite=False).T, r.shape)
     return m
 
-def spline_get_val(y, m, x):
+def _knots(y, i):
     """
-    Evaluate spline value at positions x
+    Values of y at knot indices i, for a single curve or, along the last
+    axis, for a stack of curves
+    """
+    if y.ndim == 1: return y[i]
+    return n.take_along_axis(y, i, axis=-1)
+
+def _intervals(y, x):
     """
-    intervals = len(y) - 1
+    Knot values and slope indices of the intervals holding positions x
+    """
+    intervals = y.shape[-1] - 1
     i = n.int32(x) + 1
     # (the following is a hack to keep the upper
     # bound in the valid interval range:)
     i = i - i // (intervals + 1)
-    d1 = x - i + 1.
+    return i, x - i + 1.
+
+def spline_get_val(y, m, x):
+    """
+    Evaluate spline value at positions x
+    """
+    i, d1 = _intervals(y, x)
     d2 = d1 - 1.0
-    spline_val = (y[i] * d1**3 - y[i-1] * d2**3
-                  + (m[i] - 3.0 * y[i]) * d1**2 * d2
-                  + (m[i-1] + 3.0 * y[i-1]) * d1 * d2**2)
+    yi, yi1, mi, mi1 = _knots(y, i), _knots(y, i-1), _knots(m, i), \
+            _knots(m, i-1)
+    spline_val = (yi * d1**3 - yi1 * d2**3
+                  + (mi - 3.0 * yi) * d1**2 * d2
+                  + (mi1 + 3.0 * yi1) * d1 * d2**2)
     return spline_val
 
 def spline_get_slope(y, m, x):
     """
     Evaluate spline slope at positions x
     """
-    intervals = len(y) - 1
-    i = n.int32(x) + 1
-    # (the following is a hack to keep the upper
-    # bound in the valid interval range:)
-    i = i - i // (intervals + 1)
-    d1 = x - i + 1.
+    i, d1 = _intervals(y, x)
     d2 = d1 - 1.0
-    spline_slope = (m[i] * d1**2 + m[i-1] * d2**2 +
-                    (2.0*m[i] + 2.0*m[i-1] - 6.0*y[i] + 6.0*y[i-1]) * d1 * d2)
+    yi, yi1, mi, mi1 = _knots(y, i), _knots(y, i-1), _knots(m, i), \
+            _knots(m, i-1)
+    spline_slope = (mi * d1**2 + mi1 * d2**2 +
+                    (2.0*mi + 2.0*mi1 - 6.0*yi + 6.0*yi1) * d1 * d2)
     return spline_slope
 
 def spline_get_curv(y, m, x):
     """
     Evaluate spline curvature at positions x
     """
-    intervals = len(y) - 1
-    i = n.int32(x) + 1
-    # (the following is a hack to keep the upper
-    # bound in the valid interval range:)
-    i = i - i // (intervals + 1)
-    d1 = x - i + 1.
+    i, d1 = _intervals(y, x)
     d2 = d1 - 1.0
-    spline_curv = (2.0 * m[i] * d1 + 2.0 * m[i-1] * d2 +
-                   (2.0*m[i] + 2.0*m[i-1] - 6.0*y[i] + 6.0*y[i-1]) * (d1 + d2))
+    yi, yi1, mi, mi1 = _knots(y, i), _knots(y, i-1), _knots(m, i), \
+            _knots(m, i-1)
+    spline_curv = (2.0 * mi * d1 + 2.0 * mi1 * d2 +
+                   (2.0*mi + 2.0*mi1 - 6.0*yi + 6.0*yi1) * (d1 + d2))
     return spline_curv
 
 def spline_get_max(y, m):
     """
-    Find positions of analytic maxima of spline
+    Find positions of analytic maxima of spline.  For a stack of curves
+    y of shape (ncurves, N), return (icurve, xval), the curve index and
+    position of every maximum, ordered by curve and then position.
     """
-    bign = len(y) - 1
-    xval = n.zeros(bign) - 1.0
+    bign = y.shape[-1] - 1
     #Quadratic derivative coefficients in the intervals:
-    a = (3.0 * (m[0:bign] + (n.roll(m, -1))[0:bign])
-         + 6.0 * (y[0:bign] - (n.roll(y, -1))[0:bign]))
-    b = (-2.0 * (2.0 * m[0:bign] + (n.roll(m, -1))[0:bign]
-                 + 3.0 * (y[0:bign] - (n.roll(y, -1))[0:bign])))
-    c = (m[0:bign])
+    a = (3.0 * (m[...,0:bign] + m[...,1:])
+         + 6.0 * (y[...,0:bign] - y[...,1:]))
+    b = (-2.0 * (2.0 * m[...,0:bign] + m[...,1:]
+                 + 3.0 * (y[...,0:bign] - y[...,1:])))
+    c = (m[...,0:bign])
     # Discriminant:
     d = b**2 - 4.0 * a * c
-    # Find any linear-root maxima:
-    lroots = (n.where((a == 0) * (b < 0)))[0]
-    if len(lroots) > 0:
-        xval[lroots] = -c[lroots] / b[lroots]
-    # Find any quadratic-root maxima:
-    qroots = (n.where((a != 0) * (d > 0)))[0]
-    if len(qroots) > 0:
-        xval[qroots] = -0.5 * (b[qroots] + n.sqrt(d[qroots])) / a[qroots]
+    # Find any linear-root maxima (a == 0, b < 0) and quadratic-root
+    # maxima (a != 0, d > 0), with xval = -1 elsewhere:
+    with n.errstate(divide='ignore', invalid='ignore'):
+        xval = n.where(a != 0,
+                       n.where(d > 0, -0.5 * (b + n.sqrt(n.maximum(d, 0.)))
+                               / a, -1.0),
+                       n.where(b < 0, -c / b, -1.0))
     # Find roots that are within the necessary interval bounds:
-    roots = (n.where((xval >= 0.0) * (xval < 1.0)))[0]
-    if len(roots) <= 0:
-        return n.asarray([])
+    roots = (xval >= 0.0) * (xval < 1.0)
     # Transform root values to global x-coordinate and return.
     xval = xval + n.arange(bign)
-    xval = xval[roots]
-    return xval
+    if y.ndim == 1: return xval[roots]
+    icurve, ival = n.nonzero(roots)
+    return icurve, xval[icurve,ival]
 
 # OOP interface to this business:
 class GridSpline:
@@ -140,6 +161,11 @@ class GridSpline:
     The abscissa for the spline is taken to be a zero-based
     vector of integers of length equal to the y-vector.
 
+    y may also be a 2D array of ncurves curves to be splined at
+    once, along its last axis; positions x passed to get_val etc.
+    then have shape (ncurves, K), and get_max and get_min return
+    (icurve, xval) pairs (see spline_get_max).
+
     A. Bolton, U. of Utah, 2010-2014
     """
     def __init__(self, y):
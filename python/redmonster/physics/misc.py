@@ -13,35 +13,55 @@ from redmonster.datamgr.io import write_to_log
 
 
 # Function to find where S/N is unreasonably large or where flux is
-# unphysically negative
-def flux_check(flux, ivars, plate, mjd):
+# unphysically negative, vectorized over blocks of fibers.  Pixels with
+# flux < -10*noise are masked along with their two neighbors in both
+# directions, and warnings are gathered into the dict summary, with keys
+# 'fiber' (fiber numbers, fiberid+1 or row+1), 'nhighsn' and 'nnegflux'
+# (number of pixels with S/N > 200 and with flux < -10*noise) for every
+# fiber with at least one such pixel.
+def flux_check(flux, ivars, plate, mjd, fiberid=None, nblock=16):
+    nhighsn = n.zeros(flux.shape[0], dtype=int)
+    nnegflux = n.zeros(flux.shape[0], dtype=int)
     dof = n.zeros(flux.shape[0])
-    npix = flux.shape[1]
-    for i in range(flux.shape[0]):
-        ct = n.where(abs(flux[i]) * n.sqrt(ivars[i]) > 200.)[0].shape[0]
-        # CHANGE NEXT LINE SO IT ADDS TO LOG FILE RATHER THAN PRINTS
-        if ct > 0:
-            print('WARNING: Fiber #%s has %s pixels with S/N > 200' % (i+1,ct))
-            #write_to_log(plate, mjd, 'WARNING: Fiber #%s has %s \
-                          #pixels with S/N > 200' % (i+1,ct))
-        badpix = n.where(flux[i] * n.sqrt(ivars[i]) < -10.)[0]
-        if len(badpix) > 0:
-            # ALSO CHANGE TO ADD TO LOG
-            print('WARNING: Fiber #%s has %s pixels with Flux < -10*Noise' % \
-                    (i+1,len(badpix)))
-            #write_to_log(plate, mjd, 'WARNING: Fiber #%s has %s pixels \
-                          #with Flux < -10*Noise' % (i+1,len(badpix)))
-            ivars[i] = mask_pixels(badpix, ivars[i])
-        nummasks = len( n.where(ivars[i] == 0)[0] )
-        dof[i] = npix - nummasks
-    return ivars, dof
+    # Blocks of nblock fibers, so temporaries stay in cache
+    for i in range(0, flux.shape[0], nblock):
+        sn = flux[i:i+nblock] * n.sqrt(ivars[i:i+nblock])
+        nhighsn[i:i+nblock] = n.count_nonzero(n.abs(sn) > 200., axis=1)
+        badpix = sn < -10.
+        nnegflux[i:i+nblock] = n.count_nonzero(badpix, axis=1)
+        if nnegflux[i:i+nblock].any():
+            mask_pixels(badpix, ivars[i:i+nblock])
+        dof[i:i+nblock] = n.count_nonzero(ivars[i:i+nblock], axis=1)
+    fibers = n.arange(flux.shape[0]) if fiberid is None else \
+            n.asarray(fiberid)
+    warn = (nhighsn > 0) | (nnegflux > 0)
+    summary = {'fiber': fibers[warn] + 1, 'nhighsn': nhighsn[warn],
+               'nnegflux': nnegflux[warn]}
+    # CHANGE NEXT LINES SO THEY ADD TO LOG FILE RATHER THAN PRINT
+    if nhighsn.any():
+        print('WARNING: %s fibers have %s pixels with S/N > 200' %
+              (n.count_nonzero(nhighsn), nhighsn.sum()))
+    if nnegflux.any():
+        print('WARNING: %s fibers have %s pixels with Flux < -10*Noise' %
+              (n.count_nonzero(nnegflux), nnegflux.sum()))
+    return ivars, dof, summary
 
 
 # Mask unphysically negative pixels + neighboring two pixels in
-# both directions
+# both directions.  badpix is a boolean array of the shape of ivars
+# (spectra along the last axis) or, for a single spectrum, an array of
+# bad pixel indices.
 def mask_pixels(badpix, ivars):
-    for j in badpix:
-        ivars[j-2:j+3] = 0
+    badpix = n.asarray(badpix)
+    if badpix.dtype != bool:
+        mask = n.zeros(ivars.shape, dtype=bool)
+        mask[badpix] = True
+        badpix = mask
+    mask = badpix.copy()
+    for k in (1, 2):
+        mask[...,k:] |= badpix[...,:-k]
+        mask[...,:-k] |= badpix[...,k:]
+    ivars[mask] = 0
     return ivars
 
 
@@ -76,6 +96,95 @@ def two_pad(npix):
     return (2**i)
 
 
+def fast_len(npix):
+    # Smallest 2/3/5-smooth integer >= npix, an efficient FFT length that
+    # is often much shorter than two_pad(npix)
+    npix = int(abs(npix))
+    best = two_pad(npix)
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            m = p35
+            while m < npix: m *= 2
+            best = min(best, m)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+def nnls_normal(M, v, nonneg=None, maxiter=None):
+    """
+    Batched active set (Lawson-Hanson) solution of the nonnegative least
+    squares problems
+
+        minimize f.M.f - 2 v.f  subject to f[j] >= 0 for j in nonneg
+
+    given their normal equations, M of shape (..., k, k) and v of shape
+    (..., k).  nonneg is a boolean mask of length k selecting the
+    constrained coefficients (all of them if None); the others are free.
+    Every system is iterated at once, each step being a single stacked
+    n.linalg.solve of the passive set subsystems, so the cost is a few
+    times that of the unconstrained solve.  Singular subsystems (e.g.
+    fibers with ivar = 0 everywhere) are solved with the pseudo-inverse.
+    Returns f, of shape (..., k).
+    """
+    M = n.asarray(M, dtype=float)
+    v = n.asarray(v, dtype=float)
+    shape, k = v.shape, v.shape[-1]
+    M = n.reshape(M, (-1,k,k))
+    v = n.reshape(v, (-1,k))
+    nonneg = n.ones(k, dtype=bool) if nonneg is None else \
+            n.asarray(nonneg, dtype=bool)
+    if maxiter is None: maxiter = 3*k
+    eye = n.eye(k, dtype=bool)
+    tol = 10 * n.finfo(float).eps * k * \
+            n.abs(M).reshape(M.shape[0],-1).max(axis=1)
+
+    def solve(idx):
+        # Solve the passive set subsystems of systems idx, with f = 0 on
+        # the active set
+        pas = passive[idx]
+        mp = n.where(pas[:,:,None] & pas[:,None,:], M[idx], eye)
+        vp = n.where(pas, v[idx], 0.)
+        try:
+            return n.linalg.solve(mp, vp[...,None])[...,0]
+        except n.linalg.LinAlgError:
+            return n.einsum('sij,sj->si', n.linalg.pinv(mp), vp)
+
+    # Start from the free coefficients alone, all constrained ones at 0
+    passive = n.tile(~nonneg, (v.shape[0],1))
+    f = n.zeros(v.shape)
+    if not nonneg.all(): f = solve(n.arange(v.shape[0]))
+    for it in range(maxiter):
+        # Release the constrained coefficient with the largest gradient
+        w = v - n.einsum('sij,sj->si', M, f)
+        cand = nonneg & ~passive & (w > tol[:,None])
+        idx = n.where(cand.any(axis=1))[0]
+        if idx.size == 0: break
+        passive[idx, n.argmax(n.where(cand[idx], w[idx], -n.inf), axis=1)] \
+                = True
+        while idx.size:
+            z = solve(idx)
+            neg = passive[idx] & nonneg & (z <= 0)
+            done = ~neg.any(axis=1)
+            f[idx[done]] = z[done]
+            idx, z, neg = idx[~done], z[~done], neg[~done]
+            if idx.size == 0: break
+            # Step towards z until the first coefficient hits zero, and
+            # move it (and any others at zero) to the active set
+            fi = f[idx]
+            step = n.where(neg, fi / n.where(neg, fi - z, 1.), n.inf)
+            jmin = n.argmin(step, axis=1)
+            fi += step[n.arange(idx.size),jmin][:,None] * (z - fi)
+            fi[n.arange(idx.size),jmin] = 0.
+            zero = nonneg & (fi <= 0)
+            fi[zero] = 0.
+            passive[idx] &= ~zero
+            f[idx] = fi
+    return n.reshape(f, shape)
+
+
 def multipoly_fit(ind, dep, order=2):
     ndata = n.prod(dep.shape)
     ndim = ind.shape[0]
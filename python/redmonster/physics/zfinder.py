@@ -12,81 +12,398 @@ from time import gmtime, strftime
 import numpy as n
 from astropy.io import fits
 from scipy import linalg
-from scipy.optimize import nnls
 import matplotlib as m
 from matplotlib import pyplot as p
 
 import multiprocessing
+from multiprocessing.pool import ThreadPool
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = None
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+from contextlib import contextmanager
 import sys
 import time
 
 from redmonster.datamgr.ssp_prep import SSPPrep
-from redmonster.physics.misc import poly_array, two_pad
-from redmonster.datamgr.io2 import read_ndArch, write_chi2arr
+from redmonster.physics.misc import poly_array, nnls_normal
+from redmonster.physics import grid_spline as gs
+from redmonster.datamgr.io2 import write_chi2arr
+from redmonster.datamgr.tempcache import get_templates, template_fft, \
+        template_svd, template_basis, fft_window
 
 # Assumes all templates live in $REDMONSTER_DIR/templates/
 
-def _zchi2(arg) :
-    return zchi2_single_template(**arg)
+# Shared memory blocks attached by a ZFinder worker process, keyed by name
+_shared = {}
 
-def _zchi2_no_poly(arg) :
-    return zchi2_single_template_no_poly(**arg)
+@contextmanager
+def blas_threads(nthreads):
+    """
+    Limit BLAS and OpenMP thread pools to nthreads within the block, if
+    threadpoolctl is installed, so that parallel ZFinder tasks do not
+    oversubscribe the cores.
+    """
+    if threadpool_limits is None:
+        yield
+    else:
+        with threadpool_limits(limits=nthreads):
+            yield
 
+def _init_worker():
+    # Pool initializer: one BLAS thread per worker process
+    if threadpool_limits is not None: threadpool_limits(limits=1)
 
-def zchi2_single_template(j,poly_fft, t_fft, t2_fft, data_fft, ivar_fft, pmat_pol, bvec_pol, chi2_0, chi2_null, num_z, npixstep, zminpix, flag_val_neg_model) :
-    npoly=poly_fft.shape[0] # degree+1 of polynomial
-    fftnaxis1=t_fft.shape[0] # number of redshift bins
-    pmat = pmat_pol.copy() # precomputed block for polynomial terms , n.zeros( (npoly+1, npoly+1, fftnaxis1), dtype=float)
-    bvec = bvec_pol.copy() # precomputed vector block for polynomial terms , n.zeros( (npoly+1, fftnaxis1), dtype=float)
+def _attach(layout):
+    """
+    Return a dictionary of numpy arrays backed by the shared memory blocks
+    described by layout, {key: (name, shape, dtype)}.  Blocks are attached
+    once per worker; blocks no longer in the layout are released.
+    """
+    names = [name for name, shape, dtype in layout.values()]
+    for name in list(_shared.keys()):
+        if name not in names:
+            _shared.pop(name).close()
+    arrays = {}
+    for key, (name, shape, dtype) in layout.items():
+        if name not in _shared:
+            _shared[name] = shared_memory.SharedMemory(name=name)
+        arrays[key] = n.ndarray(shape, dtype=dtype, buffer=_shared[name].buf)
+    return arrays
 
-    # fill matrix
-    pmat[0,0] = n.fft.ifft(t2_fft * ivar_fft.conj()).real
-    bvec[0]   = n.fft.ifft(t_fft * data_fft.conj()).real
-    for ipos in range(npoly):
-        pmat[ipos+1,0] = pmat[0,ipos+1] = n.fft.ifft(t_fft*poly_fft[ipos].conj()).real
+def _zchi2_shared(arg):
+    """
+    Pool task: fit fibers ii against templates j0:j1, reading the template
+    and plate arrays from, and writing the chi2 and zwarning slices to,
+    shared memory.  If reduce, the block is instead reduced over templates
+    (reduce_block) and returned.
+    """
+    layout, ii, j0, j1, flag_val_neg_model, nfft, reduce = arg
+    d = _attach(layout)
+    jj = slice(j0, j1)
+    if 'pmat_pol' in d:
+        pmat_pol, bvec_pol = d['pmat_pol'][ii], d['bvec_pol'][ii]
+    else:
+        pmat_pol, bvec_pol = None, None
+    if 'coeffs' in d:
+        # Low rank basis: every block correlates the whole basis
+        tj, coeffs = slice(None), (d['coeffs'][jj], d['coeffs2'][jj])
+    else:
+        tj, coeffs = jj, None
+    if 'templates' in d:
+        zchi2arr, zwarning = zchi2_block_direct(d['templates'][tj],
+                                                d['data'][ii], d['ivar'][ii],
+                                                d['poly'][ii] if 'poly' in d
+                                                else None, pmat_pol, bvec_pol,
+                                                d['chi2_0'][ii],
+                                                d['chi2_null'][ii],
+                                                d['zinds'], flag_val_neg_model,
+                                                d['templates2'][tj]
+                                                if 'templates2' in d else None,
+                                                coeffs)
+    else:
+        zchi2arr, zwarning = zchi2_block(d['t_fft'][tj], d['t2_fft'][tj],
+                                         d['data_fft'][ii], d['ivar_fft'][ii],
+                                         d['poly_fft'][ii] if 'poly_fft' in d
+                                         else None, pmat_pol, bvec_pol,
+                                         d['chi2_0'][ii], d['chi2_null'][ii],
+                                         d['zinds'], flag_val_neg_model, nfft,
+                                         coeffs)
+    if reduce: return reduce_block(zchi2arr, zwarning)
+    d['zchi2arr'][ii,jj] = zchi2arr
+    d['zwarning'][ii,jj] = zwarning
 
-    # solve for each z
+def solve_zchi2(a, b, p, pmat_pol, bvec_pol, chi2_0, chi2_null,
+                flag_val_neg_model):
+    """
+    Solve the normal equations pmat[:,:,l] f = bvec[:,l] of the
+    template + polynomial fit at every trial redshift l, for a stack of
+    fibers and templates at once, and return the chi2 and zwarning arrays.
 
-    zchi2arr=n.zeros((num_z))
-    zwarning=n.zeros((num_z))
-    for l in n.arange(num_z)*npixstep:
-        try : # try to solve for this redshift
-            f = linalg.solve(pmat[:,:,l+zminpix],bvec[:,l+zminpix])
+    a, b and p are the template terms pmat[0,0], bvec[0] and pmat[1:,0],
+    with shapes (nfibers, ntemps, num_z) for a and b and
+    (nfibers, ntemps, npoly, num_z) for p.  pmat_pol (nfibers, npoly+1,
+    npoly+1) and bvec_pol (nfibers, npoly+1) hold the lag independent
+    polynomial blocks.  The polynomial block Q = pmat_pol[:,1:,1:] is
+    eliminated in closed form (Schur complement), so that
+        f[0] = (b - p.f_null) / (a - p.Q^-1.p)
+        chi2 = chi2_null - (b - p.f_null)**2 / (a - p.Q^-1.p)
+    Lags with a singular system (a - p.Q^-1.p <= 0) are set to chi2_null,
+    and lags with a negative template amplitude are set to chi2_null and
+    flagged; with the amplitude alone constrained to be nonnegative the
+    chi2 is convex, so this is the exact constrained minimum that
+    misc.nnls_normal would find, at no extra cost.  If p is None the fit
+    is template only, with chi2_0 the chi2 of a zero model.
+    """
+    if p is None:
+        f = (a!=0)*b/(a+(a==0))
+        zchi2arr = chi2_0[:,None,None] - a*f**2
+        zwarning = n.zeros(zchi2arr.shape)
+        neg = f < 0
+        zchi2arr[neg] = n.broadcast_to(chi2_0[:,None,None], a.shape)[neg]
+        zwarning[neg] = flag_val_neg_model
+        return zchi2arr, zwarning
 
-            zchi2arr[(l//npixstep)] = chi2_0 - n.dot(n.dot(f,pmat[:,:,l+zminpix]),f) # is this true ?????
-            if f[0]<0 :
-                zwarning[(l//npixstep)] = int(zwarning[(l//npixstep)]) | flag_val_neg_model
-                zchi2arr[(l//npixstep)] = chi2_null
-                try:
-                    n.dot(n.dot(f,pmat[:,:,l+zminpix]),f)
-                except Exception as e:
-                    print("Except: %r" % e)
-                    zchi2arr[(l//npixstep)] = chi2_null
-        except : # failure
-            #print "failure"
-            #print sys.exc_info()
-            zchi2arr[(l//npixstep)] = chi2_null
-    return j,zchi2arr,zwarning
+    qinv = n.linalg.inv(pmat_pol[:,1:,1:])
+    f_null = n.einsum('fij,fj->fi', qinv, bvec_pol[:,1:])
+    qp = n.einsum('fij,ftjz->ftiz', qinv, p)
+    s = a - n.einsum('ftiz,ftiz->ftz', p, qp)
+    r = b - n.einsum('ftiz,fi->ftz', p, f_null)
+
+    chi2_null = n.broadcast_to(chi2_null[:,None,None], a.shape)
+    good = s > 0
+    f = n.zeros(a.shape)
+    f[good] = r[good] / s[good]
+    zchi2arr = chi2_null.copy()
+    zchi2arr[good] -= r[good] * f[good]
+    zwarning = n.zeros(a.shape)
+    neg = good & (f < 0)
+    zchi2arr[neg] = chi2_null[neg]
+    zwarning[neg] = flag_val_neg_model
+    return zchi2arr, zwarning
+
+def zchi2_block(t_fft, t2_fft, data_fft, ivar_fft, poly_fft, pmat_pol, bvec_pol,
+                chi2_0, chi2_null, zinds, flag_val_neg_model, nfft=None,
+                coeffs=None):
+    """
+    Compute the chi2 surfaces of a block of fibers against a block of
+    templates at the trial redshift lags zinds.
+
+    t_fft and t2_fft have shape (ntemps, fftnaxis1), data_fft and ivar_fft
+    have shape (nfibers, fftnaxis1).  If poly_fft is not None it has shape
+    (nfibers, npoly, fftnaxis1) and pmat_pol, bvec_pol hold the lag
+    independent polynomial blocks of the normal equations, with shapes
+    (nfibers, npoly+1, npoly+1) and (nfibers, npoly+1).  The cross
+    correlations of every (fiber, template) pair are inverse transformed
+    in a single stacked FFT call per term.  If nfft is given the inputs
+    are real-to-complex half spectra (n.fft.rfft) of nfft point signals and
+    are inverted with n.fft.irfft; otherwise they are full complex spectra.
+    If coeffs is given, t_fft and t2_fft are the FFTs of a low rank basis
+    and the template terms are reconstructed by basis_terms.
+
+    Returns zchi2arr, zwarning, both of shape (nfibers, ntemps, num_z).
+    """
+    nfibers = data_fft.shape[0]
+    ntemps = t_fft.shape[0]
+    num_z = len(zinds)
+
+    if nfft is None:
+        ifft = lambda x: n.fft.ifft(x).real
+    else:
+        ifft = lambda x: n.fft.irfft(x, nfft)
+
+    # Cross-correlations of all (fiber, template) pairs, evaluated at zinds
+    a = ifft(t2_fft[None,:,:] * ivar_fft[:,None,:].conj())[...,zinds]
+    b = ifft(t_fft[None,:,:] * data_fft[:,None,:].conj())[...,zinds]
+
+    p = None
+    if poly_fft is not None:
+        npoly = poly_fft.shape[1]
+        p = n.zeros((nfibers, ntemps, npoly, num_z))
+        for ipos in range(npoly):
+            p[:,:,ipos] = ifft(t_fft[None,:,:] *
+                               poly_fft[:,None,ipos,:].conj())[...,zinds]
+
+    if coeffs is not None: a, b, p = basis_terms(a, b, p, coeffs)
+    return solve_zchi2(a, b, p, pmat_pol, bvec_pol, chi2_0, chi2_null,
+                       flag_val_neg_model)
+
+def zchi2_block_direct(templates, data, ivar, poly, pmat_pol, bvec_pol,
+                       chi2_0, chi2_null, zinds, flag_val_neg_model,
+                       templates2=None, coeffs=None):
+    """
+    Direct sum equivalent of zchi2_block: the correlations are computed as
+    sliding dot products at the lags zinds only, one matrix product per
+    lag, rather than through full length FFTs.  Cheaper when num_z is
+    small compared to the FFT length (narrow redshift windows).
+
+    templates has shape (ntemps, fftnaxis1) (zero padded, as for the FFTs;
+    lags wrap around it as the circular FFT correlation does), data
+    (flux*ivar) and ivar have shape (nfibers, npix), and poly (poly*ivar)
+    is None or has shape (nfibers, npoly, npix).  templates2 replaces
+    templates**2 in the ivar correlations if given; with coeffs, templates
+    and templates2 are a low rank basis as for zchi2_block.
+
+    Returns zchi2arr, zwarning, both of shape (nfibers, ntemps, num_z).
+    """
+    nfibers, npix = ivar.shape
+    ntemps, nfft = templates.shape
+    num_z = len(zinds)
+    npoly = poly.shape[1] if poly is not None else 0
+
+    # Template pixels spanned by the lags, wrapped as in the FFT path
+    wrap = n.arange(zinds[0], zinds[-1]+npix) % nfft
+    t = n.take(templates, wrap, axis=1)
+    t2 = t**2 if templates2 is None else n.take(templates2, wrap, axis=1)
+    # Terms correlated with the templates: data, then poly*ivar
+    x = data if poly is None else n.concatenate(
+            (data[:,None,:], poly), axis=1).reshape(-1, npix)
+
+    a = n.zeros((nfibers, t2.shape[0], num_z))
+    bp = n.zeros((nfibers, npoly+1, ntemps, num_z))
+    for iz, lag in enumerate(zinds - zinds[0]):
+        a[:,:,iz] = n.dot(ivar, t2[:,lag:lag+npix].T)
+        bp[...,iz] = n.dot(x, t[:,lag:lag+npix].T).reshape(nfibers, npoly+1,
+                                                           ntemps)
+    b = bp[:,0]
+    p = bp[:,1:].transpose(0,2,1,3) if poly is not None else None
+
+    if coeffs is not None: a, b, p = basis_terms(a, b, p, coeffs)
+    return solve_zchi2(a, b, p, pmat_pol, bvec_pol, chi2_0, chi2_null,
+                       flag_val_neg_model)
+
+def basis_terms(a, b, p, coeffs):
+    """
+    Reconstruct the template terms a, b and p of solve_zchi2 from those of
+    a low rank basis.  With templates ~ n.dot(c, basis) and templates**2 ~
+    n.dot(c2, basis2), coeffs = (c, c2), b and p (correlated with the
+    templates) are combined with c and a (with their squares) with c2.
+    """
+    c, c2 = coeffs
+    a = n.einsum('tk,fkz->ftz', c2, a)
+    b = n.einsum('tk,fkz->ftz', c, b)
+    if p is not None: p = n.einsum('tk,fkiz->ftiz', c, p)
+    return a, b, p
+
+def basis_error(templates, u, basis, lo, hi, npix, l1=False):
+    """
+    Relative errors of the rank r = 1, ..., len(basis) reconstructions
+    n.dot(u[:,:r], basis[:r]) of the padded (ntemps, nfft) templates.  For
+    each r, the largest over the templates and over every npix pixel
+    stretch of template pixels lo to hi-1 (wrapping around nfft) of the
+    root sum of squared errors over the root sum of squares of the
+    template or, if l1, of the sum of absolute errors over the sum of
+    absolute values.
+    """
+    idx = n.arange(lo, hi) % templates.shape[-1]
+    tw = n.take(templates, idx, axis=1)
+    bw = n.take(basis, idx, axis=1)
+    f = n.abs if l1 else n.square
+    def stretches(x):
+        # Sums of f(x) over every npix pixel stretch
+        c = n.zeros((x.shape[0], x.shape[1]+1))
+        n.cumsum(f(x), axis=1, out=c[:,1:])
+        return c[:,npix:] - c[:,:-npix]
+    norm = stretches(tw)
+    norm = n.where(norm > 0, norm, 1.)
+    err = tw.copy()
+    rel = n.zeros(len(basis))
+    for r in range(len(basis)):
+        err -= n.outer(u[:,r], bw[r])
+        rel[r] = n.max(stretches(err) / norm)
+    return rel if l1 else n.sqrt(rel)
 
-def zchi2_single_template_no_poly(j,t_fft, t2_fft, data_fft, ivar_fft, chi2_0, num_z, npixstep, zminpix, flag_val_neg_model) :
+def reduce_block(zchi2arr, zwarning):
+    """
+    Reduce the (nfibers, ntemps, num_z) chi2 and zwarning arrays of a block
+    to their values at the best template for each fiber and redshift.
+    Returns (zchi2min, argmin, zwarnmin), each of shape (nfibers, num_z),
+    with argmin the first template index attaining the minimum.
+    """
+    argmin = zchi2arr.argmin(axis=1)
+    zchi2min = n.take_along_axis(zchi2arr, argmin[:,None], axis=1)[:,0]
+    zwarnmin = n.take_along_axis(zwarning, argmin[:,None], axis=1)[:,0]
+    return zchi2min, argmin, zwarnmin
 
-    a = n.fft.ifft(t2_fft * ivar_fft.conj()).real
-    b = n.fft.ifft(t_fft * data_fft.conj()).real
+def refine_minima(bestzvec, ntop, spacing=1, margin=0.):
+    """
+    Indices of the minima of bestzvec, the minimum chi2 over templates at
+    each redshift, lowest first, found as ZFitter.z_refine2 finds its num_z
+    minima (those of a spline through bestzvec, dropping the ones less
+    than spacing points from one already taken): the ntop lowest, and any
+    further ones less than margin above the last of them.
+    """
+    zspline = gs.GridSpline(bestzvec)
+    kmin = n.round(zspline.get_min()).astype(int)
+    vals = zspline.get_val(kmin)
+    order = n.argsort(vals, kind='stable')
+    kmin, vals = kmin[order], vals[order]
+    taken = []
+    cutoff = -n.inf
+    while len(kmin) and (len(taken) < ntop or vals[0] < cutoff + margin):
+        taken.append(kmin[0])
+        if len(taken) <= ntop: cutoff = vals[0]
+        far = n.abs(kmin - kmin[0]) >= spacing
+        kmin, vals = kmin[far], vals[far]
+    return n.array(taken, dtype=int)
 
-    ii = zminpix+n.arange(num_z)*npixstep
-    f = (a[ii]!=0)*b[ii]/(a[ii]+(a[ii]==0))
-    zchi2arr = chi2_0 - a[ii]*f**2 # is this true ?????
+def refine_lags(kmin, nfine, width):
+    """
+    Lag indices of the nfine point grid within width pixels of kmin.
+    """
+    lags = (kmin[:,None] + n.arange(-width, width+1)).ravel()
+    return n.unique(lags[(lags >= 0) & (lags < nfine)])
 
-    zwarning=n.zeros((num_z))
-    zchi2arr[f<0] = chi2_0
-    zwarning[f<0] = flag_val_neg_model
-    return j,zchi2arr,zwarning
+def prune_templates(chi2, kmin, npixstep, width, threshold):
+    """
+    Indices of the templates worth refining within width pixels of the
+    coarse grid points kmin of one fiber, given its coarse chi2, of shape
+    (ntemps, num_z).  This is a heuristic, not a bound: in each window a
+    template's chi2 is estimated to dip at most the largest step between
+    its neighbouring coarse values below its lowest coarse value, and the
+    template is dropped if in every window this estimate exceeds the best
+    coarse chi2 of the window (an upper bound of the best chi2 there) by
+    more than threshold.  A template with a minimum sharper than the
+    coarse grid resolves can be dropped wrongly; its chi2 in the window
+    then stays interpolated from the coarse grid.
+    """
+    half = -(-width // npixstep)
+    keep = n.zeros(chi2.shape[0], dtype=bool)
+    for k in kmin:
+        win = chi2[:,max(k-half, 0):k+half+1]
+        bound = win.min(axis=1)
+        if win.shape[1] > 1: bound -= n.abs(n.diff(win, axis=1)).max(axis=1)
+        keep |= bound <= win.min() + threshold
+    return n.where(keep)[0]
 
+def coarse_to_fine(arr, npixstep, nfine, nearest=False):
+    """
+    Linearly interpolate arr, sampled along its last axis on a grid of step
+    npixstep, onto the nfine point grid of step 1 (holding the last value
+    beyond the last coarse point).  With nearest, take the value at the
+    coarse point at or below instead (for indices and flag bits).
+    """
+    pos = n.arange(nfine) / npixstep
+    k0 = n.minimum(n.floor(pos).astype(int), arr.shape[-1]-1)
+    if nearest: return arr[...,k0]
+    k1 = n.minimum(k0+1, arr.shape[-1]-1)
+    w = n.where(k1 > k0, pos - k0, 0.)
+    return arr[...,k0]*(1-w) + arr[...,k1]*w
+
+def use_direct(num_z, npix, fftnaxis1):
+    """
+    Cost model choosing between the direct sum and FFT correlators: the
+    direct sum costs num_z*npix multiply-adds per fiber, template and term
+    (done as BLAS matrix products), the FFT path an inverse transform of
+    length fftnaxis1 plus the spectral product.  The constant weighs the
+    relative throughput of the two measured on a BOSS plate.
+    """
+    return num_z * npix < 16 * fftnaxis1 * n.log2(fftnaxis1)
+
+
+def block_shape(nfibers, ntemps, nbins, maxmem):
+    """
+    Return the (fibers, templates) block shape for zchi2_block such that
+    the stacked complex FFT products of a block, with nbins frequency bins
+    per pair, stay below maxmem MB.  Templates are batched first, then
+    fibers.
+    """
+    # A product array and its inverse transform are alive at once
+    npairs = max(1, int(maxmem * 2**20 // (2 * 16 * nbins)))
+    ntemps_block = max(1, min(ntemps, npairs))
+    nfibers_block = max(1, min(nfibers, npairs // ntemps_block))
+    return nfibers_block, ntemps_block
 
 
 class ZFinder:
     def __init__(self, fname=None, group=[0], npoly=None, zmin=None, zmax=None,
-                 nproc=1):
+                 nproc=1, maxmem=256, rfft=True, correlator='auto',
+                 reduce=False, rank=None, rank_tol=2.33, backend='processes',
+                 chi2encoding=None):
         self.fname = fname
         if type(group) == list:
             self.group = group
@@ -98,8 +415,31 @@ class ZFinder:
         self.zmin = float(zmin)
         self.zmax = float(zmax)
         self.nproc = nproc
+        # Memory cap (MB) for the stacked FFT products of one fiber x
+        # template block in the batched zchi2 engine
+        self.maxmem = maxmem
+        # Correlate with real-to-complex FFTs (half the template FFT memory
+        # and transform work) rather than full complex FFTs
+        self.rfft = rfft
+        # 'fft', 'direct' (sliding dot products at the searched lags only)
+        # or 'auto' to pick by use_direct() for each zchi2 call
+        self.correlator = correlator
+        # Keep only the minimum chi2 over templates, and the template
+        # attaining it, at each redshift (see zchi2)
+        self.reduce = reduce
+        # Worker pool and shared memory blocks used when nproc > 1; the
+        # pool lives until close_pool() is called.  backend is 'processes'
+        # (arrays passed through shared memory) or 'threads' (arrays shared
+        # in place; FFTs and BLAS release the GIL)
+        self.backend = backend
+        self.pool = None
+        self.shm = {}
         self.pixoffset = None
         self.zchi2arr = None
+        self.zchi2argmin = None
+        # Encoding of chi2 files written with chi2file: None (float64) or
+        # 'float32'/'delta' tile compressed files (see io2.write_chi2)
+        self.chi2encoding = chi2encoding
 
         try:
             self.templatesdir = environ['REDMONSTER_TEMPLATES_DIR']
@@ -110,26 +450,111 @@ class ZFinder:
         self.read_template()
         self.npars = len(self.templates.shape) - 1
         self.templates_flat = n.reshape(self.templates, (-1,self.fftnaxis1))
-        self.t_fft = n.fft.fft(self.templates_flat)
-        self.t2_fft = n.fft.fft(self.templates_flat**2)
+        # Template FFTs of length nfft over the pixel window reachable from
+        # the data, loaded in zchi2 for each new (lo, hi, nfft) window
+        self.window = None
+        self.nfft = None
+        self.direct = False
+        self.t_fft = None
+        self.t2_fft = None
+        # Optional low rank basis for the correlations (see set_basis):
+        # rank is a fixed rank, or 'auto' to pick the ranks for each zchi2
+        # call from a chi2 error bound of rank_tol (see choose_rank).  The
+        # default rank_tol is a tenth of the 23.3 dchi2 threshold of
+        # ZFitter.  rank_error is the chi2 error measured by the last
+        # zchi2 call on a sample of spectra; beyond rank_tol they are
+        # refitted with the full template set for that call.  rank_used is
+        # the basis rank of the chi2 it returned, None for the full
+        # template set.
+        self.lowrank = rank
+        self.rank_tol = rank_tol
+        self.rank = None
+        self.rank_error = None
+        self.rank_used = None
+        self.rank_curves = None
+        if rank is not None:
+            self.svd = template_svd(join(self.templatesdir,self.fname))
         self.f_nulls = []
         self.chi2_null = []
         self.sn2_data = []
 
 
     def read_template(self):
+        # Padded templates come from the process-wide template registry,
+        # backed by the on-disk template cache (memory mapped) when
+        # available
         self.templates, self.baselines, self.infodict = \
-                read_ndArch(join(self.templatesdir,self.fname))
+                get_templates(join(self.templatesdir,self.fname))
         self.type = self.infodict['class']
-        self.origshape = self.templates.shape
+        self.fftnaxis1 = self.templates.shape[-1]
+        self.origshape = self.templates.shape[:-1] + (self.infodict['nwave'],)
         self.ntemps = self.templates[...,0].size
-        self.fftnaxis1 = two_pad(self.origshape[-1])
         self.tempwave = 10**(self.infodict['coeff0'] + \
                              n.arange(self.infodict['nwave']) * \
                              self.infodict['coeff1'])
-        templates_pad = n.zeros( self.origshape[:-1]+(self.fftnaxis1,) )
-        templates_pad[...,:self.origshape[-1]] = self.templates
-        self.templates = templates_pad
+
+
+    def set_basis(self, rank):
+        """
+        Correlate the data with the leading rank = (r, r2) vectors of the
+        singular value basis of the templates, and of the squared
+        templates, rather than with every template, or with the templates
+        themselves if rank is None.  The template terms of the fit are
+        reconstructed from the basis correlations, so the FFT work goes
+        with the rank instead of the number of templates.
+        """
+        self.release(['t_fft', 't2_fft', 'templates', 'templates2', 'coeffs',
+                      'coeffs2'])
+        self.window = None
+        self.rank = rank
+        if rank is None:
+            self.coeffs = self.coeffs2 = self.basis = self.basis2 = None
+            return
+        # The basis is that of the unit norm templates (chi2 does not
+        # depend on the template scale), rescaled in the coefficients
+        norm, u, s, vt, u2, s2, vt2 = self.svd
+        self.coeffs = norm[:,None] * u[:,:rank[0]]
+        self.coeffs2 = norm[:,None]**2 * u2[:,:rank[1]]
+        self.basis, self.basis2 = template_basis(
+                join(self.templatesdir,self.fname), rank)
+
+
+    def choose_rank(self, lo, hi, npix, sn2):
+        """
+        Basis ranks (r, r2) for spectra of npix pixels with
+        sum(flux**2*ivar) up to sn2, over template pixels lo to hi-1, or
+        None for the full template set.  Unless a fixed rank was given,
+        these are the smallest ranks whose chi2 error bound is within
+        rank_tol / 2 each.  With template t fitted at amplitude f, chi2 =
+        sn2 - b**2/a for b = sum(flux*ivar*t) and a = sum(ivar*t**2); an
+        error e in t changes b by up to sqrt(sn2*sum(ivar*e**2)), and
+        f**2*a <= sn2, so the chi2 error is about 2*sn2*|e|/|t| through b
+        (and likewise the polynomial terms) and sn2*sum|e2|/sum(t**2) for
+        an error e2 in t**2 through a, with the template norms over the
+        data pixels at each redshift (basis_error; unweighted, so not a
+        strict bound: zchi2 checks the actual error).
+        """
+        ntemps = self.templates_flat.shape[0]
+        if self.lowrank != 'auto':
+            r = max(1, min(int(self.lowrank), ntemps))
+            return (r, r)
+        if self.rank_curves is None or self.rank_curves[0] != (lo, hi, npix):
+            norm, u, s, vt, u2, s2, vt2 = self.svd
+            basis, basis2 = template_basis(
+                    join(self.templatesdir,self.fname), (len(s), len(s2)))
+            t = self.templates_flat / n.where(norm > 0, norm, 1.)[:,None]
+            self.rank_curves = ((lo, hi, npix),
+                                basis_error(t, u, basis, lo, hi, npix),
+                                basis_error(t**2, u2, basis2, lo, hi, npix,
+                                            True))
+        key, rel, rel2 = self.rank_curves
+        rank = []
+        for bound in (2 * sn2 * rel, sn2 * rel2):
+            ok = n.where(bound <= self.rank_tol / 2.)[0]
+            rank.append(int(ok[0]) + 1 if len(ok) else len(bound))
+        print("INFO %s: rank %d/%d basis for the templates, %d/%d for their squares, within a chi2 error bound of %g for sum(flux**2*ivar) up to %g" % (self.fname, rank[0], len(rel), rank[1], len(rel2), self.rank_tol, sn2))
+        if min(rank) >= ntemps: return None
+        return tuple(rank)
 
 
     def create_z_baseline(self, loglam0):
@@ -145,133 +570,472 @@ class ZFinder:
 
 
     def zchi2(self, specs, specloglam, ivar, npixstep=1, chi2file=False,
-              plate=None, mjd=None, fiberid=None):
+              plate=None, mjd=None, fiberid=None, refine=False, ntop=5,
+              width=15, prune=False, threshold=23.3):
+        # With refine and npixstep > 1, chi2 is first computed every
+        # npixstep pixels, then interpolated onto the npixstep=1 grid and
+        # recomputed exactly within width pixels of the ntop lowest minima
+        # of each fiber at least width pixels apart (as ZFitter.z_refine2
+        # takes num_z = ntop minima), until those minima are all refined;
+        # the output is on the npixstep=1 grid.
+        # With prune as well, only the templates estimated from their
+        # coarse chi2 to come within threshold of the best chi2 in a window
+        # are recomputed there (prune_templates, a heuristic; needs the
+        # full chi2 array, so not in reduced mode)
         self.chi2file = chi2file
         self.npixstep = npixstep
+        self.rank_error = None
+        self.rank_used = None
         self.zwarning = n.zeros(specs.shape[0])
+        self.f_nulls = []
+        self.chi2_null = []
+        self.sn2_data = []
         flag_val_unplugged = int('0b10000000',2)
         flag_val_neg_model = int('0b1000',2)
+        refine = refine and npixstep > 1
         self.create_z_baseline(specloglam[0])
         if (self.zmin != None) and (self.zmax != None) and \
                 (self.zmax > self.zmin):
 
             zminpix, zmaxpix = self.conv_zbounds()
             self.pixoffset = zminpix
+            zspan = zmaxpix - zminpix
             num_z = int(n.floor( (zmaxpix - zminpix) / npixstep ))
             zinds = zminpix + n.arange(num_z)*npixstep
             self.zbase = self.zbase[zinds]
         else:
             zminpix = 0
+            zspan = self.origshape[-1] - specs.shape[-1]
             # Number of pixels to be fitted in redshift
-            num_z = int(n.floor( (zself.origshape[-1] - specs.shape[-1]) /
-                                npixstep ))
+            num_z = int(n.floor( zspan / npixstep ))
+            zinds = zminpix + n.arange(num_z)*npixstep
 
         # Create arrays for use in routine
         # Create chi2 array of shape (# of fibers, template_parameter_1,
-        # ..., template_parameter_N, # of redshifts)
-        zchi2arr = n.zeros((specs.shape[0], self.templates_flat.shape[0],
-                            num_z))
-        temp_zwarning = n.zeros(zchi2arr.shape)
+        # ..., template_parameter_N, # of redshifts), or in reduced mode
+        # the running minimum over templates, the template attaining it
+        # and its zwarning bits, of shape (# of fibers, # of redshifts).
+        # The full array is always kept if it is to be written out.
+        reduce = self.reduce and not chi2file
+        if reduce:
+            zchi2min = n.zeros((specs.shape[0], num_z))
+            zargmin = n.zeros((specs.shape[0], num_z), dtype=int)
+            zwarnmin = n.zeros((specs.shape[0], num_z))
+        else:
+            zchi2arr = n.zeros((specs.shape[0], self.templates_flat.shape[0],
+                                num_z))
+            temp_zwarning = n.zeros(zchi2arr.shape)
 
-        # Pad data and SSPs to a power of 2 for faster FFTs
-        data_pad = n.zeros(specs.shape[:-1] + (self.fftnaxis1,), dtype=float)
+        # Only template pixels lo to hi-1 can overlap the data over the
+        # trial redshifts; the FFT length is set by this window rather
+        # than by the full template length, and any length >= hi - lo
+        # keeps the lags free of circular wrap-around.  With refine the
+        # window covers the npixstep=1 grid of the second pass.  The
+        # window is widened to the template cache grid (fft_window).
+        lo, hi, self.nfft = fft_window(zinds[0], (zinds[0] + zspan - 1 if
+                                                  refine else zinds[-1]) +
+                                       specs.shape[-1])
+
+        # Pad data and SSPs to a 2/3/5-smooth length for faster FFTs
+        data_pad = n.zeros(specs.shape[:-1] + (self.nfft,), dtype=float)
         data_pad[...,:specs.shape[-1]] = specs
-        ivar_pad = n.zeros(ivar.shape[:-1] + (self.fftnaxis1,), dtype=float)
+        ivar_pad = n.zeros(ivar.shape[:-1] + (self.nfft,), dtype=float)
         ivar_pad[...,:specs.shape[-1]] = ivar
 
+        if self.lowrank is not None:
+            # Basis ranks for this window and the brightest spectrum
+            rank = self.choose_rank(lo, hi, specs.shape[-1],
+                                    n.max(n.sum(specs**2 * ivar, axis=1)))
+            if rank != self.rank: self.set_basis(rank)
+
+        if self.correlator == 'auto':
+            direct = use_direct(num_z, specs.shape[-1], self.nfft)
+        else:
+            direct = self.correlator == 'direct'
+        self.direct = direct
+        if direct:
+            lag0 = 0
+        else:
+            # FFT correlation lags are relative to the template window
+            lag0 = lo
+            if self.window != (lo, hi, self.nfft):
+                self.release(['t_fft', 't2_fft'])
+                self.t_fft, self.t2_fft = template_fft(
+                        join(self.templatesdir,self.fname), self.nfft,
+                        self.rfft, (lo, hi), self.rank)
+                self.window = (lo, hi, self.nfft)
+        zlags = zinds - lag0
+
         # Pre-compute FFTs for use in convolutions
-        data_fft = n.fft.fft(data_pad * ivar_pad)
-        ivar_fft = n.fft.fft(ivar_pad)
+        if self.rfft:
+            fft = n.fft.rfft
+            nfft = self.nfft
+        else:
+            fft = n.fft.fft
+            nfft = None
+        if not direct:
+            data_fft = fft(data_pad * ivar_pad)
+            ivar_fft = fft(ivar_pad)
 
         if self.npoly>0 :
             # Compute poly terms, noting that they will stay fixed with
             # the data - assumes data is passed in as shape (nfibers, npix)
             polyarr = poly_array(self.npoly, specs.shape[1])
-            pmat = n.zeros( (self.npoly+1, self.npoly+1, self.fftnaxis1),
-                            dtype=float)
-            bvec = n.zeros( (self.npoly+1, self.fftnaxis1), dtype=float)
-
-            # Pad to a power of 2 for faster FFTs
-            poly_pad = n.zeros((self.npoly, self.fftnaxis1), dtype=float)
-            poly_pad[...,:polyarr.shape[-1]] = polyarr
 
             # Pre-compute FFTs for use in convolutions
-            poly_fft = n.zeros((ivar_pad.shape[0], self.npoly, self.fftnaxis1),dtype=complex)
-            for i in range(self.npoly):
-                poly_fft[:,i,:] = n.fft.fft(poly_pad[i] * ivar_pad)
+            if direct:
+                poly_ivar = polyarr[None,:,:] * ivar[:,None,:]
+            else:
+                # Pad to the FFT length
+                poly_pad = n.zeros((self.npoly, self.nfft), dtype=float)
+                poly_pad[...,:polyarr.shape[-1]] = polyarr
+                poly_fft = n.zeros((ivar_pad.shape[0], self.npoly, ivar_fft.shape[-1]),dtype=complex)
+                for i in range(self.npoly):
+                    poly_fft[:,i,:] = fft(poly_pad[i] * ivar_pad)
 
+        # Compute z for all fibers
 
+        # If flux is all zeros, flag as unplugged according to BOSS
+        # zwarning flags and don't bother with doing fit
+        plugged = n.any(specs != 0., axis=1)
+        ifibers = n.where(plugged)[0]
+        self.zwarning[~plugged] = self.zwarning[~plugged].astype(int) | \
+                flag_val_unplugged
+        # sn2_data, chi2_null and f_nulls are kept aligned with fibers, zero
+        # for unplugged ones
+        sn2_data = n.where(plugged, n.sum(specs**2 * ivar, axis=1), 0.)
+        f_nulls = n.zeros((specs.shape[0], self.npoly))
+        if self.npoly>0 :
+            # pmat_pol and bvec_pol hold the lag independent polynomial
+            # blocks of the normal equations for each fiber, as one matrix
+            # product over all fibers each, with the polynomial null fit
+            # f_null solved for all fibers at once
+            pmat_pol = n.zeros( (specs.shape[0], self.npoly+1, self.npoly+1),
+                                dtype=float)
+            bvec_pol = n.zeros( (specs.shape[0], self.npoly+1), dtype=float)
+            polyprod = polyarr[:,None,:] * polyarr[None,:,:]
+            pmat_pol[ifibers,1:,1:] = n.dot(ivar[ifibers], n.reshape(
+                    polyprod, (-1,specs.shape[-1])).T).reshape(
+                            -1, self.npoly, self.npoly)
+            bvec_pol[ifibers,1:] = n.dot(specs[ifibers] * ivar[ifibers],
+                                         polyarr.T)
+            f_nulls[ifibers] = n.linalg.solve(pmat_pol[ifibers,1:,1:],
+                                              bvec_pol[ifibers,1:,None])[...,0]
+            chi2_null = sn2_data - n.einsum('fi,fij,fj->f', f_nulls,
+                                            pmat_pol[:,1:,1:], f_nulls)
+        else :
+            chi2_null = sn2_data.copy()
+        self.sn2_data = list(sn2_data)
+        self.chi2_null = list(chi2_null)
+        self.f_nulls = list(f_nulls)
+        if reduce: zchi2min[ifibers] = n.inf
+        chi2_0 = sn2_data
+        ntemps = self.templates_flat.shape[0]
+        nproc = self.nproc if shared_memory is not None or \
+                self.backend == 'threads' else 1
 
+        def blocking(nfib, nlags, maxmem):
+            # Block shape for nfib fibers at nlags lags within maxmem MB
+            nbins = nlags * (self.npoly+2) / 4. if direct else \
+                    self.t_fft.shape[-1]
+            if self.rank is None:
+                return block_shape(nfib, ntemps, nbins, maxmem)
+            # Low rank basis: the basis correlations and the template terms
+            # reconstructed from them, for all templates in one block
+            nbins = max(self.rank) * nbins + ntemps * nlags * \
+                    (self.npoly+2) / 4.
+            return block_shape(nfib, 1, nbins, maxmem)[0], ntemps
 
+        def fit_block(ii, jj, lags):
+            # chi2 and zwarning of fibers ii against templates jj (a slice
+            # or index array) at lags
+            if self.npoly>0 :
+                pm, bv = pmat_pol[ii], bvec_pol[ii]
+                poly_ii = poly_ivar[ii] if direct else poly_fft[ii]
+            else :
+                pm, bv, poly_ii = None, None, None
+            if self.rank is None:
+                tj, coeffs = jj, None
+            else:
+                tj, coeffs = slice(None), (self.coeffs[jj], self.coeffs2[jj])
+            if direct:
+                return zchi2_block_direct(
+                        self.templates_flat[tj] if self.rank is None else
+                        self.basis, specs[ii]*ivar[ii], ivar[ii], poly_ii, pm,
+                        bv, chi2_0[ii], chi2_null[ii], lags,
+                        flag_val_neg_model, None if self.rank is None else
+                        self.basis2, coeffs)
+            return zchi2_block(self.t_fft[tj], self.t2_fft[tj], data_fft[ii],
+                               ivar_fft[ii], poly_ii, pm, bv, chi2_0[ii],
+                               chi2_null[ii], lags, flag_val_neg_model, nfft,
+                               coeffs)
 
-        # Compute z for all fibers
+        # Blocks of fibers against blocks of templates, with the block size
+        # set by self.maxmem (shared between the workers when nproc > 1)
+        nfib_block, ntemp_block = blocking(len(ifibers), num_z,
+                                           self.maxmem / nproc)
+        nfib_blocks = -(-len(ifibers) // nfib_block)
+        if 0 < nfib_blocks < nproc:
+            # Split the templates so that every worker gets a task
+            ntemp_block = max(1, min(ntemp_block,
+                                     -(-ntemps * nfib_blocks // nproc)))
+        blocks = [(ifibers[ib:ib+nfib_block], jb, min(jb+ntemp_block, ntemps))
+                  for ib in range(0, len(ifibers), nfib_block)
+                  for jb in range(0, ntemps, ntemp_block)]
 
-        for i in range(specs.shape[0]): # Loop over fibers
+        # Template and plate arrays for the chosen correlator
+        if direct:
+            if self.rank is None:
+                temp_arrs = [('templates', self.templates_flat)]
+            else:
+                temp_arrs = [('templates', self.basis),
+                             ('templates2', self.basis2)]
+            plate_arrs = [('data', specs*ivar), ('ivar', ivar)]
+            if self.npoly>0 : plate_arrs.append( ('poly', poly_ivar) )
+        else:
+            temp_arrs = [('t_fft', self.t_fft), ('t2_fft', self.t2_fft)]
+            plate_arrs = [('data_fft', data_fft), ('ivar_fft', ivar_fft)]
+            if self.npoly>0 : plate_arrs.append( ('poly_fft', poly_fft) )
+        if self.rank is not None:
+            temp_arrs += [('coeffs', self.coeffs), ('coeffs2', self.coeffs2)]
+        plate_arrs += [('chi2_0', chi2_0), ('chi2_null', chi2_null),
+                       ('zinds', zlags)]
+        if self.npoly>0 :
+            plate_arrs += [('pmat_pol', pmat_pol), ('bvec_pol', bvec_pol)]
+
+        def merge_block(ii, j0, bmin, bargmin, bwarn, lags=None):
+            # Fold a reduced block for templates j0:... (at redshift
+            # indices lags, or all of them) into the running minima; blocks
+            # arrive in template order, so ties keep the first template as
+            # in the full array
+            if lags is not None: ii = n.ix_(ii, lags)
+            better = bmin < zchi2min[ii]
+            zchi2min[ii] = n.where(better, bmin, zchi2min[ii])
+            zargmin[ii] = n.where(better, bargmin + j0, zargmin[ii])
+            zwarnmin[ii] = n.where(better, bwarn, zwarnmin[ii])
 
+        if nproc > 1 and len(blocks) > 0 and self.backend == 'threads':
+            # Thread pool working on the in-memory arrays; full chi2 blocks
+            # are written in place (blocks do not overlap), reduced ones
+            # are returned and merged in block order
             start=time.time()
+            self.start_pool()
+            def fit_task(block):
+                ii, j0, j1 = block
+                chi2, zw = fit_block(ii, slice(j0, j1), zlags)
+                if reduce: return reduce_block(chi2, zw)
+                zchi2arr[ii,j0:j1], temp_zwarning[ii,j0:j1] = chi2, zw
+            with blas_threads(1):
+                results = self.pool.map(fit_task, blocks)
+            if reduce:
+                for (ii, j0, j1), result in zip(blocks, results):
+                    merge_block(ii, j0, *result)
+            stop=time.time()
 
-            #print 'INFO Fitting fiber %s of %s for template %s' % \
-            #        (i+1, specs.shape[0], self.fname)
-
-            # If flux is all zeros, flag as unplugged according to BOSS
-            # zwarning flags and don't bother with doing fit
-            if len(n.where(specs[i] != 0.)[0]) == 0:
-                self.zwarning[i] = int(self.zwarning[i]) | flag_val_unplugged
-            else: # Otherwise, go ahead and do fit
-
-                self.sn2_data.append (n.sum( (specs[i]**2)*ivar[i] ) )
-
-                if self.npoly>0 :
-                    for ipos in range(self.npoly):
-                        bvec[ipos+1] = n.sum( poly_pad[ipos] * data_pad[i] *
-                                              ivar_pad[i])
-                    for ipos in range(self.npoly):
-                        for jpos in range(self.npoly):
-                            pmat[ipos+1,jpos+1] = n.sum( poly_pad[ipos] *
-                                                         poly_pad[jpos] *ivar_pad[i]) # CAN GO FASTER HERE (BUT NOT LIMITING = 0.001475
-
-                    f_null = linalg.solve(pmat[1:,1:,0],bvec[1:,0])
-                    self.f_nulls.append( f_null )
-                    self.chi2_null.append( self.sn2_data[i] -
-                                           n.dot(n.dot(f_null,pmat[1:,1:,0]),f_null))
-                else :
-                    self.chi2_null.append( self.sn2_data[i] )
-                # print 'INFO Chi^2_null value is %s' % self.chi2_null[i]
-                # Loop over templates
-                # multiprocessing
-
-                func_args = []
-                for j in range(self.templates_flat.shape[0]):
-                    if self.npoly>0 :
-                        arguments = {"j":j,"poly_fft":poly_fft[i], "t_fft":self.t_fft[j], "t2_fft":self.t2_fft[j], "data_fft":data_fft[i], "ivar_fft":ivar_fft[i], "pmat_pol":pmat, "bvec_pol":bvec, "chi2_0":self.sn2_data[i], "chi2_null":self.chi2_null[i],"num_z":num_z, "npixstep":self.npixstep, "zminpix":zminpix,"flag_val_neg_model":flag_val_neg_model}
-                    else :
-                        arguments = {"j":j,"t_fft":self.t_fft[j], "t2_fft":self.t2_fft[j], "data_fft":data_fft[i], "ivar_fft":ivar_fft[i], "chi2_0":self.sn2_data[i], "num_z":num_z, "npixstep":self.npixstep, "zminpix":zminpix, "flag_val_neg_model":flag_val_neg_model}
-                    func_args.append(arguments)
-
-                results = None
-                if self.nproc > 1:
-                    pool = multiprocessing.Pool(self.nproc)
-                    if self.npoly>0 :
-                        results = pool.map(_zchi2, func_args)
-                    else :
-                        results = pool.map(_zchi2_no_poly, func_args)
-                    pool.close()
-                    pool.join()
+            print("INFO fitted %d spectra, %d templates in %s, npoly=%d, in %d blocks of %dx%d using %d threads (%s) in %f sec"%(len(ifibers),ntemps,self.fname,self.npoly,len(blocks),nfib_block,ntemp_block,nproc,'direct' if direct else 'fft',stop-start))
+        elif nproc > 1 and len(blocks) > 0:
+            # Persistent worker pool; tasks carry only fiber and template
+            # indices, the arrays are read from shared memory.  Template
+            # arrays stay shared for the life of the pool.
+            start=time.time()
+            self.start_pool()
+            layout = {}
+            for key, arr in temp_arrs:
+                layout[key] = self.shm[key][1] if key in self.shm else \
+                        self.share(key, arr)
+            if not reduce:
+                plate_arrs += [('zchi2arr', zchi2arr),
+                               ('zwarning', temp_zwarning)]
+            for key, arr in plate_arrs:
+                layout[key] = self.share(key, arr)
+            results = self.pool.map(_zchi2_shared, [(layout, ii, j0, j1,
+                                                     flag_val_neg_model, nfft,
+                                                     reduce)
+                                                    for ii, j0, j1 in blocks])
+            if reduce:
+                for (ii, j0, j1), result in zip(blocks, results):
+                    merge_block(ii, j0, *result)
+            else:
+                zchi2arr = self.shm['zchi2arr'][2].copy()
+                temp_zwarning = self.shm['zwarning'][2].copy()
+            self.release(list(layout.keys()),
+                         keep=[key for key, arr in temp_arrs])
+            stop=time.time()
+
+            print("INFO fitted %d spectra, %d templates in %s, npoly=%d, in %d blocks of %dx%d using %d procs (%s) in %f sec"%(len(ifibers),ntemps,self.fname,self.npoly,len(blocks),nfib_block,ntemp_block,nproc,'direct' if direct else 'fft',stop-start))
+        else:
+            start=time.time()
+            for ii, j0, j1 in blocks:
+                jj = slice(j0, j1)
+                chi2, zw = fit_block(ii, jj, zlags)
+                if reduce:
+                    merge_block(ii, j0, *reduce_block(chi2, zw))
                 else:
-                    if self.npoly>0 :
-                        results = [ _zchi2(x) for x in func_args ]
-                    else :
-                        results = [ _zchi2_no_poly(x) for x in func_args ]
+                    zchi2arr[ii,jj], temp_zwarning[ii,jj] = chi2, zw
+                if j1 == ntemps:
+                    stop=time.time()
+                    print("INFO fitted spectra %d-%d/%d, %d templates in %s, npoly=%d, in blocks of %dx%d (%s) in %f sec"%(ii[0]+1, ii[-1]+1, specs.shape[0],ntemps,self.fname,self.npoly,nfib_block,ntemp_block,'direct' if direct else 'fft',stop-start))
+                    start=time.time()
 
-                for result in results :
-                    j                  = result[0]
-                    zchi2arr[i,j]      = result[1]
-                    temp_zwarning[i,j] = result[2]
 
-                stop=time.time()
+        if self.rank is not None and len(ifibers):
+            # Low rank chi2 error, against exact direct sums for the 8
+            # spectra of highest S/N (where the error is largest) and 8
+            # spread over the plate, at 32 of the searched redshifts and at
+            # the chi2 minimum of each
+            i = n.unique(n.concatenate((
+                    ifibers[n.argsort(sn2_data[ifibers])[::-1][:8]],
+                    ifibers[n.linspace(0, len(ifibers)-1,
+                                       min(len(ifibers), 8)).astype(int)])))
+            best = (zchi2min[i] if reduce else
+                    zchi2arr[i].min(axis=1)).argmin(axis=-1)
+            k = n.unique(n.concatenate((n.linspace(0, num_z-1,
+                                                   min(num_z, 32)).astype(int),
+                                        best)))
+            exact = zchi2_block_direct(
+                    self.templates_flat, specs[i]*ivar[i], ivar[i],
+                    polyarr[None,:,:]*ivar[i][:,None,:] if self.npoly>0 else
+                    None, pmat_pol[i] if self.npoly>0 else None,
+                    bvec_pol[i] if self.npoly>0 else None, chi2_0[i],
+                    chi2_null[i], zinds[k], flag_val_neg_model)[0]
+            if reduce:
+                self.rank_error = n.abs(zchi2min[i][:,k] -
+                                        exact.min(axis=1)).max()
+            else:
+                self.rank_error = n.abs(zchi2arr[i][:,:,k] - exact).max()
+            print("INFO rank %d/%d basis chi2 error for %d spectra at %d redshifts: max |dchi2| = %g, tolerance %g" % (self.rank[0], self.rank[1], len(i), len(k), self.rank_error, self.rank_tol))
+            if self.rank_error > self.rank_tol:
+                print("WARNING rank %d/%d basis chi2 error %g exceeds %g in %s: refitting with the full template set" % (self.rank[0], self.rank[1], self.rank_error, self.rank_tol, self.fname))
+                # For this call only: the next one picks its ranks again
+                rank_error, lowrank = self.rank_error, self.lowrank
+                self.lowrank = None
+                self.set_basis(None)
+                try:
+                    self.zchi2(specs, specloglam, ivar, npixstep, chi2file,
+                               plate, mjd, fiberid, refine, ntop, width,
+                               prune, threshold)
+                finally:
+                    self.lowrank = lowrank
+                self.rank_error = rank_error
+                return
+        self.rank_used = self.rank
 
-                print("INFO fitted spectrum %d/%d, chi2_null=%f, %d templates in %s, npoly=%d, using %d procs in %f sec"%(i+1, specs.shape[0],self.chi2_null[i],self.templates_flat.shape[0],self.fname,self.npoly,self.nproc,stop-start))
+        if refine:
+            # Second pass on the npixstep=1 grid: the coarse chi2 is
+            # interpolated onto it, then recomputed around the coarse minima
+            # of each fiber with the same correlator as the first pass.
+            # The FFT path correlates all lags at once and goes fiber by
+            # fiber; the direct path batches the fibers over the union of
+            # their windows.
+            start=time.time()
+            nfine = int(zspan)
+            if prune and reduce:
+                print("INFO Not pruning templates with reduced chi2 arrays")
+            prune = prune and not reduce
+            if reduce:
+                bestzvecs = zchi2min.copy()
+                zchi2min = coarse_to_fine(zchi2min, npixstep, nfine)
+                zargmin = coarse_to_fine(zargmin, npixstep, nfine, True)
+                zwarnmin = coarse_to_fine(zwarnmin, npixstep, nfine, True)
+            else:
+                bestzvecs = zchi2arr.min(axis=1)
+                coarse = zchi2arr
+                zchi2arr = coarse_to_fine(zchi2arr, npixstep, nfine)
+                temp_zwarning = coarse_to_fine(temp_zwarning, npixstep, nfine,
+                                               True)
+            zinds = zinds[0] + n.arange(nfine)
+            def bestzvec(k):
+                # Current npixstep=1 minimum over templates of fiber
+                # ifibers[k]
+                return zchi2min[ifibers[k]] if reduce else \
+                        zchi2arr[ifibers[k]].min(axis=0)
+            # The minima to refine are those ZFitter.z_refine2 would take,
+            # first on the coarse grid.  Once refined, a window may hold a
+            # lower minimum than its coarse points showed; the minima are
+            # taken again on the refined chi2, along with any others within
+            # the largest such dip of the last of them, until all their
+            # windows are refined.  The ends of the grid are always
+            # refined, as the coarse spline cannot show minima there.
+            centers = [n.r_[0, refine_minima(bestzvecs[i], ntop,
+                                             width / npixstep) * npixstep,
+                            nfine-1] for i in ifibers]
+            refined = n.zeros((len(ifibers), nfine), dtype=bool)
+            dip = n.zeros(len(ifibers))
+            nlags = 0
+            npairs = 0
+            nfits = 0
+            npasses = 0
+            while True:
+                fiblags = [refine_lags(kmin, nfine, width)
+                           for kmin in centers]
+                fiblags = [lags[~refined[k,lags]]
+                           for k, lags in enumerate(fiblags)]
+                todo = n.array([k for k, lags in enumerate(fiblags)
+                                if len(lags)], dtype=int)
+                if not len(todo): break
+                npasses += 1
+                if prune:
+                    fibtemps = [prune_templates(coarse[ifibers[k]],
+                                                n.round(centers[k] /
+                                                        npixstep).astype(int),
+                                                npixstep, width, threshold)
+                                for k in todo]
+                else:
+                    fibtemps = [n.arange(ntemps)] * len(todo)
+                before = [bestzvec(k)[fiblags[k]] for k in todo]
+                union = n.unique(n.concatenate([fiblags[k] for k in todo]))
+                if direct and len(todo) * len(union) <= \
+                        2 * sum([len(fiblags[k]) for k in todo]):
+                    groups = [(ifibers[todo], union,
+                               n.unique(n.concatenate(fibtemps)))]
+                else:
+                    groups = [(ifibers[k:k+1], fiblags[k], temps)
+                              for k, temps in zip(todo, fibtemps)]
+                for ig, lags, temps in groups:
+                    nlags += len(ig) * len(lags)
+                    npairs += len(ig) * len(temps)
+                    nfits += len(ig)
+                    nfib_block, ntemp_block = blocking(len(ig), len(lags),
+                                                       self.maxmem)
+                    for ib in range(0, len(ig), nfib_block):
+                        ii = ig[ib:ib+nfib_block]
+                        if reduce: zchi2min[n.ix_(ii, lags)] = n.inf
+                        for j0 in range(0, len(temps), ntemp_block):
+                            tj = temps[j0:j0+ntemp_block]
+                            chi2, zw = fit_block(ii, tj, zinds[lags] - lag0)
+                            if reduce:
+                                bmin, bargmin, bwarn = reduce_block(chi2, zw)
+                                merge_block(ii, 0, bmin, tj[bargmin], bwarn,
+                                            lags=lags)
+                            else:
+                                idx = n.ix_(ii, tj, lags)
+                                zchi2arr[idx], temp_zwarning[idx] = chi2, zw
+                for k, old in zip(todo, before):
+                    refined[k,fiblags[k]] = True
+                    best = bestzvec(k)
+                    dip[k] = max(dip[k], (old - best[fiblags[k]]).max())
+                    centers[k] = refine_minima(best, ntop, width, dip[k])
+            num_z = nfine
+            self.npixstep = 1
+            self.zbase = ((10**specloglam[0])/self.tempwave[zinds]) - 1
+            stop=time.time()
+            print("INFO refined %d spectra in %s at %d of %d redshifts and %d of %d templates per spectrum in %d passes (%s) in %f sec"%(len(ifibers),self.fname,nlags//max(len(ifibers),1),nfine,npairs//max(nfits,1),ntemps,npasses,'direct' if direct else 'fft',stop-start))
 
+        if reduce:
+            # Use only neg_model flag from best fit model/redshift, taking
+            # the first template then the first redshift among equal minima
+            # as for the full array below
+            for i in range(self.zwarning.shape[0]):
+                iz = n.where(zchi2min[i] == n.min(zchi2min[i]))[0]
+                iz = iz[n.lexsort((iz, zargmin[i,iz]))[0]]
+                self.zwarning[i] = int(self.zwarning[i]) | \
+                        int(zwarnmin[i,iz])
+            self.zchi2arr = zchi2min
+            self.zchi2argmin = n.stack(n.unravel_index(zargmin,
+                                                       self.origshape[:-1]),
+                                       axis=-1)
+            print('INFO Not writing chi2')
+            return
 
         # Use only neg_model flag from best fit model/redshift and add
         # it to self.zwarning
@@ -287,75 +1051,92 @@ class ZFinder:
 
         #return zchi2arr
         self.zchi2arr = zchi2arr
+        self.zchi2argmin = None
         #self.store_models(specs, ivar)
         if self.chi2file is True:
             if (plate is not None) & (mjd is not None) & (fiberid is not None):
-                write_chi2arr(plate, mjd, fiberid, self.zchi2arr)
+                write_chi2arr(plate, mjd, fiberid, self.zchi2arr, self.type,
+                              self.zbase, self.chi2encoding)
             else:
                 print('WARNING Plate/mjd/fiberid not given - unable to write chi2 file!')
         else:
             print('INFO Not writing chi2')
 
+    def start_pool(self):
+        """Start the worker pool, if not already running."""
+        if self.pool is None and self.backend == 'threads':
+            self.pool = ThreadPool(self.nproc)
+        elif self.pool is None:
+            # Workers must inherit the parent's resource tracker, or they
+            # start their own and unlink the shared blocks on exit
+            resource_tracker.ensure_running()
+            self.pool = multiprocessing.Pool(self.nproc,
+                                             initializer=_init_worker)
+
+    def close_pool(self):
+        """Shut down the worker pool and free all shared memory blocks."""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.release(list(self.shm.keys()))
+
+    def share(self, key, arr):
+        """
+        Copy arr into a new shared memory block stored under key and return
+        its (name, shape, dtype) layout entry.
+        """
+        self.release([key])
+        arr = n.ascontiguousarray(arr)
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        view = n.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+        view[...] = arr
+        self.shm[key] = (shm, (shm.name, arr.shape, arr.dtype.str), view)
+        return self.shm[key][1]
+
+    def release(self, keys, keep=[]):
+        """Free the shared memory blocks stored under keys, except keep."""
+        for key in keys:
+            if key in self.shm and key not in keep:
+                shm = self.shm.pop(key)[0]
+                shm.close()
+                shm.unlink()
+
     def store_models(self, specs, ivar):
-        self.models = n.zeros( (specs.shape) )
-        for i in range(self.models.shape[0]):
-            minloc = n.unravel_index( self.zchi2arr[i].argmin(),
-                                     self.zchi2arr[i].shape )
-            pmat = n.zeros( (specs.shape[-1],self.npoly+1) )
-            this_temp = self.templates[minloc[:-1]]
-            pmat[:,0] = this_temp[(minloc[-1]*self.npixstep) +
-                                  self.pixoffset:(minloc[-1]*self.npixstep) +
-                                  self.pixoffset+specs.shape[-1]]
-            polyarr = poly_array(self.npoly, specs.shape[-1])
-            pmat[:,1:] = n.transpose(polyarr)
-            ninv = n.diag(ivar[i])
-            try: # Some eBOSS spectra have ivar[i] = 0 for all i
-                '''
-                f = linalg.solve( n.dot(n.dot(n.transpose(pmat),ninv),pmat),
-                                n.dot( n.dot(n.transpose(pmat),ninv),specs[i]) )
-                '''
-                f = nnls( n.dot(n.dot(n.transpose(pmat),ninv),pmat),
-                         n.dot( n.dot(n.transpose(pmat),ninv),specs[i]) );\
-                                f = n.array(f)[0]
-                self.models[i] = n.dot(pmat, f)
-            except Exception as e:
-                self.models[i] = n.zeros(specs.shape[-1])
-                print("Exception: %r" % r)
+        # Best fit model of every fiber, with a nonnegative template
+        # amplitude, solving blocks of fibers at once with nnls_normal on
+        # the ivar weighted columns of pmat, within maxmem MB
+        nfibers, npix = specs.shape
+        self.models = n.zeros( (nfibers,npix) )
+        polyarr = n.transpose(poly_array(self.npoly, npix))
+        nonneg = n.arange(self.npoly+1) == 0
+        nblock = max(1, int(self.maxmem * 2**20 //
+                            (16 * npix * (self.npoly+1))))
+        for i0 in range(0, nfibers, nblock):
+            ii = n.arange(i0, min(i0+nblock, nfibers))
+            pmat = n.zeros( (len(ii),npix,self.npoly+1) )
+            for k, i in enumerate(ii):
+                if self.zchi2argmin is None:
+                    minloc = n.unravel_index( self.zchi2arr[i].argmin(),
+                                             self.zchi2arr[i].shape )
+                    zidx, tidx = minloc[-1], minloc[:-1]
+                else:
+                    # Reduced chi2: the best template at each redshift is
+                    # in zchi2argmin
+                    zidx = self.zchi2arr[i].argmin()
+                    tidx = tuple(self.zchi2argmin[i,zidx])
+                lo = zidx*self.npixstep + self.pixoffset
+                pmat[k,:,0] = self.templates[tidx][lo:lo+npix]
+            pmat[:,:,1:] = polyarr
+            pmat_ivar = n.transpose(pmat, (0,2,1)) * ivar[ii][:,None,:]
+            M = n.matmul(pmat_ivar, pmat)
+            v = n.matmul(pmat_ivar, specs[ii][:,:,None])[:,:,0]
+            # Some eBOSS spectra have ivar[i] = 0 for all i; nnls_normal
+            # gives them zero models
+            f = nnls_normal(M, v, nonneg)
+            self.models[ii] = n.matmul(pmat, f[:,:,None])[:,:,0]
 
 
     def write_chi2arr(self, plate, mjd, fiberid):
-        prihdu = fits.PrimaryHDU(self.zchi2arr)
-        thdulist = fits.HDUList([prihdu])
-        try:
-            rsr = environ['REDMONSTER_SPECTRO_REDUX']
-            run2d = environ['RUN2D']
-            run1d = environ['RUN1D']
-            if (rsr is not None) & (run2d is not None) & (run1d is not None):
-                testpath = join(rsr, run2d, '%s' % plate, run1d)
-                if exists(testpath):
-                    dest = testpath
-                else:
-                    try:
-                        makedirs(testpath)
-                        dest = testpath
-                    except Exception as e:
-                        print("Exception: %r" % e)
-                        dest = None
-        except Exception as e:
-            print("Exception: %r" % e)
-            dest = None
-        if dest is not None:
-            try:
-                thdulist.writeto(join(dest, '%s' % 'chi2arr-%s-%s-%s-%03d.fits'
-                                      % (self.type, plate, mjd, fiberid)),
-                                 clobber=True)
-                print('Writing chi2 file to %s' % \
-                        join(dest, '%s' % 'chi2arr-%s-%s-%s-%03d.fits' %
-                             (self.type, plate, mjd, fiberid)))
-            except Exception as e:
-                print("Exception: %r" % e)
-                print('Environment variables not set or path does not exist - \
-                        not writing chi2 file!')
-        else:
-            print('Environment variables not set or path does not exist - \
-                    not writing chi2 file!')
+        write_chi2arr(plate, mjd, fiberid, self.zchi2arr, self.type, self.zbase,
+                      self.chi2encoding)
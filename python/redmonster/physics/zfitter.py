@@ -11,15 +11,21 @@ import matplotlib as m
 from matplotlib import pyplot as p
 m.interactive(True)
 
-from redmonster.physics.misc import quadfit
 from redmonster.physics import grid_spline as gs
 
 
 class ZFitter:
 
-    def __init__(self, zchi2, zbase):
+    def __init__(self, zchi2, zbase, argmin=None):
+        # zchi2 is the full chi2 array from ZFinder, of shape (nfibers,
+        # template_parameter_1, ..., template_parameter_N, # of redshifts),
+        # or the reduced form (ZFinder(reduce=True)) of shape
+        # (nfibers, # of redshifts) holding the minimum over templates,
+        # with argmin of shape (nfibers, # of redshifts, N) holding the
+        # template indices attaining it
         self.zchi2 = zchi2
         self.zbase = zbase
+        self.argmin = argmin
         self.z = n.zeros((zchi2.shape[0],5))
         self.z_err = n.zeros((zchi2.shape[0],5))
         self.minvector = []
@@ -31,12 +37,17 @@ class ZFitter:
         self.threshold = threshold
         self.width = width
         for ifiber in range(self.zchi2.shape[0]):
-            self.minvector.append( (ifiber,) +
-                                  n.unravel_index(self.zchi2[ifiber].argmin(),
-                                                  self.zchi2[ifiber].shape))
-            bestzvec = n.zeros( self.zchi2.shape[-1])
-            for iz in range(self.zchi2.shape[-1]):
-                bestzvec[iz] = n.min( self.zchi2[ifiber,...,iz] )
+            bestzvec, allminvectors = self.min_over_templates(ifiber)
+            if self.argmin is None:
+                self.minvector.append( (ifiber,) +
+                        n.unravel_index(self.zchi2[ifiber].argmin(),
+                                        self.zchi2[ifiber].shape))
+            else:
+                # First template, then first redshift, among equal minima
+                iz = n.where(bestzvec == n.min(bestzvec))[0]
+                iz = iz[n.lexsort((iz,) +
+                                  tuple(self.argmin[ifiber,iz].T[::-1]))[0]]
+                self.minvector.append( (ifiber,) + allminvectors[iz] + (iz,) )
             posinvec = n.where( bestzvec == n.min(bestzvec) )[0][0]
             # Flag and skip interpolation fit if best chi2 is at edge of z-range
             if (posinvec == 0) or (posinvec == bestzvec.shape[0]-1):
@@ -45,16 +56,9 @@ class ZFitter:
                 self.z_err[ifiber] = -1.
             else:
                 # Find best redshift using global chi2 minimum
-                xp = n.linspace(self.zbase[posinvec-1], self.zbase[posinvec+1],
-                                1000)
-                f = quadfit(self.zbase[posinvec-1:posinvec+2],
-                            bestzvec[posinvec-1:posinvec+2])
-                fit = quad_for_fit(xp, f[0], f[1], f[2])
-                #p.plot(xp, fit, color='red', hold=False)
-                #p.plot(self.zbase[posinvec-1:posinvec+2],
-                        #bestzvec[posinvec-1:posinvec+2], 'ko', hold=True)
-                self.z[ifiber,0] = xp[n.where(fit == n.min(fit))[0][0]]
-                self.z_err[ifiber,0] = self.estimate_z_err(xp, fit)
+                zfit, zfit_err = self.quad_min(bestzvec[None],
+                                               n.array([posinvec]))
+                self.z[ifiber,0], self.z_err[ifiber,0] = zfit[0], zfit_err[0]
                 # Find second- and third-, and fourth-best redshifts
                 zspline = gs.GridSpline(bestzvec)
                 zminlocs = n.round(zspline.get_min())
@@ -87,18 +91,14 @@ class ZFitter:
                 while (self.z[ifiber,1] == 0) | (self.z[ifiber,2] == 0) | \
                         (self.z[ifiber,3] == 0) | (self.z[ifiber,4] == 0):
                     imin += 1
-                    nextpos = zminlocs[n.where(
-                            zminvals == n.sort(zminvals)[imin])[0][0]]
+                    nextpos = int(zminlocs[n.where(
+                            zminvals == n.sort(zminvals)[imin])[0][0]])
                     if (abs(posinvec - nextpos) > width) & (nextpos != 0) & \
                             (nextpos != bestzvec.shape[0]-1) :
-                        xp = n.linspace(self.zbase[nextpos-1],
-                                        self.zbase[nextpos+1], 1000)
-                        f = quadfit(self.zbase[nextpos-1:nextpos+2],
-                                    bestzvec[nextpos-1:nextpos+2])
-                        fit = quad_for_fit(xp, f[0], f[1], f[2])
-                        self.z[ifiber,imin] = xp[n.where(
-                                fit == n.min(fit))[0][0]]
-                        self.z_err[ifiber,imin] = self.estimate_z_err(xp, fit)
+                        zfit, zfit_err = self.quad_min(bestzvec[None],
+                                                       n.array([nextpos]))
+                        self.z[ifiber,imin] = zfit[0]
+                        self.z_err[ifiber,imin] = zfit_err[0]
                     else:
                         self.z[ifiber,imin] = -1.
                         self.z_err[ifiber,imin] = -1.
@@ -107,13 +107,20 @@ class ZFitter:
                 self.flag_small_dchi2(ifiber, bestzvec, threshold=threshold,
                                       width=width)
 
-    def estimate_z_err(self, xp, fit):
-        fitminloc = n.where(fit == n.min(fit))[0]
-        # Rarely, fit will have two equal global minima - use the first
-        if len( fitminloc ) is not 1: fitminloc = fitminloc[0]
-        # abs() of difference between z_(chi2_min) and z_(chi2_min_+1)
-        z_err = abs(xp[fitminloc]-xp[abs(n.min(fit)+1-fit).argmin()])
-        return z_err
+    def min_over_templates(self, ifiber):
+        # Minimum chi2 over templates at each trial redshift, and the
+        # list of template index tuples attaining it
+        if self.argmin is None:
+            nz = self.zchi2.shape[-1]
+            chi2 = self.zchi2[ifiber].reshape(-1, nz)
+            loc = chi2.argmin(axis=0)
+            bestzvec = chi2[loc, n.arange(nz)]
+            argmin = n.stack(n.unravel_index(loc, self.zchi2.shape[1:-1]),
+                             axis=-1)
+        else:
+            bestzvec = n.array(self.zchi2[ifiber], dtype=float)
+            argmin = self.argmin[ifiber]
+        return bestzvec, [tuple(vec) for vec in argmin]
 
     def flag_small_dchi2(self, ifiber, zvector, threshold, width):
         # zvector: vector of minimum chi2 in parameter-space at each redshift
@@ -135,141 +142,151 @@ class ZFitter:
         flag_val = int('0b100000',2) # From BOSS zwarning flag definitions
         self.zwarning[ifiber] = int(self.zwarning[ifiber]) | flag_val
 
+    def min_over_templates_all(self):
+        # Minimum chi2 over templates at each trial redshift for every
+        # fiber, shape (nfibers, # of redshifts), and the template indices
+        # attaining it, shape (nfibers, # of redshifts, N)
+        nfibers, nz = self.zchi2.shape[0], self.zchi2.shape[-1]
+        if self.argmin is None:
+            # Running minimum over templates, in contiguous (nfibers,
+            # # of redshifts) slices, with ties going to the first
+            # template as in argmin (which is very slow along this axis)
+            chi2 = self.zchi2.reshape(nfibers, -1, nz)
+            bestzvec = n.array(chi2[:,0], dtype=float)
+            loc = n.zeros(bestzvec.shape, dtype=int)
+            for j in range(1, chi2.shape[1]):
+                better = chi2[:,j] < bestzvec
+                bestzvec[better] = chi2[:,j][better]
+                loc[better] = j
+            argmin = n.stack(n.unravel_index(loc, self.zchi2.shape[1:-1]),
+                             axis=-1)
+        else:
+            bestzvec = n.array(self.zchi2, dtype=float)
+            argmin = self.argmin
+        return bestzvec, argmin
+
     def z_refine2(self, threshold=23.3, width=15, num_z=5):
         # Default threshold of 23.3 is delta (chi_r)**2 = .005,
         # and width is 1000 km/s
         self.num_z = num_z
         self.threshold = threshold
         self.width = width
-        self.z = n.zeros((self.zchi2.shape[0],num_z))
-        self.z_err = n.zeros((self.zchi2.shape[0],num_z))
+        nfibers = self.zchi2.shape[0]
+        self.z = n.zeros((nfibers,num_z))
+        self.z_err = n.zeros((nfibers,num_z))
+        # Vector of minimum chi2 at each trial redshift, and location
+        # in zchi2[ifiber,...,iz] of each min, for all fibers
+        bestzvec, allminvectors = self.min_over_templates_all()
+        nz = bestzvec.shape[-1]
+        maxchi2 = n.max(bestzvec, axis=1)
+        # Spline minima of every fiber, padded to a common length with
+        # values of inf (never selected)
+        zspline = gs.GridSpline(bestzvec)
+        ifibers, zminlocs = zspline.get_min()
+        nmins = n.bincount(ifibers, minlength=nfibers)
+        locs = n.zeros((nfibers,max(nmins.max(),1)), dtype=int)
+        valid = n.arange(locs.shape[1]) < nmins[:,None]
+        locs[valid] = n.round(zminlocs).astype(int)
+        vals = n.where(valid, zspline.get_val(locs), n.inf)
+        # Selected minima in order, -1 for a repeated redshift
+        posinvecs = n.full((nfibers,num_z), -1)
+        nsel = n.zeros(nfibers, dtype=int)
+        null = nmins == 0
+        for ifiber in n.where(null)[0]: self.flag_null_fit(ifiber)
+        self.z[null] = -1.
+        self.z_err[null] = -1.
+        edge = n.zeros(nfibers, dtype=bool)
+        active = ~null
+        for z_ind in range(num_z):
+            ii = n.where(active)[0]
+            if len(ii) == 0: break
+            # Location in zminvals vector, and in bestzvec, of minimum
+            thisminloc = vals[ii].argmin(axis=1)
+            posinvec = locs[ii,thisminloc]
+            # Flag and skip interpretation if best fit chi2 is at edge of
+            # z-range.  If it's the first redshift, set all num_z
+            # redshifts and errors to -1; if not, this minimum stays the
+            # lowest, so no further redshifts are found for the fiber
+            atedge = (posinvec == 0) | (posinvec == nz-1)
+            if z_ind == 0:
+                for ifiber in ii[atedge]: self.flag_z_fitlimit(ifiber)
+                self.z[ii[atedge]] = -1.
+                self.z_err[ii[atedge]] = -1.
+                edge[ii[atedge]] = True
+            active[ii[atedge]] = False
+            ii, thisminloc, posinvec = ii[~atedge], thisminloc[~atedge], \
+                    posinvec[~atedge]
+            # Fit with quadratic and find minimum and error
+            zfit, zfit_err = self.quad_min(bestzvec[ii], posinvec)
+            repeat = n.any(self.z[ii] == zfit[:,None], axis=1)
+            self.z[ii,z_ind] = n.where(repeat, -1., zfit)
+            self.z_err[ii,z_ind] = n.where(repeat, -1., zfit_err)
+            posinvecs[ii,z_ind] = n.where(repeat, -1, posinvec)
+            nsel[ii] += 1
+            # Set minima within width of this one to n.max(bestzvec)
+            near = valid[ii] & (n.abs(locs[ii] - posinvec[:,None]) <
+                                self.width)
+            near[n.arange(len(ii)),thisminloc] = True
+            vals[ii] = n.where(near, maxchi2[ii,None], vals[ii])
         self.minvectors = []
         self.chi2vals = []
-        for ifiber in range(self.zchi2.shape[0]):
-            allminvectors = []
+        for ifiber in range(nfibers):
+            if null[ifiber] or edge[ifiber]:
+                self.minvectors.append( [(-1,)]*num_z )
+                self.chi2vals.append( [maxchi2[ifiber]]*num_z )
+                continue
             bestminvectors = []
             bestchi2vals = []
-            bestzvec = n.zeros( self.zchi2.shape[-1] )
-            # Make vector of minimum chi2 at each trial redshift
-            for iz in range(self.zchi2.shape[-1]):
-                bestzvec[iz] = n.min( self.zchi2[ifiber,...,iz] )
-                # Location in zchi2[ifiber,...,iz] of min
-                allminvectors.append( n.unravel_index(
-                        self.zchi2[ifiber,...,iz].argmin(),
-                        self.zchi2[ifiber,...,iz].shape ) )
-            zspline = gs.GridSpline(bestzvec) # Spline up bestzvec
-            zminlocs = list(map(int,n.round(zspline.get_min()))) # Minimun locations
-            zminvals = zspline.get_val(zminlocs) # Minimum values
-            z_ind = 0
-            stop = False
-            #import pdb; pdb.set_trace()
-            if len(zminvals) == 0:
-                self.flag_null_fit(ifiber)
-                self.z[ifiber] = -1.
-                self.z_err[ifiber] = -1.
-                bestminvectors = [(-1,)]*num_z
-                bestchi2vals = [n.max(bestzvec)]*num_z
-            else:
-                while (z_ind < num_z) & (stop == False):
-                    # Location in zminvals vector of minimum
-                    thisminloc = zminvals.argmin()
-                    # Location in bestzvec of minimum
-                    posinvec = zminlocs[thisminloc]
-                    # Flag and skip interpretation if best fit chi2 is
-                    # at edge of z-range
-                    if (posinvec == 0) or (posinvec == bestzvec.shape[0]-1):
-                        # If it's the first redshift, set all num_z
-                        # redshifts and errors to -1
-                        if z_ind == 0:
-                            self.flag_z_fitlimit(ifiber)
-                            self.z[ifiber] = -1.
-                            self.z_err[ifiber] = -1.
-                            bestminvectors = [(-1,)]*num_z
-                            bestchi2vals = [n.max(bestzvec)]*num_z
-                            stop = True
-                        # If it's not the first, and if it's on the
-                        # left edge, set the 15 pixels to the right to
-                        # n.max(bestzvec) and move on
-                        elif posinvec == 0:
-                            k = 0
-                            while True:
-                                k += 1
-                                try:
-                                    if n.abs(zminlocs[thisminloc+k] - \
-                                             zminlocs[thisminloc]) < self.width:
-                                        zminvals[thisminloc+k] = n.max(bestzvec)
-                                    else:
-                                        break
-                                except IndexError:
-                                    break
-                            z_ind += 1
-                        # If it's not the first, and if it's on the
-                        # right edge, set the 15 pixels to the left =
-                        # n.max(bestzvec) and move on
-                        elif posinvec == bestzvec.shape[0]-1:
-                            k = 0
-                            while True:
-                                k += 1
-                                try:
-                                    if n.abs(zminlocs[thisminloc-k] - \
-                                             zminlocs[thisminloc]) < self.width:
-                                        zminvals[thisminloc-k] = n.max(bestzvec)
-                                    else:
-                                        break
-                                except IndexError:
-                                    break
-                            z_ind += 1
-                    # Fit with quadratic and find minimum and error
-                    else:
-                        xp = n.linspace(self.zbase[posinvec-1],
-                                        self.zbase[posinvec+1], 1000)
-                        f = quadfit(self.zbase[posinvec-1:posinvec+2],
-                                    bestzvec[posinvec-1:posinvec+2])
-                        fit = quad_for_fit(xp, f[0], f[1], f[2])
-                        if not xp[n.where(fit == n.min(fit))[0][0]] in \
-                                self.z[ifiber]:
-                            self.z[ifiber,z_ind] = xp[n.where(fit ==
-                                                              n.min(fit))[0][0]]
-                            self.z_err[ifiber,z_ind] = self.estimate_z_err(
-                                    xp, fit)
-                            bestchi2vals.append( bestzvec[posinvec] )
-                            bestminvectors.append( allminvectors[posinvec] +
-                                                  (posinvec,) )
-                        else:
-                            self.z[ifiber,z_ind] = -1.
-                            self.z_err[ifiber,z_ind] = -1.
-                            bestchi2vals.append(n.max(bestzvec))
-                            bestminvectors.append((-1,))
-                        zminvals[thisminloc] = n.max(bestzvec)
-                        k = 0
-                        # Set width points to the right and left of minimum
-                        # to n.max(bestzvec)
-                        while True:
-                            k += 1
-                            try:
-                                if n.abs(zminlocs[thisminloc+k] - \
-                                         zminlocs[thisminloc]) < self.width:
-                                    zminvals[thisminloc+k] = n.max(bestzvec)
-                                else:
-                                    break
-                            except IndexError:
-                                break
-                        k = 0
-                        while True:
-                            k += 1
-                            try:
-                                if n.abs(zminlocs[thisminloc-k] - \
-                                         zminlocs[thisminloc]) < self.width:
-                                    zminvals[thisminloc-k] = n.max(bestzvec)
-                                else:
-                                    break
-                            except IndexError:
-                                break
-                        z_ind += 1
+            for pos in posinvecs[ifiber,:nsel[ifiber]]:
+                if pos < 0:
+                    bestminvectors.append((-1,))
+                    bestchi2vals.append(maxchi2[ifiber])
+                else:
+                    bestminvectors.append(
+                            tuple(allminvectors[ifiber,pos]) + (int(pos),))
+                    bestchi2vals.append(bestzvec[ifiber,pos])
             self.minvectors.append( bestminvectors )
             self.chi2vals.append( bestchi2vals )
         self.flag_small_dchi2_2()
 
+    def quad_min(self, zvectors, posinvec):
+        # Redshift and error of the minimum of the parabola through the
+        # chi2 of each zvectors[i] at posinvec[i]-1:posinvec[i]+2, in
+        # closed form.  The minimum is the vertex, or the lower end point
+        # if the vertex lies outside the three points (or the parabola is
+        # not convex), and the error is the distance to the nearest point
+        # within them where chi2 rises by 1, or to the maximum within
+        # them if it never does.  Parabola y = y1 + B*u + A*u**2, u = z - z1
+        rows = n.arange(len(posinvec))[:,None]
+        zs = self.zbase[posinvec[:,None] + n.arange(-1,2)]
+        ys = zvectors[rows,posinvec[:,None] + n.arange(-1,2)]
+        h0, h2 = zs[:,0] - zs[:,1], zs[:,2] - zs[:,1]
+        y0, y1, y2 = ys[:,0], ys[:,1], ys[:,2]
+        d0, d2 = (y0 - y1) / h0, (y2 - y1) / h2
+        A = (d2 - d0) / (h2 - h0)
+        B = d2 - A*h2
+        # (zbase may be decreasing)
+        ulo, uhi = n.minimum(h0, h2), n.maximum(h0, h2)
+        uv = -0.5 * B / n.where(A != 0, A, 1.)
+        inside = (A != 0) & (uv >= ulo) & (uv <= uhi)
+        umin = n.where(inside & (A > 0), uv, n.where(y2 < y0, h2, h0))
+        ymin = n.where(inside & (A > 0), y1 + 0.5*B*uv, n.minimum(y0, y2))
+        # Roots of A*u**2 + B*u + y1 - (ymin + 1) within the points
+        c = y1 - ymin - 1.
+        disc = B**2 - 4*A*c
+        sq = n.sqrt(n.where(disc > 0, disc, 0.))
+        linear = A == 0
+        with n.errstate(divide='ignore', invalid='ignore'):
+            roots = n.where(linear[:,None], (-c / B)[:,None],
+                            (-B[:,None] + n.array([-1., 1.])*sq[:,None]) /
+                            (2*A[:,None]))
+        ok = ((disc >= 0) | linear)[:,None] & (roots >= ulo[:,None]) & \
+                (roots <= uhi[:,None])
+        dist = n.where(ok, n.abs(roots - umin[:,None]), n.inf).min(axis=1)
+        umax = n.where(inside & (A < 0), uv, n.where(y2 > y0, h2, h0))
+        dist = n.where(n.isfinite(dist), dist, n.abs(umax - umin))
+        return zs[:,1] + umin, dist
+
     def flag_small_dchi2_2(self):
         flag_val = int('0b100',2) # From BOSS zwarning flag definitions
         if self.num_z > 1:
@@ -283,8 +300,3 @@ class ZFitter:
     def flag_null_fit(self, ifiber):
         null_fit_flag = int('0b100000000',2)
         self.zwarning[ifiber] = int(self.zwarning[ifiber]) | null_fit_flag
-
-
-def quad_for_fit(x, a, b, c):
-    return a*(x**2) + b*x + c
-
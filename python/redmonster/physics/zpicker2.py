@@ -15,12 +15,10 @@ from os import environ
 from os.path import join
 
 import numpy as n
-from scipy import linalg
-from scipy.optimize import nnls
 from astropy.io import fits
 
-from redmonster.physics.misc import poly_array
-from redmonster.datamgr.io import read_ndArch
+from redmonster.physics.misc import poly_array, nnls_normal
+from redmonster.datamgr.tempcache import get_templates
 
 class ZPicker:
 
@@ -53,6 +51,9 @@ class ZPicker:
         self.models = n.zeros( (specobj.flux.shape[0],num_z,self.npixflux) )
         self.fs = []
         self.nclass = len(zfindobjs)
+        # Correlation FFT length used for each class (0 for direct sums)
+        self.nfft = [0 if zfindobj.direct else zfindobj.nfft for zfindobj
+                     in zfindobjs]
         #self.minrchi2 = n.zeros( (zfindobjs[0].zchi2arr.shape[0],self.num_z) )
         self.minrchi2 = []
         self.rchi2diff = []
@@ -79,6 +80,7 @@ class ZPicker:
         # [0,1,2,3,0,1,2,3,0,1,2,3] for num_z=4 and 3 templates)
         poslist = list(range(self.num_z))*len(zfindobjs)
         rchi2s = []
+        slots = []
         for itemp in range(len(zfindobjs)):
             for i in range(self.num_z):
                 tempdict[ i+(itemp*self.num_z) ] = itemp
@@ -188,12 +190,11 @@ class ZPicker:
                             self.sn2_data.append(
                                     zfindobjs[tempnum].sn2_data[ifiber])
                         fibermins[zpos] = 1e9
-                        self.models[ifiber,iz], f = self.create_model(
-                                fnametuple[iz], npolytuple[iz],
-                                npixsteptuple[iz], vectortuple[iz],
-                                zfindobjs[tempnum], self.flux[ifiber],
-                                self.ivar[ifiber])
-                        fstuple += (f,)
+                        # Model is fit below, with those of all fibers
+                        slots.append( (ifiber, iz, fnametuple[iz],
+                                       npolytuple[iz], npixsteptuple[iz],
+                                       vectortuple[iz], zfindobjs[tempnum]) )
+                        fstuple += ((0,),)
                         iz += 1
                     else:
                         fibermins[zpos] = 1e9
@@ -228,6 +229,7 @@ class ZPicker:
                 self.flag_small_dchi2(ifiber)
             self.flag_null_fit(ifiber, flags)
         self.zwarning = list(map(int, self.zwarning))
+        self.create_models(slots)
 
     def flag_small_dchi2(self, ifiber):
         """Set the small delta chi**2 zwarning flag."""
@@ -242,37 +244,46 @@ class ZPicker:
                 self.zwarning[ifiber] = int(self.zwarning[ifiber]) | \
                         null_fit_flag
 
-    def create_model(self, fname, npoly, npixstep, minvector, zfindobj,
-                     flux, ivar):
-        """Return the best fit model for a given template at a
-            given redshift.
+    def create_models(self, slots, nbatch=50):
+        """Fill self.models and self.fs with the best fit models and
+            coefficients of each (ifiber, iz, fname, npoly, npixstep,
+            minvector, zfindobj) in slots.  The template amplitudes are
+            constrained to be nonnegative; the weighted normal equations
+            of nbatch slots at a time are solved at once with nnls_normal.
         """
-        try:
-            pixoffset = zfindobj.pixoffset
-            temps = read_ndArch( join( environ['REDMONSTER_TEMPLATES_DIR'],
-                                      fname ) )[0]
-            pmat = n.zeros( (self.npixflux, npoly+1) )
-            this_temp = temps[minvector[:-1]]
-            pmat[:,0] = this_temp[(minvector[-1]*npixstep)+pixoffset:\
-                                  (minvector[-1]*npixstep)+pixoffset + \
-                                  self.npixflux]
-            polyarr = poly_array(npoly, self.npixflux)
-            pmat[:,1:] = n.transpose(polyarr)
-            ninv = n.diag(ivar)
-            f = linalg.solve( n.dot(n.dot(n.transpose(pmat),ninv),pmat),
-                               n.dot( n.dot(n.transpose(pmat),ninv),flux) ); \
-                    f = n.array(f)
-            if f[0] < 0:
+        fs = [list(f) for f in self.fs]
+        kmax = max([slot[3] for slot in slots] + [0]) + 1
+        for start in range(0, len(slots), nbatch):
+            batch = slots[start:start+nbatch]
+            pmat = n.zeros( (len(batch),self.npixflux,kmax) )
+            fitted = []
+            for i, (ifiber, iz, fname, npoly, npixstep, minvector,
+                    zfindobj) in enumerate(batch):
                 try:
-                    f = nnls( n.dot(n.dot(n.transpose(pmat),ninv),pmat),
-                             n.dot( n.dot(n.transpose(pmat),ninv),flux) )[0]; \
-                            f = n.array(f)
-                    return n.dot(pmat,f), tuple(f)
+                    # Templates are shared with ZFinder by the registry
+                    temps = get_templates( join(
+                            environ['REDMONSTER_TEMPLATES_DIR'], fname) )[0]
+                    lo = minvector[-1]*npixstep + zfindobj.pixoffset
+                    pmat[i,:,0] = temps[minvector[:-1]][lo:lo+self.npixflux]
+                    pmat[i,:,1:npoly+1] = n.transpose(
+                            poly_array(npoly, self.npixflux))
+                    fitted.append(i)
                 except Exception as e:
                     print("Exception: %r" % e)
-                    return n.zeros(self.npixflux), (0,)
-            else:
-                return n.dot(pmat,f), tuple(f)
-        except Exception as e:
-            print("Exception: %r" % e)
-            return n.zeros(self.npixflux), (0,)
+            if len(fitted) == 0: continue
+            pmat = pmat[fitted]
+            ifibers = n.array([batch[i][0] for i in fitted])
+            izs = n.array([batch[i][1] for i in fitted])
+            # Unused polynomial columns of lower npoly fits get unit
+            # diagonals, and so zero coefficients
+            pad = n.all(pmat == 0, axis=1) & (n.arange(kmax) > 0)
+            pmat_ivar = n.transpose(pmat, (0,2,1)) * \
+                    self.ivar[ifibers][:,None,:]
+            M = n.matmul(pmat_ivar, pmat)
+            M[pad[:,:,None] & n.eye(kmax, dtype=bool)] = 1.
+            v = n.matmul(pmat_ivar, self.flux[ifibers][:,:,None])[:,:,0]
+            f = nnls_normal(M, v, nonneg=(n.arange(kmax) == 0))
+            self.models[ifibers,izs] = n.matmul(pmat, f[:,:,None])[:,:,0]
+            for j, i in enumerate(fitted):
+                fs[ifibers[j]][izs[j]] = tuple(f[j,:batch[i][3]+1])
+        self.fs = [tuple(f) for f in fs]
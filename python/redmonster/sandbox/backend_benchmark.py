@@ -0,0 +1,71 @@
+# Benchmark of the ZFinder execution backends: serial, threads and
+# processes, on a synthetic plate.  Each fiber is a randomly chosen
+# template of TEMPLATE (in $REDMONSTER_TEMPLATES_DIR), shifted to a random
+# trial redshift and scaled, plus a low order polynomial and Gaussian
+# noise, on a BOSS-like log-lambda grid.  For each backend and number of
+# workers we report the best of ntrials zchi2 times and check that the
+# chi2 surfaces agree with the serial ones.
+#
+# Usage: python backend_benchmark.py [nfibers] [nproc,nproc,...] [template]
+
+import sys
+from time import time
+
+import numpy as n
+
+from redmonster.physics.zfinder import ZFinder, threadpool_limits
+
+nfibers = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+nprocs = [int(x) for x in sys.argv[2].split(',')] if len(sys.argv) > 2 \
+        else [2, 4]
+fname = sys.argv[3] if len(sys.argv) > 3 else \
+        'ndArch-ssp_galaxy_noemit-v000.fits'
+zmin, zmax, npoly = 0.01, 0.6, 3
+npix = 4000
+ntrials = 2
+
+def plate(zf):
+    # Synthetic spectra on the log-lambda grid of the templates
+    rng = n.random.RandomState(1)
+    loglam0 = n.log10(zf.tempwave[0]) + 0.3
+    loglam = loglam0 + n.arange(npix) * 1e-4
+    zf.create_z_baseline(loglam0)
+    zminpix, zmaxpix = zf.conv_zbounds()
+    temps = n.reshape(zf.templates, (-1,zf.fftnaxis1))
+    flux = n.zeros((nfibers, npix))
+    for i in range(nfibers):
+        t = temps[rng.randint(temps.shape[0])]
+        k = rng.randint(zminpix, zmaxpix)
+        flux[i] = t[k:k+npix] / n.mean(n.abs(t[k:k+npix])) * \
+                rng.uniform(1, 10) + rng.uniform(-1, 1)
+    ivar = n.ones((nfibers, npix)) / rng.uniform(0.5, 2, (nfibers, 1))**2
+    flux += rng.standard_normal(flux.shape) / n.sqrt(ivar)
+    return flux, loglam, ivar
+
+def run(flux, loglam, ivar, **kwargs):
+    # Best of ntrials zchi2 times, with the pool started beforehand
+    zf = ZFinder(fname=fname, npoly=npoly, zmin=zmin, zmax=zmax, **kwargs)
+    if zf.nproc > 1: zf.start_pool()
+    best = n.inf
+    for trial in range(ntrials):
+        start = time()
+        zf.zchi2(flux.copy(), loglam, ivar.copy())
+        best = min(best, time() - start)
+    zf.close_pool()
+    return best, zf.zchi2arr
+
+print('threadpoolctl %s' % ('available' if threadpool_limits is not None
+                            else 'not installed: BLAS threads not pinned'))
+flux, loglam, ivar = plate(ZFinder(fname=fname, npoly=npoly, zmin=zmin,
+                                   zmax=zmax))
+tserial, chi2 = run(flux, loglam, ivar)
+results = [('serial', 1, tserial, 0.)]
+for nproc in nprocs:
+    for backend in ['threads', 'processes']:
+        t, c = run(flux, loglam, ivar, nproc=nproc, backend=backend)
+        results.append((backend, nproc, t, n.abs(c - chi2).max()))
+print('%-10s %5s %9s %8s %12s' % ('backend', 'nproc', 'zchi2 (s)', 'speedup',
+                                  'max |dchi2|'))
+for backend, nproc, t, err in results:
+    print('%-10s %5d %9.2f %8.2f %12.3g' % (backend, nproc, t, tserial / t,
+                                            err))
@@ -0,0 +1,82 @@
+# Benchmark of ZFinder FFT lengths: power of two (misc.two_pad) versus the
+# 2/3/5-smooth length of tempcache.fft_window, for every ndArch template
+# file in $REDMONSTER_TEMPLATES_DIR.  For each template the FFT covers the
+# template window ZFinder.zchi2 transforms for a BOSS spectrum of npix
+# pixels starting at loglam0 over the template's redshift range (as in
+# conf/zfind.ini: galaxies -0.01 to 1.2, QSOs 0.4 to 3.5, other templates
+# -0.005 to 0.005), and we time the transforms of the cropped templates
+# and the correlation of a block of fibers against all templates, and
+# report the template FFT memory.
+#
+# Usage: python fft_len_benchmark.py [npix] [nfibers] [loglam0]
+
+import sys
+from os import environ, listdir
+from time import time
+
+import numpy as n
+
+from redmonster.physics.zfinder import ZFinder
+from redmonster.physics.misc import two_pad
+from redmonster.datamgr.tempcache import fft_window
+
+npix = int(sys.argv[1]) if len(sys.argv) > 1 else 4600
+nfibers = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+loglam0 = float(sys.argv[3]) if len(sys.argv) > 3 else 3.5523
+ntrials = 3
+
+def zrange(fname):
+    # Redshift range searched for the template in conf/zfind.ini
+    if 'galaxy' in fname.lower(): return -0.01, 1.2
+    if 'qso' in fname.lower(): return 0.4, 3.5
+    return -0.005, 0.005
+
+def window(fname):
+    # Template window and FFT length of ZFinder.zchi2 (npixstep=1), or
+    # None if the template does not cover the redshift range
+    zmin, zmax = zrange(fname)
+    zf = ZFinder(fname=fname, npoly=4, zmin=zmin, zmax=zmax)
+    zf.create_z_baseline(loglam0)
+    zminpix, zmaxpix = zf.conv_zbounds()
+    if zmaxpix <= zminpix: return None
+    lo, hi, nfft = fft_window(zminpix, zmaxpix - 1 + npix)
+    return zf.templates_flat, lo, hi, nfft
+
+def bench(templates, data, nfft):
+    # Best of ntrials for the template FFTs and one correlation block
+    t_temp = t_corr = n.inf
+    for trial in range(ntrials):
+        start = time()
+        t_fft = n.fft.rfft(templates, nfft)
+        t2_fft = n.fft.rfft(templates**2, nfft)
+        t_temp = min(t_temp, time() - start)
+        d_fft = n.fft.rfft(data, nfft)
+        start = time()
+        for i in range(d_fft.shape[0]):
+            n.fft.irfft(t_fft * d_fft[i].conj(), nfft)
+        t_corr = min(t_corr, time() - start)
+    return t_temp, t_corr, (t_fft.nbytes + t2_fft.nbytes) / 2.**20
+
+tempdir = environ['REDMONSTER_TEMPLATES_DIR']
+data = n.random.standard_normal((nfibers, npix))
+print('%-36s %6s %11s %6s %6s %9s %9s %9s %9s %8s %8s' %
+      ('template', 'ntemps', 'window', 'two', 'fast', 'tfft_two',
+       'tfft_fast', 'corr_two', 'corr_fast', 'MB_two', 'MB_fast'))
+for fname in sorted(listdir(tempdir)):
+    if not (fname.startswith('ndArch') and fname.endswith('.fits')): continue
+    win = window(fname)
+    if win is None:
+        print('%-36s does not cover z = %g to %g' % ((fname[:36],) +
+                                                     zrange(fname)))
+        continue
+    templates, lo, hi, nfft5 = win
+    # The cropped templates, wrapping around the padded length as in
+    # tempcache.template_fft
+    templates = n.take(templates, n.arange(lo, hi) % templates.shape[-1],
+                       axis=1)
+    nfft2 = two_pad(hi - lo)
+    tt2, tc2, mb2 = bench(templates, data, nfft2)
+    tt5, tc5, mb5 = bench(templates, data, nfft5)
+    print('%-36s %6d %5d-%5d %6d %6d %9.3f %9.3f %9.3f %9.3f %8.1f %8.1f' %
+          (fname[:36], templates.shape[0], lo, hi, nfft2, nfft5, tt2, tt5,
+           tc2, tc5, mb2, mb5))
@@ -0,0 +1,34 @@
+"""
+redmonster.test.redmonster_test_suite
+=====================================
+
+Used to initialize the unit test framework via ``python setup.py test``.
+"""
+from __future__ import absolute_import, division, print_function
+
+import unittest
+
+
+def redmonster_test_suite():
+    """Returns unittest.TestSuite of redmonster tests.
+
+    This is factored out separately from runtests() so that it can be used by
+    ``python setup.py test``.
+    """
+    from os.path import dirname
+    test_dir = dirname(__file__)
+    return unittest.defaultTestLoader.discover(test_dir,
+        top_level_dir=dirname(dirname(dirname(test_dir))))
+
+
+def runtests():
+    """Run all tests in redmonster.test.test_*.
+    """
+    # Load all TestCase classes from redmonster/test/test_*.py
+    tests = redmonster_test_suite()
+    # Run them
+    unittest.TextTestRunner(verbosity=2).run(tests)
+
+
+if __name__ == "__main__":
+    runtests()
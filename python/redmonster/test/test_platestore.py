@@ -0,0 +1,106 @@
+"""
+Test redmonster.datamgr.platestore.PlateStore.
+"""
+from __future__ import absolute_import, division, print_function
+
+import unittest
+from os.path import join, getsize
+from shutil import rmtree
+from tempfile import mkdtemp
+import io
+import contextlib
+
+import numpy as n
+from astropy.io import fits
+
+from redmonster.datamgr.platestore import PlateStore
+
+
+def row(fiberid):
+    """Table row of fiber fiberid."""
+    return [('Z', 'D', 0.1 * fiberid), ('CLASS', '6A', 'ssp_%d' % fiberid)]
+
+
+def models(fiberid):
+    """Models of fiber fiberid."""
+    return n.arange(10.).reshape(2, 5) + fiberid
+
+
+class TestPlateStore(unittest.TestCase):
+    """Test redmonster.datamgr.platestore.PlateStore.
+    """
+
+    def setUp(self):
+        self.dest = mkdtemp()
+        self.store = PlateStore(1234, 56789, self.dest)
+
+    def tearDown(self):
+        rmtree(self.dest, ignore_errors=True)
+
+    def append(self, fiberid, offset=0, **kwargs):
+        hdr = fits.Header([('FIBER', fiberid)])
+        with contextlib.redirect_stdout(io.StringIO()):
+            return self.store.append(fiberid, row(fiberid),
+                                     models(fiberid) + offset, hdr, **kwargs)
+
+    def read_index(self, store=None):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return (store or self.store).read_index()
+
+    def test_last_record(self):
+        """The last record of a fiber in the file wins.
+        """
+        for fiberid, offset in ((1, 0), (2, 0), (1, 100)):
+            self.assertTrue(self.append(fiberid, offset))
+        index = self.read_index()
+        self.assertEqual(sorted(index), [1, 2])
+        shape, fibrow, hdr, offset = index[1]
+        self.assertEqual(offset, max([index[f][3] for f in index]))
+        with contextlib.redirect_stdout(io.StringIO()):
+            dest = self.store.finalize()
+        with fits.open(dest) as hdul:
+            self.assertEqual(hdul[0].header['FIBER'], 1)
+            self.assertEqual(list(hdul[1].data['FIBERID']), [2, 3])
+            self.assertTrue((hdul[2].data == [models(1) + 100,
+                                              models(2)]).all())
+
+    def test_torn_record(self):
+        """Fibers left with only a torn record are reported lost.
+        """
+        for fiberid in (1, 2):
+            self.append(fiberid)
+        size = getsize(self.store.path)
+        self.append(3)
+        # Cut the record of fiber 3 short, as a crashed worker would, and
+        # append fiber 4 after it
+        with open(self.store.path, 'r+b') as f:
+            f.truncate(size + (getsize(self.store.path) - size) // 2)
+        self.append(4)
+        store = PlateStore(1234, 56789, self.dest)
+        self.assertEqual(sorted(self.read_index(store)), [1, 2, 4])
+        self.assertEqual(store.lost, [3])
+        self.assertEqual(store.nbad, 1)
+        # Appending the fiber again recovers it
+        self.append(3)
+        self.assertEqual(sorted(self.read_index(store)), [1, 2, 3, 4])
+        self.assertEqual(store.lost, [])
+
+    def test_no_clobber(self):
+        """Without clobber, fibers in the store are kept, reading the store
+        once per PlateStore.
+        """
+        self.append(1)
+        size = getsize(self.store.path)
+        reads = []
+        read_index = self.store.read_index
+        def counted(*args, **kwargs):
+            reads.append(1)
+            return read_index(*args, **kwargs)
+        self.store.read_index = counted
+        self.assertFalse(self.append(1, clobber=False))
+        self.assertEqual(getsize(self.store.path), size)
+        for fiberid in range(2, 20):
+            self.assertTrue(self.append(fiberid, clobber=False))
+        self.assertFalse(self.append(5, clobber=False))
+        self.assertEqual(len(reads), 1)
+        self.assertEqual(sorted(self.read_index()), list(range(1, 20)))
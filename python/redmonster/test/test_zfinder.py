@@ -0,0 +1,184 @@
+"""
+Test redmonster.physics.zfinder.ZFinder: the chi2 surfaces of its
+correlator paths against each other on a synthetic plate.
+"""
+from __future__ import absolute_import, division, print_function
+
+import unittest
+from os import environ
+from os.path import abspath, dirname, join
+from shutil import rmtree
+from tempfile import mkdtemp
+import io
+import contextlib
+
+import numpy as n
+
+from redmonster.physics.zfinder import ZFinder
+from redmonster.physics.zfitter import ZFitter
+
+# Bundled templates of the repository
+templatesdir = abspath(join(dirname(__file__), '..', '..', '..', 'templates'))
+fname = 'ndArch-ssp_galaxy_noemit-v000.fits'
+zmin, zmax = 0.1, 0.3
+
+
+def make_plate(nfibers=6, npix=2000, seed=1):
+    """
+    Synthetic plate of templates of fname at random redshifts in zmin to
+    zmax, scaled and offset, with gaussian noise; returns (flux, loglam,
+    ivar).
+    """
+    rng = n.random.RandomState(seed)
+    zf = ZFinder(fname=fname, npoly=0, zmin=zmin, zmax=zmax)
+    loglam0 = n.log10(zf.tempwave[0]) + 0.2
+    loglam = loglam0 + n.arange(npix) * 1e-4
+    zf.create_z_baseline(loglam0)
+    zminpix, zmaxpix = zf.conv_zbounds()
+    flux = n.zeros((nfibers, npix))
+    for i in range(nfibers):
+        t = zf.templates_flat[rng.randint(zf.ntemps)]
+        k = rng.randint(zminpix, zmaxpix)
+        flux[i] = t[k:k+npix] / n.mean(n.abs(t[k:k+npix])) * \
+                rng.uniform(1, 5) + rng.uniform(-1, 1)
+    ivar = n.ones((nfibers, npix)) / rng.uniform(0.5, 2, (nfibers, 1))**2
+    flux += rng.standard_normal(flux.shape) / n.sqrt(ivar)
+    return flux, loglam, ivar
+
+
+def run_zchi2(flux, loglam, ivar, npoly=3, zchi2_args={}, **kwargs):
+    """ZFinder(**kwargs) after zchi2 on the plate, its output silenced."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        zf = ZFinder(fname=fname, npoly=npoly, zmin=zmin, zmax=zmax,
+                     **kwargs)
+        zf.zchi2(flux.copy(), loglam, ivar.copy(), **zchi2_args)
+        zf.close_pool()
+    return zf
+
+
+class TestZFinder(unittest.TestCase):
+    """Test redmonster.physics.zfinder.ZFinder.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.environ = dict(environ)
+        environ['REDMONSTER_TEMPLATES_DIR'] = templatesdir
+        cls.cachedir = mkdtemp()
+        environ['REDMONSTER_CACHE_DIR'] = cls.cachedir
+        cls.flux, cls.loglam, cls.ivar = make_plate()
+        cls.full = dict([(npoly, run_zchi2(cls.flux, cls.loglam, cls.ivar,
+                                           npoly, correlator='fft'))
+                         for npoly in (0, 3)])
+
+    @classmethod
+    def tearDownClass(cls):
+        environ.clear()
+        environ.update(cls.environ)
+        rmtree(cls.cachedir, ignore_errors=True)
+
+    def assert_chi2_equal(self, chi2, ref):
+        # Equal to round-off relative to the chi2 scale
+        self.assertEqual(chi2.shape, ref.shape)
+        self.assertLess(n.abs(chi2 - ref).max(), 1e-9 * n.abs(ref).max())
+
+    def test_rfft(self):
+        """Real-to-complex and complex FFT chi2 surfaces agree.
+        """
+        for npoly in (0, 3):
+            zf = run_zchi2(self.flux, self.loglam, self.ivar, npoly,
+                           correlator='fft', rfft=False)
+            self.assert_chi2_equal(zf.zchi2arr, self.full[npoly].zchi2arr)
+            self.assertTrue((zf.zwarning == self.full[npoly].zwarning).all())
+
+    def test_direct(self):
+        """Direct sum and FFT chi2 surfaces agree.
+        """
+        for npoly in (0, 3):
+            zf = run_zchi2(self.flux, self.loglam, self.ivar, npoly,
+                           correlator='direct')
+            self.assertTrue(zf.direct)
+            self.assert_chi2_equal(zf.zchi2arr, self.full[npoly].zchi2arr)
+
+    def test_reduce(self):
+        """Reduced chi2 holds the minimum and argmin over templates.
+        """
+        full = self.full[3]
+        zf = run_zchi2(self.flux, self.loglam, self.ivar, correlator='fft',
+                       reduce=True)
+        chi2 = full.zchi2arr.reshape(self.flux.shape[0], -1,
+                                     full.zchi2arr.shape[-1])
+        self.assert_chi2_equal(zf.zchi2arr, chi2.min(axis=1))
+        argmin = n.ravel_multi_index(tuple(n.moveaxis(zf.zchi2argmin, -1,
+                                                      0)),
+                                     full.zchi2arr.shape[1:-1])
+        self.assertTrue((argmin == chi2.argmin(axis=1)).all())
+        self.assertTrue((zf.zwarning == full.zwarning).all())
+
+    def test_store_models(self):
+        """Reduced and full chi2 give the same best fit models.
+        """
+        zf = run_zchi2(self.flux, self.loglam, self.ivar, correlator='fft',
+                       reduce=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            zf.store_models(self.flux, self.ivar)
+            self.full[3].store_models(self.flux, self.ivar)
+        self.assertEqual(zf.models.shape, self.flux.shape)
+        self.assertTrue(n.allclose(zf.models, self.full[3].models))
+        self.assertTrue((n.abs(zf.models).max(axis=1) > 0).all())
+
+    def test_refine(self):
+        """Coarse-to-fine search, with and without template pruning, finds
+        the redshifts of the full search.
+        """
+        full = self.full[3]
+        with contextlib.redirect_stdout(io.StringIO()):
+            zfit = ZFitter(full.zchi2arr, full.zbase)
+            zfit.z_refine2()
+        for npixstep, correlator, reduce, prune in [
+                (2, 'fft', False, False), (4, 'fft', False, False),
+                (4, 'fft', True, False), (4, 'direct', False, False),
+                (2, 'fft', False, True), (4, 'direct', False, True)]:
+            zf = run_zchi2(self.flux, self.loglam, self.ivar,
+                           correlator=correlator, reduce=reduce,
+                           zchi2_args=dict(npixstep=npixstep, refine=True,
+                                           prune=prune))
+            self.assertEqual(zf.npixstep, 1)
+            self.assertTrue(n.allclose(zf.zbase, full.zbase))
+            with contextlib.redirect_stdout(io.StringIO()):
+                f = ZFitter(zf.zchi2arr, zf.zbase, zf.zchi2argmin)
+                f.z_refine2()
+            # All num_z redshifts and chi2 minima
+            self.assertTrue(n.allclose(f.z, zfit.z, rtol=0, atol=1e-10))
+            self.assertTrue(n.allclose(f.chi2vals, zfit.chi2vals))
+            self.assertTrue((f.zwarning == zfit.zwarning).all())
+
+    def test_rank(self):
+        """Low rank chi2 is within rank_tol of the full template set, or
+        is refitted with it for that call only.
+        """
+        full = self.full[3]
+        zf = run_zchi2(self.flux, self.loglam, self.ivar, correlator='fft',
+                       rank=55)
+        self.assertEqual(zf.rank_used, (55, 55))
+        self.assertLessEqual(zf.rank_error, zf.rank_tol)
+        self.assertLess(n.abs(zf.zchi2arr - full.zchi2arr).max(),
+                        zf.rank_tol)
+        zf = run_zchi2(self.flux, self.loglam, self.ivar, correlator='fft',
+                       rank=5)
+        for call in range(2):
+            if call:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    zf.zchi2(self.flux.copy(), self.loglam, self.ivar.copy())
+            self.assertEqual(zf.lowrank, 5)
+            self.assertIsNone(zf.rank_used)
+            self.assertGreater(zf.rank_error, zf.rank_tol)
+            self.assert_chi2_equal(zf.zchi2arr, full.zchi2arr)
+
+    def test_blocks(self):
+        """Chi2 does not depend on the fiber x template blocking.
+        """
+        zf = run_zchi2(self.flux, self.loglam, self.ivar, correlator='fft',
+                       maxmem=1)
+        self.assert_chi2_equal(zf.zchi2arr, self.full[3].zchi2arr)
+
@@ -51,6 +51,10 @@ if platedir:
             for x in iglob( join( topdir, run2d, rmver, str(plate),
                                  'redmonster-%s-*-*.fits' % plate) ):
                 files.append(x)
+            # Plate stores of fibers appended by zfind -f
+            for x in iglob( join( topdir, run2d, rmver, str(plate),
+                                 'redmonster-%s-*.store' % plate) ):
+                files.append(x)
             for file in files:
                 '''
                 if mjds is not basename(file)[16:21]:
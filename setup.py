@@ -61,7 +61,7 @@ setup_keywords['use_2to3'] = True
 setup_keywords['packages'] = find_packages('python')
 setup_keywords['package_dir'] = {'':'python'}
 setup_keywords['cmdclass'] = {'sdist': DistutilsSdist}
-# setup_keywords['test_suite'] = '{name}.test.{name}_test_suite.{name}_test_suite'.format(**setup_keywords)
+setup_keywords['test_suite'] = '{name}.test.{name}_test_suite.{name}_test_suite'.format(**setup_keywords)
 #
 # Autogenerate command-line scripts.
 #